@@ -21,7 +21,7 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 from sys import stderr, argv, version_info, exit,version_info
-from os import path, remove, makedirs, getcwd
+from os import path, remove, makedirs, getcwd, listdir
 from shutil import copy as shutil_copy
 from uuid import uuid4
 import errno
@@ -35,24 +35,33 @@ import re
 import sqlite3
 
 import gzip
+import hashlib
 
-from subprocess import Popen
 
 '''Import new objects for CanSNPer1.1'''
-from CanSNPer.modules.ParseXMFA import ParseXMFA
-from multiprocessing import Process, Queue
+from CanSNPer import __version__
+from CanSNPer.x2fa import x2fa
+from CanSNPer.modules.ParseXMFA import ParseXMFA, CanSNPerClassification
+from CanSNPer.modules.DatabaseConnection import open_database
+from CanSNPer.modules.MauveScheduler import MauveScheduler, MauveJob
+from CanSNPer.modules.ReferenceCache import ReferenceCache
+from CanSNPer.modules.ResultCache import ResultCache
+from CanSNPer.modules.CanSNPTree import CanSNPTree
+from CanSNPer.modules.DatabaseSchema import DatabaseSchema, DuplicateRowsError
+from CanSNPer.modules.SequenceStore import SequenceStore
+from CanSNPer.modules.KmerTyper import KmerTyper
+from CanSNPer.modules.LocalAligner import LocalAligner
+from CanSNPer.modules.MinHashSketch import MinHashSketch
+from multiprocessing import Pool, cpu_count
 
 from ete3 import Tree, faces, AttrFace, TreeStyle, NodeStyle
 
 def zopen(path,*args, **kwargs):
 	'''Redefine open to handle zipped files automatically'''
 	if path.endswith(".gz"):
-		#print(sys.version_info.major)
-		if str(*args) in ["r","w"] and version_info.major >= 3:
-			## Python version three and above interprets binary formats as binary, add t (rt) to get text returned
-			#args = (str(*args)+"t",)
-			print("Opening: ", args)
-		print("Opening wrong: ", args)
+		if args and args[0] in ["r","w","a"]:
+			## gzip opens files as binary by default, add t (rt) to get text returned like open does
+			args = (args[0]+"t",) + args[1:]
 		return gzip.open(path,*args,**kwargs)
 	else:
 		#if str(*args) in ["r","w"] and version_info.major >= 3:
@@ -80,9 +89,17 @@ def parse_arguments():
 	# Parse command line arguments
 	parser = argparse.ArgumentParser(description=cansnper_description)
 	parser.add_argument("-r", "--reference",
-						help="the name of the organism")
+						help="the name of the organism, queries that are typed " +
+						"without it are matched to an organism of the database " +
+						"by MinHash sketches")
 	parser.add_argument("-i", "--query",
 						help="fasta sequence file name that is to be analysed")
+	parser.add_argument("--query_batch", nargs="+",
+						help="type many fasta files in one run, given as " +
+						"fasta files, directories or manifest files " +
+						"listing one fasta file per line")
+	parser.add_argument("--batch_output", default="CanSNPer_batch.tsv",
+						help="consolidated result table of --query_batch [CanSNPer_batch.tsv]")
 	parser.add_argument("-b", "--db_path",
 						help="path to CanSNPerDB.db")
 	parser.add_argument("--import_tree_file",
@@ -93,12 +110,20 @@ def parse_arguments():
 						help="loads a sequence file into the database")
 	parser.add_argument("--strain_name",
 						help="the name of the strain")
-	## Depricated all SNPs will be considered
-	# parser.add_argument("--allow_differences",
-	# 					help="allow a number of SNPs to be wrong, i.e." +
-	# 					"continue moving down the tree even if none of the " +
-	# 					"SNPs of the lower level are present [0]", type=int,
-	# 					default=0)
+	parser.add_argument("--pack_sequences", action="store_true",
+						help="store reference sequences 2-bit packed, " +
+						"sequences stored as text are packed and " +
+						"--import_seq_file stores its sequence packed")
+	parser.add_argument("--sketch_references", action="store_true",
+						help="store MinHash sketches of the reference sequences, " +
+						"used to find the organism of queries typed without --reference")
+	parser.add_argument("--allow_differences",
+						help="allow a number of SNPs to be wrong, i.e. " +
+						"continue moving down the tree even if none of the " +
+						"SNPs of the lower level are present [0], the " +
+						"default only follows derived SNPs, the SNPs passed " +
+						"this way are listed in a warning", type=int,
+						default=0)
 	parser.add_argument("-t", "--tab_sep", action="store_true",
 						help="print the results in a simple tab " +
 						"separated format")
@@ -113,19 +138,39 @@ def parse_arguments():
 						help="prints some more information about the " +
 						"goings-ons of the program while running")
 	parser.add_argument("-s", "--save_align", action="store_true",
-						help="saves the alignment file")
+						help="saves the alignments in fasta format as well, " +
+						"<tmp_path>/<query>.CanSNPer.<strain>.fa, every query is " +
+						"aligned, the result cache and --kmer_typing are not used")
 	parser.add_argument("-n", "--num_threads",
 						help="maximum number of threads CanSNPer is " +
-						"allowed to use, the default [0] is no limit, " +
-						"CanSNPer will start one process per " +
-						"reference genome while aligning", type=int, default=0)
+						"allowed to use, with the default [0] CanSNPer " +
+						"will start one process per core, or per " +
+						"reference genome if there are more, while " +
+						"aligning and one alignment parser per core", type=int, default=0)
 	parser.add_argument("-delete_organism", action="store_true",
 						help="deletes all information in the database " +
 						"concerning an organism")
 	parser.add_argument("-initialise_organism", action="store_true",
 						help="initialise a new table for an organism")
+	parser.add_argument("--immutable_database", action="store_true",
+						help="open the database as immutable when typing, faster on " +
+						"network file systems but only safe if nobody changes the database")
+	parser.add_argument("--migrate_database", action="store_true",
+						help="add the indexes and keys of the latest schema " +
+						"version to an existing database")
 	parser.add_argument("-f", "--tmp_path",
 						help="where temporary files are stored")
+	parser.add_argument("--reference_cache",
+						help="where reference fasta files are kept between runs " +
+						"[<tmp_path>/reference_cache]")
+	parser.add_argument("--result_cache", nargs="?", const=True,
+						help="keep typing results between runs, optionally " +
+						"where [<tmp_path>/result_cache], remove the folder " +
+						"to clear it")
+	parser.add_argument("--result_cache_size", type=int, default=100,
+						help="maximum size of the result cache in megabytes [100]")
+	parser.add_argument("--no_result_cache", action="store_true",
+						help="do not use or store cached results, the default")
 	parser.add_argument("-q", "--dev", action="store_true", help="dev mode")
 	parser.add_argument("--galaxy", action="store_true",
 						help="argument used if Galaxy is running CanSNPer, " +
@@ -135,6 +180,24 @@ def parse_arguments():
 							 			process, if you are limited to one core
 										turn the feature off here""")
 	parser.add_argument("--skip_mauve", action="store_true", help="Can be used if mauve alignments already exists")
+	parser.add_argument("--mauve_timeout", type=int, default=0,
+							help="seconds before a progressiveMauve job is stopped, the default [0] is no limit")
+	parser.add_argument("--mauve_retries", type=int, default=0,
+							help="number of times a crashed or stopped progressiveMauve job is restarted [0]")
+	parser.add_argument("--kmer_typing", action="store_true",
+							help="""call SNPs from k-mers of their flanks first, queries
+							 		are only aligned if SNPs their classification depends
+									on can not be called this way""")
+	parser.add_argument("--kmer_size", type=int, default=31,
+							help="k-mer length used by --kmer_typing, odd and at most 31 [31]")
+	parser.add_argument("--local_window", type=int, default=200,
+							help="""bases on each side of a SNP aligned to the query when
+							 		--kmer_typing can not call it, 0 aligns whole genomes
+									with progressiveMauve instead [200]""")
+	parser.add_argument("--xmfa_index", action="store_true",
+							help="""keep a .idx sidecar index next to each alignment
+							 		so that re-typing with --skip_mauve only reads
+									alignment blocks holding canSNP positions""")
 
 	# Exit and print help if there were no arguments
 	if len(argv) == 1:
@@ -199,7 +262,20 @@ def read_config(args):
 	config["strain_name"] = None
 	config["delete_organism"] = None
 	config["initialise_organism"] = None
+	config["migrate_database"] = args.migrate_database
+	config["immutable_database"] = args.immutable_database
+	config["pack_sequences"] = args.pack_sequences
+	config["sketch_references"] = args.sketch_references
 	config["skip_mauve"] = args.skip_mauve
+	config["allow_differences"] = args.allow_differences
+	config["query_batch"] = args.query_batch
+	config["batch_output"] = args.batch_output
+	config["xmfa_index"] = args.xmfa_index
+	config["kmer_typing"] = args.kmer_typing
+	config["kmer_size"] = args.kmer_size
+	config["local_window"] = args.local_window
+	config["mauve_timeout"] = args.mauve_timeout
+	config["mauve_retries"] = args.mauve_retries
 
 	if args.dev:
 		config["dev"] = True
@@ -240,6 +316,17 @@ def read_config(args):
 		config["galaxy"] = True
 	if args.tmp_path:
 		config["tmp_path"] = args.tmp_path
+	if args.reference_cache:
+		config["reference_cache"] = args.reference_cache
+	else:
+		config["reference_cache"] = path.join(config["tmp_path"], "reference_cache")
+	if args.no_result_cache or not args.result_cache:
+		config["result_cache"] = None
+	elif args.result_cache is True:
+		config["result_cache"] = path.join(config["tmp_path"], "result_cache")
+	else:
+		config["result_cache"] = args.result_cache
+	config["result_cache_size"] = args.result_cache_size
 	if config["dev"]:  # Developer printout
 		print("#[DEV] configurations:%s" % config)
 	if config["verbose"]:
@@ -263,6 +350,47 @@ def get_organism(config, c):
 		return select_table(c)
 
 
+def detect_organisms(file_names, config, c):
+	'''Returns the organism of each query {file_name: organism}.
+
+	Keyword arguments:
+	file_names -- the fasta files that are to be typed
+
+	The organism given with --reference is used for all queries. Otherwise
+	each query is matched to the closest reference sequence of the database by
+	MinHash sketches (see MinHashSketch). Only sketches stored in the database
+	are used, they are made when sequences are imported or packed and with
+	--sketch_references. Without any stored sketches the organism is chosen
+	as before (see select_table).
+
+	'''
+	if config["reference"]:
+		return dict([(file_name, config["reference"]) for file_name in file_names])
+	organisms = DatabaseSchema(c).organisms()
+	if len(organisms) == 1:
+		return dict([(file_name, organisms[0]) for file_name in file_names])
+	sketcher = MinHashSketch(c, verbose=config["verbose"])
+	references, missing = sketcher.stored_references(SequenceStore(c), organisms)
+	if not references:
+		print("#There are no stored sketches to find the organism with, store them with --sketch_references")
+		organism = select_table(c)
+		return dict([(file_name, organism) for file_name in file_names])
+	if missing:
+		stderr.write("#[WARNING in %s] %d reference sequence(s) have no up to date sketch and are not used to find the organism, store them with --sketch_references: %s\n" %
+					 (config["query"], len(missing), ", ".join(["%s %s" % reference for reference in missing])))
+	detected = dict()
+	for file_name in file_names:
+		if not path.isfile(file_name):
+			exit("#[ERROR in %s] No such file: %s" % (config["query"], file_name))
+		hit = sketcher.detect(file_name, references)
+		if not hit:
+			exit("#[ERROR in %s] %s is not close to any reference sequence in the database, choose an organism with --reference" % (config["query"], file_name))
+		detected[file_name] = hit[0]
+		if config["verbose"]:
+			print("#%s: detected %s, closest reference %s (distance %.4f)" % (file_name, hit[0], hit[1], hit[2]))
+	return detected
+
+
 def get_strain(organism, config, c):
 	'''Returns the strain chosen.
 
@@ -286,7 +414,7 @@ def select_table(c):
 	tables = c.fetchall()
 
 	# You are not supposed to be able to pick one of these
-	tables_NOT_to_list = ["Sequences", "Tree"]
+	tables_NOT_to_list = DatabaseSchema.system_tables
 
 	table_list = list()
 	db_name = ""
@@ -357,7 +485,8 @@ def initialise_table(config, c):
 	'''Initialises a table in the SQLite3 database.
 
 	Prompts the user for an organism name that is
-	used as the table name.
+	used as the table name. The database is migrated
+	to the latest schema version first.
 
 	'''
 	if config["reference"]:
@@ -369,19 +498,66 @@ def initialise_table(config, c):
 			exit("Exiting...")
 	try:
 		# Try to execute, otherwise spit out the error
-		c.execute("CREATE TABLE IF NOT EXISTS Tree (Name text, Children text, Organism text)")
-		c.execute("CREATE TABLE IF NOT EXISTS Sequences (Organism text, Strain text, Sequence text)")
-		c.execute("CREATE TABLE IF NOT EXISTS %s (SNP VARCHAR(5), Reference VARCHAR(255), Strain VARCHAR(100), Position integer, Derived_base NCHAR(1), Ancestral_base NCHAR(1))" % organism_name)
+		DatabaseSchema(c, config["verbose"]).create(organism_name)
 	except sqlite3.OperationalError as e:
 		exit("#[ERROR in %s] SQLite OperationalError: %s" % (config["query"], str(e)))
+	except DuplicateRowsError as e:
+		exit("#[ERROR in %s] Could not migrate database: %s" % (config["query"], str(e)))
+
+
+def migrate_schema(config, c):
+	'''Migrates the database before it is changed, duplicate rows are not removed (see migrate_database).'''
+	schema = DatabaseSchema(c, config["verbose"])
+	try:
+		schema.migrate()
+	except DuplicateRowsError as e:
+		exit("#[ERROR in %s] Could not migrate database: %s" % (config["query"], str(e)))
+	return schema
+
+
+def migrate_database(config, c):
+	'''Migrates the database to the latest schema version (see DatabaseSchema), rows that repeat a new unique key are removed.'''
+	schema = DatabaseSchema(c, verbose=True, deduplicate=True)
+	try:
+		applied = schema.migrate()
+	except sqlite3.Error as e:
+		exit("#[ERROR in %s] Could not migrate database: %s" % (config["query"], str(e)))
+	if not applied:
+		print("#Database schema is at the latest version (%d)" % schema.latest)
+
+
+def pack_sequences(config, c):
+	'''Packs the reference sequences stored as text (see SequenceStore) and shrinks the database file.'''
+	schema = migrate_schema(config, c)
+	store = SequenceStore(c, verbose=config["verbose"])
+	packed = store.pack_all(config["reference"])
+	# Packing keeps the checksums, only references that were never sketched are sketched
+	organisms = [config["reference"]] if config["reference"] else schema.organisms()
+	MinHashSketch(c, verbose=config["verbose"]).references(store, organisms, save=True)
+	c.connection.commit()
+	if packed:
+		c.execute("VACUUM")  # Give the space of the text sequences back
+	print("#Packed %d sequence(s)" % packed)
+
+
+def sketch_references(config, c):
+	'''Stores MinHash sketches of the reference sequences of one or all organisms (see MinHashSketch).'''
+	schema = migrate_schema(config, c)
+	organisms = [config["reference"]] if config["reference"] else schema.organisms()
+	sketches = MinHashSketch(c, verbose=config["verbose"]).references(SequenceStore(c), organisms, save=True)
+	c.connection.commit()
+	print("#Sketched %d reference sequence(s)" % len(sketches))
 
 
 def purge_organism(config, c):
 	'''Removes everything in the SQLite3 database connected to a organism.'''
 	db_name = get_organism(config, c)
 	if input("Delete everything concerning %s? (Y/N) " % db_name).lower()[0] == "y":
+		migrate_schema(config, c)
 		c.execute("DROP TABLE %s" % db_name)
 		c.execute("DELETE FROM Sequences WHERE Organism = ?", (db_name, ))
+		c.execute("DELETE FROM SequenceChunks WHERE Organism = ?", (db_name, ))
+		c.execute("DELETE FROM Sketches WHERE Organism = ?", (db_name, ))
 		c.execute("DELETE FROM Tree WHERE Organism = ?", (db_name, ))
 	else:
 		exit("#Nothing happened, promise.")
@@ -419,8 +595,12 @@ def import_sequence(file_name, config, c):
 	for row in c.fetchall():
 		if strain_name == row[1] and organism_name == row[0]:  # If an entry was found, set our flag to false
 			flag = False
+	# Cached fasta files of the strain are outdated
+	ReferenceCache(config["reference_cache"]).clear(organism_name, strain_name)
+	migrate_schema(config, c)  # Packed sequences are stored in SequenceChunks
+	store = SequenceStore(c, verbose=config["verbose"])
 	if flag:  # No entry for this strain name
-		c.execute("INSERT INTO Sequences VALUES(?,?,?)", (organism_name, strain_name, seq))
+		store.put(organism_name, strain_name, seq, packed=config["pack_sequences"])
 	else:  # There was an entry for this strain name, ask for update
 		print("This strain name already has a sequence listed in the database. Update entry? (Y/N)")
 		while True:
@@ -428,58 +608,93 @@ def import_sequence(file_name, config, c):
 			if answer[0].lower() == "n":  # Dont do anything if user doesnt want update
 				break
 			elif answer[0].lower() == "y":  # Update Sequences
-				c.execute("UPDATE Sequences SET Sequence = ? WHERE Organism = ? AND Strain = ?",
-						  (seq, organism_name, strain_name))
+				store.put(organism_name, strain_name, seq, packed=config["pack_sequences"])
 				break
 			elif answer.lower().strip() == "exit":
 				exit("Exiting...")
+	# Keep the sketch used to find the organism of queries up to date
+	MinHashSketch(c, verbose=config["verbose"]).references(store, [organism_name], save=True)
+
+
+def read_snp_file(snp_file):
+	'''Yields (values, row) for each line of a SNP file, row is None if the line can not be imported.
+
+	Keyword arguments:
+	snp_file -- an open SNP file, it is read one line at a time
+
+	'''
+	for line in snp_file:
+		line = line.strip()
+		if line == "" or line[0] == "#":
+			continue
+		values = line.split("\t")
+		if len(values) != 7:  # One of the pieces of information is missing
+			yield values, None
+			continue
+		try:
+			yield values, (values[0], values[2], values[3], int(values[4]), values[5], values[6])
+		except ValueError:  # The position is not a number
+			yield values, None
 
 
-def import_to_db(file_name, config, c):
+def import_to_db(file_name, config, c, chunk_size=10000):
 	'''Imports a textfile of SNP information into the SQLite3 database.
 	Lines beginning with # are considered comment lines.
 
 	Keyword arguments:
 	file_name -- the file name of the file containing the SNP info
+	chunk_size -- number of SNPs sent to the database at a time
 
 	Format of the file:
 	#SNP-name\tOrganism-name\tReference\tStrain\tPosition\tDerived-base\tAncestral-base
 	B.1\tFrancisella\tSvensson\tLVS\t23942\tA\tG
 
 	Organism-name isnt used at the moment, the table name is the organism name.
+	SNPs already in the database are updated. The file is read as a stream and
+	imported in one transaction, nothing is imported if it fails.
 
 	'''
 	db_name = get_organism(config, c)
+	migrate_schema(config, c)  # The SNP key is needed to update SNPs in place
 
-	snp_file = zopen(file_name, "r")
-
-	queries = []
-	for line in snp_file.readlines():
-		if line != "" and line[0] != "#":
-			line = line.strip()
-			values = line.split("\t")
-			snpname = values[0]
-			c.execute("SELECT SNP from %s WHERE SNP=?" % db_name, (snpname,))
-			if c.fetchone():
-				if len(values) == 7:
-					c.execute("UPDATE %s SET Reference = ?, Strain = ?, Position = ?, Derived_base = ?, Ancestral_base = ? WHERE SNP = ?" % db_name,
-							  (values[2], values[3], int(values[4]),
-							   values[5], values[6], snpname))
-			else:
-				if len(values) == 7:
-					queries.append((snpname, values[2], values[3],
-								   int(values[4]), values[5], values[6]))
-				else:  # Skip line if one of the pieces of information is missing
+	upsert = ("INSERT INTO {table} (SNP, Reference, Strain, Position, Derived_base, Ancestral_base) VALUES(?,?,?,?,?,?) " +
+			  "ON CONFLICT (SNP) DO UPDATE SET Reference = excluded.Reference, Strain = excluded.Strain, " +
+			  "Position = excluded.Position, Derived_base = excluded.Derived_base, " +
+			  "Ancestral_base = excluded.Ancestral_base").format(table=db_name)
+	try:
+		c.execute("SELECT COUNT(*) FROM %s" % db_name)
+		before = c.fetchone()[0]
+		imported = 0
+		skipped = 0
+		chunk = []
+		with zopen(file_name, "rt") as snp_file:
+			for values, row in read_snp_file(snp_file):
+				if row is None:
 					print("#Skipping:", values)
-	c.executemany("INSERT INTO %s VALUES(?,?,?,?,?,?)" % db_name, queries)
-	snp_file.close()
+					skipped += 1
+					continue
+				chunk.append(row)
+				if len(chunk) >= chunk_size:
+					c.executemany(upsert, chunk)
+					imported += len(chunk)
+					chunk = []
+		c.executemany(upsert, chunk)
+		imported += len(chunk)
+		c.execute("SELECT COUNT(*) FROM %s" % db_name)
+		inserted = c.fetchone()[0] - before
+		c.connection.commit()
+	except sqlite3.Error as e:
+		c.connection.rollback()
+		exit("#[ERROR in %s] Could not import SNPs to %s: %s" % (config["query"], db_name, str(e)))
+	print("#Imported SNPs to %s: %d inserted, %d updated, %d skipped" % (db_name, inserted, imported - inserted, skipped))
+	return inserted, imported - inserted, skipped
 
 
 def import_tree(file_name, config, c):
 	'''Imports a tree structure into the SQLite3 database
 
 	Keyword arguments:
-	file_name -- the file name of the txt file with the tree structure
+	file_name -- the file name of the txt or newick file with the tree structure
 
 	Format of the txt file:
 	ROOT
@@ -490,97 +705,69 @@ def import_tree(file_name, config, c):
 	ROOT;N2;N5
 	ROOT;N2;N5;N6
 
-	The above structure represents this newick tree,
-	however newick format can not be imported at this time:
+	The above structure represents this newick tree, which
+	can be imported as well (all nodes have to be named):
 	(N1,(N3,N4,(N6)N5)N2)ROOT;
 
+	The tree is read into memory and replaces the tree of
+	the organism in one transaction.
+
 	'''
 	organism_name = get_organism(config, c)
-	tree_file = zopen(file_name, "r")
-	text_tree = tree_file.readlines()
-	# Truncate the table
-	c.execute("DELETE FROM Tree WHERE Organism = ?", (organism_name, ))
-	tree_file.close()
-	for line in text_tree:
-		if line[0] != "#":
-			nodes = line.strip().split(";")
-			for i in range(0, len(nodes)):
-				if nodes[i] != "":
-					c.execute("SELECT Name FROM Tree WHERE Name = ? AND Organism = ?", (nodes[i], organism_name))
-					if c.fetchone():
-						if len(nodes) > i + 1:  # Looking for children
-							c.execute("SELECT Children FROM Tree WHERE Name = ? and Organism = ?", (nodes[i], organism_name))
-							children = c.fetchone()[0]
-							if children:
-								child_list = children.split(";")
-								if nodes[i + 1] in child_list:
-									pass  # Already listed as a child, skip
-								else:  # Append child
-									new_children = ";".join(child_list) + ";" + nodes[i + 1]
-									c.execute("UPDATE Tree SET Children = ? WHERE Name = ? AND Organism = ?",
-											  (new_children, nodes[i], organism_name))
-							else:
-								c.execute("UPDATE Tree SET Children = ? WHERE Name = ? AND Organism = ?",
-										  (nodes[i + 1], nodes[i], organism_name))
-					else:  # Add a node
-						if len(nodes) > i + 1 and nodes[i + 1] != "":  # First check if its got children
-							c.execute("INSERT INTO Tree VALUES(?,?,?)", (nodes[i], nodes[i + 1], organism_name))
-						else:
-							c.execute("INSERT INTO Tree VALUES(?,?,?)", (nodes[i], None, organism_name))
-
-
-def tree_to_newick(organism, config, c):
+	with zopen(file_name, "rt") as tree_file:
+		text_tree = tree_file.read()
+	tree = CanSNPTree(organism_name)
+	if text_tree.lstrip().startswith("("):  # Newick format
+		try:
+			tree.load_newick(text_tree)
+		except ValueError as e:
+			exit("#[ERROR in %s] Could not read newick tree %s: %s" % (config["query"], file_name, str(e)))
+	else:
+		tree.load_lines(text_tree.splitlines())
+	try:
+		# Truncate the table and insert the new tree
+		c.execute("DELETE FROM Tree WHERE Organism = ?", (organism_name, ))
+		c.executemany("INSERT INTO Tree VALUES(?,?,?)", tree.rows())
+		c.connection.commit()
+	except sqlite3.Error as e:
+		c.connection.rollback()
+		exit("#[ERROR in %s] Could not import tree to %s: %s" % (config["query"], organism_name, str(e)))
+	if config["verbose"]:
+		print("#Imported %d nodes to the %s tree" % (len(tree.nodes), organism_name))
+
+
+def tree_to_newick(organism, config, c, tree=False):
 	'''Returns a tree in the SQLite3 database in newick format
 
 	Keyword arguments:
 	organism -- the organism tree wanted
+	tree -- CanSNPTree of the organism, it is read from the database if not given
 
-	Tries to convert the tree in the SQLite3 database into newick
-	format. Does so by inserting the root and its children, after
-	which each child is replaced by an entry containing itself and
-	its children. Tries to go through all nodes 10000 times. This
-	is because of the possibility of a node being listed before
-	its parent. If after 10000 loops there are still nodes left,
-	a warning is printed, but the resulting tree is still returned
+	The tree is written from the root in one pass (see CanSNPTree.to_newick).
+	Nodes that can not be reached from the root are left out with a
+	warning, but the resulting tree is still returned
 
 	'''
-	c.execute("SELECT * FROM Tree WHERE Organism = ?", (organism, ))
-	nodes = c.fetchall()
+	if not tree:
+		tree = CanSNPTree(organism).load_tree(c)
 	if config['dev']:
 		print("#[DEV] Nodes in Tree that have %s as Organism" % organism)
-		for node in nodes:
-			print("#[DEV]", node)
-	result = ''
-	count = 0  # Counter to stop if it doesnt work properly
-	while nodes and count < 10000:  # Run the loop a maximum of 10000 times
-		for node in nodes:  # Go through all nodes
-			search_regex = re.compile("[(|,]" + node[0] + "[,|)]")
-			search_hit = search_regex.search(result)
-			#print(search_hit)
-			if search_hit:  # If the node is part of result, replace that entry with the same node and its children
-				if node[1]:
-					result = result[:search_hit.start() + 1] + \
-						"(%s)%s" % (node[1].replace(";", ","), node[0]) + \
-						result[search_hit.end() - 1:]
-					nodes.remove(node)
-				else:
-					nodes.remove(node)  # Just remove the node from the list if it doesnt have children
-			elif result == '':  # If result is empty, just add the node. This is the root!
-				if node[1]:
-					result += "(%s)%s;" % (node[1].replace(";", ","), node[0])
-					nodes.remove(node)
-				else:
-					result += "%s;" % node[0]
-					nodes.remove(node)
-		count += 1
-	if count > 9999:  # Could not insert all nodes into the tree
+		for node in tree.nodes:
+			print("#[DEV]", (node, ";".join(tree.get_children(node)) or None, organism))
+	root = tree.find_root()
+	if root is None:
+		result = ''
+		missing = tree.nodes
+	else:
+		result = tree.to_newick(root)
+		missing = set(tree.nodes) - set(tree.postorder(root))
+	if missing:  # Could not insert all nodes into the tree
 		stderr.write("#[WARNING in %s] Broken tree, cannot convert entire tree to newick format. " % config["query"] +
 					 "Most likely reason is a non-root node not listed as a child anywhere in the tree\n")
 		if config["dev"]:
-			print("#[DEV] These nodes were left out of the tree: %s" % str(nodes))
+			print("#[DEV] These nodes were left out of the tree: %s" % str(sorted(missing)))
 	if config["dev"]:
 		print("#[DEV] Tree in newick format:%s" % result)
-	#print("newick tree result", result)
 	return result
 
 
@@ -591,16 +778,17 @@ def CanSNPer_tree_layout(node):
 	faces.add_face_to_node(name_face, node, column=0, position="branch-top")
 
 
-def draw_ete3_tree(organism, snplist, tree_file_name, config, c):
+def draw_ete3_tree(organism, snplist, tree_file_name, config, c, tree=False):
 	'''Draws a phylogenetic tree using ETE3
 
 	Keyword arguments:
 	organism -- the organism of which to make a tree
 	snplist -- a list of the SNP names, positions and state
 	file_name -- the name of the out-file _tree.pdf will be added
+	tree -- CanSNPTree of the organism, it is read from the database if not given
 
 	'''
-	newick = tree_to_newick(organism, config, c)
+	newick = tree_to_newick(organism, config, c, tree)
 	tree = Tree(newick, format=1)
 	tree_depth = int(tree.get_distance(tree.get_farthest_leaf()[0]))
 	for n in tree.traverse():
@@ -636,18 +824,19 @@ def draw_ete3_tree(organism, snplist, tree_file_name, config, c):
 	ts = TreeStyle()
 	ts.show_leaf_name = False  # Do not print(leaf names, they are added in layout)
 	ts.show_scale = False  # Do not show the scale
-	ts.layout_fn = self.CanSNPer_tree_layout  # Use the custom layout
+	ts.layout_fn = CanSNPer_tree_layout  # Use the custom layout
 	ts.optimal_scale_level = 'full'  # Fully expand the branches of the tree
 	if config["dev"]:
 		print("#[DEV] Tree file: %s" % tree_file_name)
 	tree.render(tree_file_name, tree_style=ts, width=tree_depth * 500)
 
 
-def find_tree_root(db_name, c, config):
+def find_tree_root(db_name, c, config, tree=False):
 	'''Returns the root of a tree.
 
 	Keyword arguments:
 	db_name -- the name of the organism from which we are grabbing the tree
+	tree -- CanSNPTree of the organism, it is read from the database if not given
 
 	Definition of root:
 	Is not listed as a child anywhere in the entire tree.
@@ -656,150 +845,15 @@ def find_tree_root(db_name, c, config):
 	the first one listed in the SQLite3 database is returned.
 
 	'''
-	root = None
-	c.execute("SELECT * FROM Tree WHERE Organism = ?", (db_name,))
-	nodes = c.fetchall()
-	for node in nodes:
-		flag = True
-		for node_two in nodes:
-			if node_two[1]:
-				if node[0] in node_two[1].split(";"):
-					flag = False
-					break  # Break out if the node is listed as a child somewhere
-		if flag:  # If the node was never listed as a child
-			root = node[0]  # Set it as root
-			break
+	if not tree:
+		tree = CanSNPTree(db_name).load_tree(c)
+	root = tree.find_root()
 	if config["dev"]:  # Developer printout
 		print("#[DEV] root %s tree: %s" % (db_name, root))
 	if not root:
 		exit("#[ERROR in %s] Could not find root of %s tree" % (config["query"], db_name))
 	return root
 
-def multi_tree_walker(node, sequences, organism, threshold, wrong_list, config, c, force_flag=False, quiet=False):
-	'''Tree walking classifier for CanSNPer.
-
-	Keyword arguments:
-	node -- The current node in the tree.
-	sequences -- The aligned sequences of the query. A list, one for each reference strain
-	organism -- The name of the organism
-	threshold -- Number of ancestral SNPs to allow in the classification
-	wrong_list -- A list of the positions that have been wrong, ie ancestral SNP
-		config -- Dictionary containing running arguments for CanSNPer
-	force_flag -- Boolean, flag for whether or not to force through current node
-				 even if the sequence does not have the derived SNP
-	quiet -- Boolean, if the function is run in a quiet mode, i.e. as a test
-			 this mode is run by the algorithm itself when "looking" deeper into the tree
-
-	Walks through a tree, descending to the children of the node only if a quiet
-	test of the next node has been completed.
-
-	'''
-	qstring = ""
-	fstring = ""
-	if quiet:
-		qstring = "quiet"
-	else:
-		qstring = "not quiet"
-	if force_flag:
-		fstring = "Forcing"
-	else:
-		fstring = "Walking"
-	if config["dev"]:
-		print("#[DEV]", fstring, "into", node, qstring)
-	c.execute("SELECT Strain, Position, Derived_base FROM %s WHERE SNP = ?" % organism, (node,))
-	snp_info = c.fetchone()
-	if snp_info:
-		try:  # Catch a KeyError that arises when a sequence is missing from the DB
-			if sequences[snp_info[0]][snp_info[1] - 1] == snp_info[2] or force_flag:
-				# If its wrong and we are forcing
-				if sequences[snp_info[0]][snp_info[1] - 1] != snp_info[2]:
-					if node not in wrong_list:
-						wrong_list.append(node)
-				if quiet and not force_flag:
-					# Return True if we are quietly testing a single node
-					# and we are not forcing it
-					return True, True
-				c.execute("SELECT Children FROM Tree WHERE Name = ? AND Organism = ?", (node, organism))
-				children = c.fetchone()[0]
-
-				if not children:  # No children, Leaf node.
-					#  Hit a leaf that is not derived
-					if sequences[snp_info[0]][snp_info[1] - 1] != snp_info[2]:
-						if config["dev"] and not quiet:
-							print("#[DEV] %s was not derived" % node)
-						wrong_list.remove(node)
-						return None, wrong_list
-					else:  # Hit a leaf that is derived
-						if config["dev"] and not quiet:
-							print("#[DEV] %s was a derived leaf. We are done here." % node)
-						return node, wrong_list
-
-				# Has children, loop through them
-				for child in children.split(";"):
-					if config["dev"] and not quiet:  # Developer printout
-						print("#[DEV] testing child: %s" % child)
-					# Test the SNP of child
-					if multi_tree_walker(child, sequences, organism, threshold, wrong_list, config, c, False, True)[0]:
-						# Move further down the Tree if it worked
-						if config["dev"] and not quiet:
-							print("#[DEV] testing child success, going into: %s" % child)
-						return multi_tree_walker(child, sequences, organism, threshold, wrong_list, config, c, False, quiet)
-				if config["dev"] and not quiet:
-					print("#[DEV] Number of forced SNPs: %s, Threshold: %s, %s" % (len(wrong_list), threshold, str(wrong_list)))
-				if len(wrong_list) >= threshold:
-					# Return node if we passed the threshold
-					if not quiet and sequences[snp_info[0]][snp_info[1] - 1] == snp_info[2]:
-						return node, wrong_list
-					else:
-						wrong_list.remove(node)
-						return None, wrong_list
-
-				if config["dev"] and not quiet:  # Developer printout
-					print("#[DEV] Now going to try to force %s" % children)
-				for child in children.split(";"):  # loop again if there were no results without force
-					if config["dev"] and not quiet:
-							print("#[DEV] force-testing child: %s" % child)
-					# Test forcing the SNP of child
-					if multi_tree_walker(child, sequences, organism, threshold, wrong_list, config, c, True, True)[0]:
-						# Move further down the Tree if it worked
-						return multi_tree_walker(child, sequences, organism, threshold, wrong_list, config, c, True, quiet)
-
-				if sequences[snp_info[0]][snp_info[1] - 1] == snp_info[2]:
-					return node, wrong_list  # Return node if we didnt find anything by forcing
-				else:
-					wrong_list.remove(node)  # Return None if we failed while "looking" quietly
-					return None, wrong_list
-		except KeyError as e:
-			message = "#[ERROR in %s] SNP position of %s listed in strain that is not in the database: %s" % (config["query"], node, str(e.message))
-			exit(message)
-	else:
-		stderr.write("#[WARNING in %s] SNP not in database: %s\n" % (config["query"], node))
-	if config["dev"]:  # Developer printout
-		print("#[DEV] %s was not derived" % node)
-	# if not quiet and force_flag:
-	if node in wrong_list:
-		wrong_list.remove(node)
-	return None, wrong_list
-
-
-def x2fa_error_check(num, config):
-	'''Function that checks for errors in x2fa.py runs.
-
-	Keyword arguments:
-	num -- the uuid for this specific x2fa run
-
-	'''
-	# This file contains the stderr output from progressiveMauve
-	x2fa_errors_file = zopen("%s/CanSNPer_xerr%s.txt" % (config["tmp_path"], num), "r")
-	x2fa_errors = x2fa_errors_file.read()
-	x2fa_errors_file.close()
-
-	if x2fa_errors:  # Quit if there was something wrong
-		exit("#[ERROR in %s] x2fa.py failed to complete:\n%s" % (config["query"], x2fa_errors))
-
-	# Remove the file if there were no errors, annoying to have an empty file lying around
-	silent_remove("%s/CanSNPer_xerr%s.txt" % (config["tmp_path"], num))
-
 
 def mauve_error_check(num, config):
 	'''Function that checks for errors in progressiveMauve runs.
@@ -818,147 +872,454 @@ def mauve_error_check(num, config):
 	# Remove the file if there were no errors, annoying to have an empty file lying around
 	silent_remove("%s/CanSNPer_err%s.txt" % (config["tmp_path"], num))
 
-def parse_xmfa(XMFA_obj, database, xmfa_file, organism,reference,results=[]):
+def parse_xmfa(XMFA_obj, database, xmfa_file, organism,reference,index=False,snplist=False):
 	'''Process xmfa file using ParseXMFA object'''
-	snps = XMFA_obj.run(database, xmfa_file, organism,reference)
-	results.put(snps)
-	return results
+	return XMFA_obj.run(database, xmfa_file, organism,reference,index=index,snplist=snplist)
 
-def get_refs(xmfa_obj,database):
-	'''Get which references exists in the database'''
-	return xmfa_obj.get_references(database)
-
-def xmfa_multiproc(xmfa_obj, seq_uids, tmp_path,out_name,database,organism):
-	'''function to run addition of genomes in paralell'''
-	jobs = []
-	refs = get_refs(xmfa_obj,database) #["FSC200","SCHUS4.1","SCHUS4.2","OSU18"]
-	snps = {}
-	result_queue = Queue()
-	for i in range(len(seq_uids)):
-		seq_ui = seq_uids[i+1]
-		xmfa = "{tmp_path}/{out_name}.CanSNPer.{seq_ui}.xmfa".format(tmp_path=tmp_path.rstrip("/"), out_name=out_name,seq_ui=seq_ui)
-		ref = refs[i]
-		print(organism, ref)
-		p = Process(target=parse_xmfa, args=(xmfa_obj,database,xmfa,organism,ref ,result_queue))
-		p.start()
-		jobs.append(p)
-	for job in jobs:
-		job.join()
-	for i in range(len(jobs)):
-		snps = dict(**snps, **result_queue.get())
-	return snps
-
-def align(file_name, config, c):
-	'''This function is the "main" of the classifier part of the program.
+def get_snp_catalog(database,organism):
+	'''Load the SNPs of all reference strains of an organism once per run'''
+	snp_db = CanSNPerClassification(database)
+	catalog = snp_db.snp_catalog(organism)
+	snp_db.database.disconnect()
+	return catalog
+
+def get_pool_size(num_threads):
+	'''Number of worker processes to use, the default [0] is one per available core'''
+	if num_threads > 0:
+		return num_threads
+	return cpu_count()
+
+def xmfa_parse_job(xmfa_obj, seq_ui, tmp_path,out_name,database,organism,reference,index,catalog):
+	'''Return the arguments of parse_xmfa for the alignment of a query against one reference'''
+	xmfa = "{tmp_path}/{out_name}.CanSNPer.{seq_ui}.xmfa".format(tmp_path=tmp_path.rstrip("/"), out_name=out_name,seq_ui=seq_ui)
+	return (xmfa_obj,database,xmfa,organism,reference,index,catalog.get(reference, {}))
+
+def database_fingerprint(db_name, c):
+	'''Returns a hash of the SNPs, tree and reference sequences of an organism.
 
 	Keyword arguments:
-	file_name -- the name of the fasta file that is to be typed
+	db_name -- the organism
 
-	Sets everything in motion and retrieves and distributes all the results.
+	Any change of the organism in the database changes the fingerprint,
+	it is part of the key of cached results.
 
 	'''
-	# Set warning flags
-	WARNINGS = dict()
+	sha = hashlib.sha1()
+	c.execute("SELECT SNP, Reference, Strain, Position, Derived_base, Ancestral_base FROM %s ORDER BY SNP, Strain, Position" % db_name)
+	for row in c.fetchall():
+		sha.update(("%s\n" % "\t".join(map(str, row))).encode())
+	c.execute("SELECT Name, Children FROM Tree WHERE Organism = ? ORDER BY Name", (db_name,))
+	for row in c.fetchall():
+		sha.update(("%s\n" % "\t".join(map(str, row))).encode())
+	checksums = SequenceStore(c).checksums(db_name)  # stored with the sequences, they are not hashed here
+	for strain in sorted(checksums):
+		sha.update(("%s\t%s\n" % (strain, checksums[strain])).encode())
+	return sha.hexdigest()
 
-	# Get database and output name
-	db_name = get_organism(config, c)
-	out_name = file_name.split("/")[-1]
-	output = "%s/%s.CanSNPer" % (config["tmp_path"], out_name)
-	# Get the sequences from our SQLite3 database, and write them
-	# to tmp files that progressiveMauve can read
-	c.execute("SELECT Organism, Strain, Sequence FROM Sequences WHERE Organism = ?", (db_name,))
+
+def write_reference_sequences(db_name, config, c):
+	'''Write the reference sequences of an organism to files that progressiveMauve can read.
+
+	Keyword arguments:
+	db_name -- the organism
+
+	The files are kept in the reference cache and only written if the sequence
+	in the database has changed since they were written.
+	Returns the uid used in tmp file names, the strain name and the fasta file of
+	each reference, keyed by reference number.
+
+	'''
+	store = SequenceStore(c, verbose=config["verbose"])
 	seq_counter = 0  # Counter for the number of sequences
 	seq_uids = dict()
 
 	reference_sequences = dict()
+	reference_files = dict()
+	cache = ReferenceCache(config["reference_cache"], verbose=config["dev"])
 
 	if config["verbose"]:
 		print("#Fetching reference sequence(s) ...")
-	for row in c.fetchall():
+	checksums = store.checksums(db_name)  # stored with the sequences, they are not hashed here
+	for strain in store.strains(db_name):
 		seq_counter += 1
 		# 32 char long unique hex string used for unique tmp file names
 		seq_uids[seq_counter] = str(seq_counter)#uuid4().hex
-		reference_sequences[seq_counter] = row[1]  # save the name of the references
-		if not path.exists(config["tmp_path"]):
-			makedirs(config["tmp_path"])
-		tmp_file = zopen("%s/CanSNPer_reference_sequence." % config["tmp_path"] +
-						seq_uids[seq_counter] +
-						".fa", "w")  # Open a tmp file
-		tmp_file.write(">%s.%s\n%s\n" % (row[0], row[1], row[2]))  # Write to tmp file
-		tmp_file.close()
-
-	# Check if the file exists
-	if not path.isfile(file_name):
-		exit("#[ERROR in %s] No such file: %s" % (config["query"], file_name))
+		reference_sequences[seq_counter] = strain  # save the name of the references
+		# The sequence is only read from the database if it is not in the cache
+		reference_files[seq_counter] = cache.get(db_name, strain, lambda strain=strain: store.chunks(db_name, strain),
+												 key=checksums[strain])
+	if not path.exists(config["tmp_path"]):
+		makedirs(config["tmp_path"])
+	return seq_uids, reference_sequences, reference_files
+
+
+def kmer_type(file_names, results, db_name, config, c, catalog, tree, root):
+	'''Types queries with k-mers of the SNP flanks (see KmerTyper) and returns the queries that still have to be aligned.
+
+	Keyword arguments:
+	file_names -- the fasta files that are to be typed
+	results -- the SNPs of the queries typed with k-mers are stored here
+	catalog -- the preloaded SNP catalog of the organism (see get_snp_catalog)
+	tree -- CanSNPTree of the organism
+	root -- the root of the tree
+
+	SNPs the classification depends on (see CanSNPTree.examined) that can not be
+	called from k-mers are called by aligning the reference around them to the query
+	(see LocalAligner). A query is only aligned with progressiveMauve if some of them
+	are still unresolved.
+
+	'''
+	store = SequenceStore(c)
+	strains = set(store.strains(db_name))
+	try:
+		typer = KmerTyper(config["kmer_size"], verbose=config["verbose"])
+	except ValueError as e:
+		exit("#[ERROR in %s] %s" % (config["query"], str(e)))
+	typer.build(catalog, lambda strain: store.get(db_name, strain) if strain in strains else None)
+	aligner = LocalAligner(window=config["local_window"], verbose=config["verbose"])
+	windows = dict()  ## Reference windows of the SNPs that were aligned, shared by the queries
+	region = lambda strain, start, end: store.region(db_name, strain, start, end) if strain in strains else ""
+	to_align = list()
+	for file_name in file_names:
+		calls, unresolved = typer.call(file_name)
+		examined = tree.examined(calls, config["allow_differences"], root)
+		tried = set()
+		## Calls of aligned SNPs can lead the classification to other SNPs, repeat until none are left to align
+		while config["local_window"] > 0 and (unresolved & examined) - tried:
+			names = (unresolved & examined) - tried
+			windows.update(aligner.windows(catalog, set(names) - set(windows), region))
+			aligned, missing = aligner.call(file_name, dict([(name, windows[name]) for name in names if name in windows]))
+			calls.update(aligned)
+			unresolved -= set(aligned) - missing
+			tried |= names
+			examined = tree.examined(calls, config["allow_differences"], root)
+		unresolved &= examined
+		if unresolved:
+			if config["verbose"]:
+				print("#%s: %d SNP(s) could not be called without alignment, aligning ..." % (file_name, len(unresolved)))
+			to_align.append(file_name)
+		else:
+			if config["verbose"]:
+				print("#%s: typed without whole genome alignment" % file_name)
+			results[file_name] = calls
+	return to_align
+
+
+def type_queries(file_names, db_name, config, c, tree, root, pool=False, catalog=False):
+	'''Aligns a list of fasta files against all reference sequences of an organism and
+	returns the SNPs found in each of them as a dictionary {file_name: snplist} and
+	their classification {file_name: (tree_location, not_derived)}.
+
+	Keyword arguments:
+	file_names -- the fasta files that are to be typed
+	db_name -- the organism
+	tree -- CanSNPTree snapshot of the organism and root its root, the queries are classified on it
+	pool -- worker pool to parse alignments with, reused when several queries are typed
+	catalog -- the preloaded SNP catalog of the organism (see get_snp_catalog)
+
+	All (query x reference) progressiveMauve jobs are run by one scheduler and each alignment
+	is parsed as soon as its job has finished. The SNP catalog is loaded once for all queries.
+
+	Queries found in the result cache are neither aligned nor classified again,
+	queries that could be typed from k-mers with --kmer_typing are not aligned.
+	With --save_align neither is used, every query is aligned so that its
+	alignments are written.
+
+	'''
+	for file_name in file_names:
+		# Check if the file exists
+		if not path.isfile(file_name):
+			exit("#[ERROR in %s] No such file: %s" % (config["query"], file_name))
+
+	results = dict([(file_name, dict()) for file_name in file_names])
+	classifications = dict()
+	cache_keys = dict()
+	if config["result_cache"] and not config["save_align"]:  # Cached results have no alignments to save
+		result_cache = ResultCache(config["result_cache"], max_size=config["result_cache_size"], verbose=config["verbose"])
+		fingerprint = database_fingerprint(db_name, c)
+		settings = [db_name, fingerprint, config["mauve_path"], root, config["allow_differences"]]
+		if config["kmer_typing"]:
+			settings += ["kmer", config["kmer_size"], config["local_window"]]
+		for file_name in file_names:
+			cache_keys[file_name] = result_cache.key(file_name, *settings)
+			cached = result_cache.get(cache_keys[file_name])
+			if cached and "classification" in cached:
+				results[file_name] = cached["snps"]
+				classifications[file_name] = (cached["classification"], cached["not_derived"])
+				del cache_keys[file_name]
+		file_names = list(cache_keys)
+
+	def store_results():
+		'''Classify the queries that were typed, all at once, and store them in the cache'''
+		states, snp_names = tree.state_matrix([results[file_name] for file_name in file_names])
+		locations, not_derived = tree.classify_matrix(states, snp_names, config["allow_differences"], root)
+		for i, file_name in enumerate(file_names):
+			classifications[file_name] = (locations[i], not_derived[i])
+		for file_name in cache_keys:
+			result_cache.put(cache_keys[file_name], {"query": file_name, "snps": results[file_name],
+							 "classification": classifications[file_name][0], "not_derived": classifications[file_name][1]})
+		return results, classifications
+
+	if not file_names:  # Everything was cached, no need to align
+		return results, classifications
+	if not catalog:
+		catalog = get_snp_catalog(config["db_path"],db_name)
+	if config["kmer_typing"] and not config["save_align"]:
+		aligned_names = kmer_type(file_names, results, db_name, config, c, catalog, tree, root)
+		if not aligned_names:
+			return store_results()
+	else:
+		aligned_names = file_names
+
+	seq_uids, reference_sequences, reference_files = write_reference_sequences(db_name, config, c)
+	seq_counter = len(seq_uids)
+
+	out_names = dict()
+	for file_name in aligned_names:
+		out_name = file_name.split("/")[-1]
+		if out_name in out_names.values():  # Queries with the same file name in different folders
+			out_name = "%s.%d" % (out_name, len(out_names))
+		out_names[file_name] = out_name
 
 	# Parallelised running of several progressiveMauve processes
-	if config["num_threads"] == 0 or config["num_threads"] > seq_counter:
-		max_threads = seq_counter
+	# By default one per core, but at least one per reference so a single query is aligned against all references at once
+	if config["num_threads"] == 0:
+		max_threads = min(max(cpu_count(), seq_counter), seq_counter * len(aligned_names))
 	else:
-		max_threads = config["num_threads"]
+		max_threads = min(config["num_threads"], seq_counter * len(aligned_names))
+	max_threads = max(1, max_threads)
 
 	if config["verbose"] and not config["skip_mauve"]:
-		print("#Aligning sequence against %i reference sequence(s) ..." % len(reference_sequences))
+		print("#Aligning %i sequence(s) against %i reference sequence(s) ..." % (len(aligned_names), len(reference_sequences)))
 
-	processes = list()
 	mauve_jobs = list()
 	x2f_jobs = list()
 
-	for i in range(1, seq_counter + 1):
-		if config["save_align"]:
-			fasta_name = reference_sequences[i]
-		else:
-			fasta_name = seq_uids[i]
+	for file_name in aligned_names:
+		output = "%s/%s.CanSNPer" % (config["tmp_path"], out_names[file_name])
+		for i in range(1, seq_counter + 1):
+			if config["save_align"]:
+				fasta_name = reference_sequences[i]
+			else:
+				fasta_name = seq_uids[i]
+
+			# Write the commands that will be run. one for each reference sequence
+			job = [config["mauve_path"], "--output=%s.%s.xmfa" % (output, seq_uids[i]), reference_files[i], file_name]
+			mauve_jobs.append(MauveJob((file_name, i), job, "%s/CanSNPer_err%s.%s.txt" % (config["tmp_path"], out_names[file_name], seq_uids[i])))
+			if config["save_align"]:  # The alignment is converted to fasta in the coordinates of the reference, sequence 1 of the job
+				x2f_jobs.append(("%s.%s.xmfa" % (output, seq_uids[i]), 1, 0, "%s.%s.fa" % (output, fasta_name)))
 
-		# Write the commands that will be run. one for each reference sequence
-		job = ("%s --output=%s.%s.xmfa " % (config["mauve_path"], output, seq_uids[i]) +
-						  "%s/CanSNPer_reference_sequence.%s.fa %s > " % (config["tmp_path"],
-																		  seq_uids[i], file_name) +
-						  "/dev/null 2> %s/CanSNPer_err%s.txt" % (config["tmp_path"], seq_uids[i]))
-		mauve_jobs.append(job.strip()+"\n")
+	'''CanSNPer1.1 modification, a new xmfa parser has been implemented which will subprocess a function call only.
+		Each alignment is parsed as soon as its progressiveMauve job has finished, while other alignments are still running'''
+	xmfa_obj = ParseXMFA()
+	own_pool = not pool
+	if own_pool:
+		pool = Pool(max_threads)
+
+	def parse_alignment(file_name, i, callback=None):
+		'''Start parsing the alignment of a query against reference number i'''
+		job = xmfa_parse_job(xmfa_obj,seq_uids[i],config["tmp_path"],out_names[file_name],config["db_path"],db_name,
+							reference_sequences[i],config["xmfa_index"],catalog)
+		return pool.apply_async(parse_xmfa, job, callback=callback, error_callback=callback)
+
+	def aligned(job, release):
+		'''Errorcheck mauve, cant continue if it crashed, then parse the alignment.
+			The job keeps its slot until the alignment is parsed.'''
+		file_name, i = job.key
+		if job.error is not None:
+			exit("#[ERROR in %s] progressiveMauve could not be run after %d attempt(s): %s" % (file_name, job.attempts, str(job.error)))
+		if job.failed:
+			exit("#[ERROR in %s] progressiveMauve exited with status %s after %d attempt(s)" % (file_name, job.returncode, job.attempts))
+		mauve_error_check("%s.%s" % (out_names[file_name], seq_uids[i]), config)
+		parse_alignment(file_name, i, callback=release)
 
 	#Starting the processes that use progressiveMauve to align sequences
 	if not config["skip_mauve"]:
-		while True:
-			while mauve_jobs and len(processes) < max_threads:
-				job = mauve_jobs.pop()
-				processes.append(Popen(job, shell=True))
-				if config["dev"]:
-					print("#[DEV] progressiveMauve command: %s" % job)
-			for p in processes:
-				if p.poll() is not None:
-					processes.remove(p)
-			if not processes and not mauve_jobs:
-				break
-			time.sleep(0.5)
-		for uid in seq_uids:  # Errorcheck mauve, cant continue if it crashed
-			mauve_error_check(seq_uids[uid], config)
+		scheduler = MauveScheduler(max_threads, timeout=config["mauve_timeout"], retries=config["mauve_retries"],
+									verbose=config["verbose"], dev=config["dev"])
+		for job in scheduler.run(mauve_jobs, aligned):
+			if isinstance(job.result, Exception):
+				raise job.result
+			results[job.key[0]].update(job.result)
+	else:
+		parse_jobs = [(file_name, parse_alignment(file_name, i)) for file_name in aligned_names for i in range(1, seq_counter + 1)]
+		for file_name, result in parse_jobs:
+			results[file_name].update(result.get())
 
-	'''CanSNPer1.1 modification, a new xmfa parser has been implemented which will subprocess a function call only'''
-	xmfa_obj = ParseXMFA()
-	snplist = xmfa_multiproc(xmfa_obj,seq_uids, config["tmp_path"],out_name,config["db_path"],config["reference"])
+	# x2fa runs in the worker pool, no new python process is started for it. The fasta
+	# files are written one alignment block at a time, memory does not grow with the genomes
+	for job, conversion in [(job, pool.apply_async(x2fa, job, {"stream": True})) for job in x2f_jobs]:
+		try:
+			conversion.get()
+		except ValueError as e:
+			exit("#[ERROR in %s] x2fa failed to convert %s:\n%s" % (config["query"], job[0], str(e)))
+		if config["verbose"]:
+			print("#Alignment saved as %s" % job[3])
+
+	if own_pool:
+		pool.close()
+		pool.join()
+	return store_results()
+
+
+def align(file_name, config, c, pool=False):
+	'''This function is the "main" of the classifier part of the program.
+
+	Keyword arguments:
+	file_name -- the name of the fasta file that is to be typed
+	pool -- worker pool to parse alignments with, reused when several queries are typed
+
+	Sets everything in motion and retrieves and distributes all the results.
+
+	'''
+	# Set warning flags
+	WARNINGS = dict()
 
-	root = find_tree_root(db_name, c, config)  # Find the root of the tree we are using
+	# Get database and output name
+	db_name = detect_organisms([file_name], config, c)[file_name]
+	catalog = get_snp_catalog(config["db_path"],db_name)
+	tree = CanSNPTree(db_name, verbose=config["dev"]).load(c)
+	root = find_tree_root(db_name, c, config, tree)  # Find the root of the tree we are using
 	if config["verbose"]:
 		print("#Using tree root:", root)
 
+	results, classifications = type_queries([file_name], db_name, config, c, tree, root, pool=pool, catalog=catalog)
+	snplist = results[file_name]
+	tree_location, not_derived = classifications[file_name]
+	print_classification(file_name, tree_location, not_derived, config)
+
 	if config["draw_tree"]:  # Draw a tree and mark positions
 		if config["galaxy"]:
 			tree_file_name = getcwd() + "/CanSNPer_tree_galaxy.pdf"
 		else:
 			tree_file_name = "%s_tree.pdf" % file_name
-		draw_ete3_tree(db_name, snplist, tree_file_name, config, c)
+		draw_ete3_tree(db_name, snplist, tree_file_name, config, c, tree)
+	return snplist, tree_location
+
+
+def print_classification(file_name, tree_location, not_derived, config):
+	'''Prints the classification of a query'''
+	if config["tab_sep"]:
+		print("%s\t%s" % (file_name, tree_location))
+	else:
+		print("Classification of %s: %s" % (file_name, tree_location))
+	if not_derived:
+		stderr.write("#[WARNING in %s] these SNPs were not in the derived state: %s\n" % (file_name, ", ".join(not_derived)))
+
+
+def get_batch_queries(file_names):
+	'''Returns the list of fasta files to type in batch mode.
+
+	Keyword arguments:
+	file_names -- fasta files, directories or manifest files
+
+	Every fasta file in a directory is typed. A manifest is a text file
+	listing one fasta file per line, lines beginning with # are comments
+	and relative paths are relative to the manifest.
+
+	'''
+	fasta_suffixes = (".fa", ".fasta", ".fna", ".fas", ".fa.gz", ".fasta.gz", ".fna.gz", ".fas.gz")
+	queries = list()
+	for file_name in file_names:
+		if path.isdir(file_name):
+			queries += sorted([path.join(file_name, f) for f in listdir(file_name) if f.endswith(fasta_suffixes)])
+			continue
+		manifest = zopen(file_name, "r")
+		first = manifest.read(1)
+		if first == ">" or not first:  # A fasta file
+			queries.append(file_name)
+		else:
+			manifest.seek(0)
+			for line in manifest:
+				line = line.strip()
+				if line and line[0] != "#":
+					queries.append(path.join(path.dirname(file_name), line))
+		manifest.close()
+	return queries
+
+
+def write_batch_table(results, classifications, file_name, organisms=False):
+	'''Writes the classification and SNP calls of all queries in a batch as one tab separated table.
+
+	Keyword arguments:
+	results -- dictionary {query: {SNP: state}}
+	classifications -- dictionary {query: canSNP}
+	file_name -- the name of the table
+	organisms -- dictionary {query: organism}, written as a column if given
+
+	One row per query and one column per SNP, the state is 1 for derived,
+	2 for ancestral and 0 if the SNP was not found.
+
+	'''
+	snps = sorted(set([snp for query in results for snp in results[query]]))
+	out = open(file_name, "w")
+	if organisms:
+		out.write("#Query\tOrganism\tClassification\t%s\n" % "\t".join(snps))
+	else:
+		out.write("#Query\tClassification\t%s\n" % "\t".join(snps))
+	for query in results:
+		calls = "\t".join([str(results[query].get(snp, 0)) for snp in snps])
+		if organisms:
+			out.write("%s\t%s\t%s\t%s\n" % (query, organisms[query], classifications[query], calls))
+		else:
+			out.write("%s\t%s\t%s\n" % (query, classifications[query], calls))
+	out.close()
+
+
+def type_batch(file_names, config, c):
+	'''Types many query fasta files in one run and writes a consolidated result table.
+
+	Keyword arguments:
+	file_names -- fasta files, directories or manifest files (see get_batch_queries)
+
+	Without --reference the organism of each query is detected (see detect_organisms),
+	the queries of each organism are typed together against its references only.
+
+	'''
+	queries = get_batch_queries(file_names)
+	if config["verbose"]:
+		print("#Typing %i sequence(s) in batch mode ..." % len(queries))
+	organisms = detect_organisms(queries, config, c)
+	results = dict()
+	classifications = dict()
+	with Pool(get_pool_size(config["num_threads"])) as pool:
+		for db_name in sorted(set(organisms.values())):
+			group = [query for query in queries if organisms[query] == db_name]
+			catalog = get_snp_catalog(config["db_path"],db_name)
+			tree = CanSNPTree(db_name, verbose=config["dev"]).load(c)  # The tree is loaded once for all queries
+			root = find_tree_root(db_name, c, config, tree)
+			if config["verbose"]:
+				print("#Typing %i sequence(s) of %s, using tree root: %s" % (len(group), db_name, root))
+			group_results, group_classifications = type_queries(group, db_name, config, c, tree, root, pool=pool, catalog=catalog)
+			results.update(group_results)
+			for query in group:
+				classifications[query], not_derived = group_classifications[query]
+				print_classification(query, classifications[query], not_derived, config)
+			if config["draw_tree"]:
+				for query in group:
+					draw_ete3_tree(db_name, results[query], "%s_tree.pdf" % query, config, c, tree)
+	results = dict([(query, results[query]) for query in queries])  # Rows in the order the queries were given
+	write_batch_table(results, classifications, config["batch_output"], organisms if len(set(organisms.values())) > 1 else False)
+	if config["verbose"]:
+		print("#Batch results written to %s" % config["batch_output"])
+	return results
 
 def main():
 	config = parse_arguments()
 
 	db_open = False
+	# Typing only reads the database, many runs can then share it without locking each other
+	read_only = not any([config["initialise_organism"], config["import_snp_file"], config["import_tree_file"],
+						 config["import_seq_file"], config["pack_sequences"], config["delete_organism"],
+						 config["migrate_database"], config["sketch_references"]])
 	# Open sqlite3 connection
 	if config["db_path"] is not None:
 		if not path.isfile(config["db_path"]):
+			if read_only:
+				exit("#[ERROR in %s] Could not find database at %s" % (config["query"], config["db_path"]))
 			print("Trying to create new database at %s" % config["db_path"])
 		try:
-			cnx = sqlite3.connect(config["db_path"])
+			cnx = open_database(config["db_path"], read_only=read_only, immutable=read_only and config["immutable_database"])
 			c = cnx.cursor()
 			db_open = True
 		except sqlite3.OperationalError as e:
@@ -968,6 +1329,13 @@ def main():
 	# Check that the db is available before running
 	if db_open:
 		# Run the apropriate functions
+		if config["migrate_database"]:
+			migrate_database(config, c)
+		elif config["verbose"] and not config["initialise_organism"]:
+			schema = DatabaseSchema(c)
+			if schema.version() < schema.latest:
+				print("#Database schema version %d is older than %d, --migrate_database adds indexes that speed up lookups" % (schema.version(), schema.latest))
+
 		if config["initialise_organism"]:
 			initialise_table(config, c)
 
@@ -980,11 +1348,20 @@ def main():
 		if config["import_seq_file"]:
 			import_sequence(config["import_seq_file"], config, c)
 
+		if config["pack_sequences"]:
+			pack_sequences(config, c)
+
+		if config["sketch_references"]:
+			sketch_references(config, c)
+
 		if config["query"]:
 			if config["verbose"]:
 				print("#Starting %s ..." % config["query"])
 			align(config["query"], config, c)
 
+		if config["query_batch"]:
+			type_batch(config["query_batch"], config, c)
+
 		if config["delete_organism"]:
 			purge_organism(config, c)
 	else:
@@ -992,7 +1369,8 @@ def main():
 
 	# If the database is been open, close it
 	if db_open:
-		cnx.commit()
+		if not read_only:
+			cnx.commit()
 		c.close()
 		cnx.close()
 
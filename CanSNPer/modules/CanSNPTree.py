@@ -0,0 +1,381 @@
+#!/usr/bin/env python3 -c
+
+'''
+CanSNPTree is an in memory snapshot of the canSNP tree of an organism.
+	The tree and the SNP of every node are read with one query each, so
+	walking the tree does not need the database.
+'''
+
+__version__ = "0.1.0"
+__author__ = "David Sundell"
+__credits__ = ["David Sundell"]
+__license__ = "GPLv3"
+__maintainer__ = "FOI bioinformatics group"
+__email__ = ["bioinformatics@foi.se", "david.sundell@foi.se"]
+__date__ = "2019-05-06"
+__status__ = "Production"
+
+import re
+import numpy as np
+
+class CanSNPTree(object):
+	"""Snapshot of a canSNP tree, node -> children and node -> (strain, position, derived base)."""
+	def __init__(self, organism, verbose=False):
+		super(CanSNPTree, self).__init__()
+		self.organism = organism
+		self.verbose = verbose
+		self.nodes = []  ## Nodes in the order they are listed in the database
+		self.children = {}
+		self.snps = {}
+		self.topologies = {}  ## Index arrays of the tree below a root, see topology
+
+	def load_tree(self, c):
+		'''Load the tree of the organism from a database cursor, without its SNPs'''
+		c.execute("SELECT Name, Children FROM Tree WHERE Organism = ?", (self.organism,))
+		for name, children in c.fetchall():
+			if name not in self.children:
+				self.nodes.append(name)
+			self.children[name] = children.split(";") if children else []
+		self.topologies = {}
+		return self
+
+	def load(self, c):
+		'''Load tree and SNPs of the organism from a database cursor'''
+		self.load_tree(c)
+		c.execute("SELECT SNP, Strain, Position, Derived_base FROM %s" % self.organism)
+		for snp, strain, position, derived in c.fetchall():
+			if snp not in self.snps:  ## Keep the first entry like a SELECT ... fetchone would
+				self.snps[snp] = (strain, position, derived)
+		if self.verbose:
+			print("#Loaded {nodes} nodes and {snps} SNPs of {organism}".format(nodes=len(self.nodes), snps=len(self.snps), organism=self.organism))
+		return self
+
+	def get_children(self, node):
+		'''Return the children of a node, an empty list for leaves'''
+		return self.children.get(node, [])
+
+	def get_snp(self, node):
+		'''Return (strain, position, derived base) of the SNP of a node, None if the node has no SNP'''
+		return self.snps.get(node)
+
+	def find_root(self):
+		'''Return the first node that is not listed as a child of any node, None if there is none'''
+		listed = set()
+		for node in self.nodes:
+			listed.update(self.get_children(node))
+		for node in self.nodes:
+			if node not in listed:
+				return node
+		return None
+
+	def to_newick(self, root=None):
+		'''Return the tree below root in newick format, ie (N1,(N3,N4,(N6)N5)N2)ROOT;'''
+		if root is None:
+			root = self.find_root()
+		newick = {}
+		for node in self.postorder(root):
+			children = [newick[child] for child in self.get_children(node) if child in newick]
+			if children:
+				newick[node] = "(%s)%s" % (",".join(children), node)
+			else:
+				newick[node] = node
+		return newick[root] + ";"
+
+	def load_lines(self, lines):
+		'''Load the tree from lines listing each node after its ancestors, ie ROOT;N2;N5.
+
+			Lines starting with # are ignored. Nodes are listed in the order they are first seen.
+		'''
+		self.nodes = []
+		self.children = {}
+		for line in lines:
+			if line.startswith("#"):
+				continue
+			path = [node.strip() for node in line.strip().split(";")]
+			path = [node for node in path if node]
+			for i, node in enumerate(path):
+				if node not in self.children:
+					self.nodes.append(node)
+					self.children[node] = []
+				if i + 1 < len(path) and path[i + 1] not in self.children[node]:
+					self.children[node].append(path[i + 1])
+		self.topologies = {}
+		return self
+
+	def rows(self):
+		'''Return the tree as rows of the Tree table, (Name, Children, Organism)'''
+		return [(node, ";".join(self.get_children(node)) or None, self.organism) for node in self.nodes]
+
+	def load_newick(self, newick):
+		'''Load the tree from a newick string, every node has to be named.
+
+			Branch lengths are ignored. The nodes are listed root first in depth first order.
+		'''
+		tokens = re.findall(r"[(),;]|[^(),;]+", newick)
+		stack = []  ## Children of the nodes that are still open
+		closed = None  ## Children of the last closed parenthesis, named by the next token
+		named = False  ## The current node has a name
+		children = {}
+		root = None
+		for token in tokens:
+			if token == "(":
+				stack.append([])
+			elif token in "),;":
+				if closed is not None or not named:
+					raise ValueError("The newick tree has a node without a name")
+				if token == ";":
+					break
+				if not stack:
+					raise ValueError("Unbalanced parentheses in newick tree")
+				if token == ")":
+					closed = stack.pop()
+				named = False
+			else:
+				name = token.split(":")[0].strip()  ## Drop branch lengths
+				if not name:
+					continue
+				if name in children:
+					raise ValueError("Node %s is listed more than once in the newick tree" % name)
+				children[name] = closed if closed is not None else []
+				closed = None
+				named = True
+				if stack:
+					stack[-1].append(name)
+				elif root is None:
+					root = name
+				else:
+					raise ValueError("The newick tree has more than one root")
+		if stack or root is None:
+			raise ValueError("Unbalanced parentheses in newick tree")
+		self.children = children
+		self.nodes = []
+		order = [root]
+		while order:  ## Root first, every node before its children
+			node = order.pop()
+			self.nodes.append(node)
+			order.extend(reversed(self.children[node]))
+		self.topologies = {}
+		return self
+
+	def postorder(self, root):
+		'''Return the nodes below root with every child before its parent, without recursion'''
+		order = []
+		seen = set()
+		stack = [root]
+		while stack:
+			node = stack.pop()
+			if node in seen:  ## A node listed twice in a broken tree is only walked once
+				continue
+			seen.add(node)
+			order.append(node)
+			stack.extend(self.get_children(node))
+		order.reverse()
+		return order
+
+	def node_support(self, snplist, root):
+		'''Count derived, ancestral and missing SNPs of every subtree in one bottom-up pass.
+
+			snplist -- the SNP states of a query {SNP: state}, 1 derived, 2 ancestral and 0 missing
+			Returns the counts {node: [derived, ancestral, missing]} and for every node the least
+			number of SNPs that has to be forced to reach a derived SNP through it, the node included
+			(0 for derived nodes, None if no derived SNP can be reached)
+		'''
+		counts = {}
+		needed = {}
+		for node in self.postorder(root):
+			count = [0, 0, 0]
+			state = snplist.get(node, 0) if node in self.snps else 0
+			count[{1: 0, 2: 1, 0: 2}[state]] += 1
+			best = None
+			for child in self.get_children(node):
+				if child not in counts:
+					continue
+				count = [a + b for a, b in zip(count, counts[child])]
+				if needed[child] is not None and (best is None or needed[child] < best):
+					best = needed[child]
+			counts[node] = count
+			if node not in self.snps:  ## Nodes without SNP can not be passed
+				needed[node] = None
+			elif state == 1:
+				needed[node] = 0
+			elif best is None:
+				needed[node] = None
+			else:
+				needed[node] = best + 1
+		return counts, needed
+
+	def classify(self, snplist, threshold=0, root=None):
+		'''Classify a query from its SNP states, without recursion.
+
+			snplist -- the SNP states of a query {SNP: state}, 1 derived, 2 ancestral and 0 missing
+			threshold -- number of SNPs that are allowed to be forced
+			Returns the deepest derived canSNP reached and the list of forced SNPs in its path.
+
+			From each node the walk moves to the first derived child. If there is none and less than
+			threshold SNPs are forced, it moves to the first child from which a derived SNP can be
+			reached by forcing the remaining number of SNPs. The node is returned when neither is possible.
+		'''
+		if root is None:
+			root = self.nodes[0]
+		counts, needed = self.node_support(snplist, root)
+		if needed[root] != 0:  ## The root has to be derived
+			return None, []
+		node = root
+		forced_snps = []
+		while True:
+			children = self.get_children(node)
+			next_node = False
+			for child in children:
+				if needed.get(child) == 0:
+					next_node = child
+					break
+			if not next_node:
+				for child in children:
+					if needed.get(child) is not None and needed[child] <= threshold - len(forced_snps):
+						next_node = child
+						break
+			if not next_node:
+				if needed[node] == 0:
+					return node, forced_snps
+				return None, forced_snps  ## Not reached, a forced SNP always leads to a derived SNP
+			if needed[next_node] > 0:
+				forced_snps.append(next_node)
+			node = next_node
+
+	def examined(self, snplist, threshold=0, root=None):
+		'''Return the nodes whose SNP states the classification of a query depends on.
+
+			Without forced SNPs these are the nodes on the path to the canSNP of the query and
+			their children, changing the state of any other SNP gives the same classification.
+			With forced SNPs the whole tree below root is returned.
+		'''
+		if root is None:
+			root = self.nodes[0]
+		if threshold > 0:
+			return set(self.postorder(root))
+		node, forced_snps = self.classify(snplist, threshold, root)
+		if node is None:
+			return set([root])
+		nodes, parent, depth, children = self.topology(root)
+		i = nodes.index(node)
+		examined = set()
+		while i >= 0:
+			examined.add(nodes[i])
+			examined.update(self.get_children(nodes[i]))
+			i = parent[i]
+		return examined
+
+	def topology(self, root):
+		'''Return index arrays of the tree below root, computed once per root.
+
+			nodes -- the nodes in breadth first order, the root first
+			parent -- index of the parent of every node, -1 for the root
+			depth -- depth of every node, 0 for the root
+			children -- children of every node as a matrix padded with -1, in database order
+		'''
+		if root in self.topologies:
+			return self.topologies[root]
+		nodes = [root]
+		parent = [-1]
+		depth = [0]
+		index = {root: 0}
+		i = 0
+		while i < len(nodes):
+			for child in self.get_children(nodes[i]):
+				if child in index:  ## A node listed twice in a broken tree is only used once
+					continue
+				index[child] = len(nodes)
+				nodes.append(child)
+				parent.append(i)
+				depth.append(depth[i] + 1)
+			i += 1
+		width = max([len(self.get_children(node)) for node in nodes])
+		children = np.full((len(nodes), max(width, 1)), -1, dtype=np.int64)
+		for i, node in enumerate(nodes):
+			kids = [index[child] for child in self.get_children(node) if parent[index[child]] == i]
+			children[i, :len(kids)] = kids
+		topology = (nodes, np.array(parent, dtype=np.int64), np.array(depth, dtype=np.int64), children)
+		self.topologies[root] = topology
+		return topology
+
+	def state_matrix(self, snplists):
+		'''Return a samples x SNPs matrix of SNP states and the SNP name of every column.
+
+			snplists -- list of SNP states of each sample {SNP: state}, as given by ParseXMFA
+		'''
+		snp_names = list(self.snps)
+		column = {snp: i for i, snp in enumerate(snp_names)}
+		states = np.zeros((len(snplists), len(snp_names)), dtype=np.uint8)
+		for row, snplist in enumerate(snplists):
+			for snp, state in snplist.items():
+				if snp in column:
+					states[row, column[snp]] = state
+		return states, snp_names
+
+	def classify_matrix(self, states, snp_names, threshold=0, root=None):
+		'''Classify many samples at once, the result is the same as classify for each sample.
+
+			states -- samples x SNPs matrix of SNP states, 1 derived, 2 ancestral and 0 missing
+			snp_names -- the SNP of every column of states
+			threshold -- number of SNPs that are allowed to be forced
+			Returns an array with the deepest derived canSNP of every sample (None if the root
+			is not derived) and a list with the forced SNPs in the path of every sample.
+
+			The samples are handled in NumPy, Python only loops over the levels of the tree.
+		'''
+		if root is None:
+			root = self.nodes[0]
+		nodes, parent, depth, children = self.topology(root)
+		states = np.asarray(states)
+		samples = states.shape[0]
+		column = {snp: i for i, snp in enumerate(snp_names)}
+		node_columns = np.array([column.get(node, -1) for node in nodes], dtype=np.int64)
+		passable = np.array([node in self.snps for node in nodes])
+		## SNP state of every sample and node, nodes without a column are missing
+		if states.shape[1]:
+			node_states = np.where(node_columns >= 0, states[:, np.maximum(node_columns, 0)], 0)
+		else:  ## No SNPs, every node is missing
+			node_states = np.zeros((samples, len(node_columns)), dtype=states.dtype)
+		derived = (node_states == 1) & passable
+
+		## Least number of forced SNPs to reach a derived SNP through each node (see node_support)
+		unreachable = np.iinfo(np.int64).max
+		best = np.full((samples, len(nodes)), unreachable, dtype=np.int64)
+		needed = np.full((samples, len(nodes)), unreachable, dtype=np.int64)
+		for level in range(depth.max(), -1, -1):
+			idx = np.flatnonzero(depth == level)
+			step = np.where(best[:, idx] < unreachable, best[:, idx] + 1, unreachable)
+			needed[:, idx] = np.where(derived[:, idx], 0, np.where(passable[idx], step, unreachable))
+			if level > 0:
+				np.minimum.at(best.T, parent[idx], needed[:, idx].T)
+
+		## Walk all samples down the tree, one level per iteration
+		rows = np.arange(samples)
+		current = np.zeros(samples, dtype=np.int64)
+		forced = np.zeros(samples, dtype=np.int64)
+		active = needed[:, 0] == 0
+		forced_steps = []
+		while active.any():
+			kids = children[current]
+			kid_needed = np.where(kids >= 0, needed[rows[:, None], np.maximum(kids, 0)], unreachable)
+			is_derived = kid_needed == 0
+			can_force = kid_needed <= (threshold - forced)[:, None]
+			has_derived = is_derived.any(axis=1)
+			has_forced = can_force.any(axis=1)
+			choice = np.where(has_derived, is_derived.argmax(axis=1), can_force.argmax(axis=1))
+			moving = active & (has_derived | has_forced)
+			next_node = kids[rows, choice]
+			forcing = moving & ~has_derived
+			forced += forcing
+			forced_steps.append(np.where(forcing, next_node, -1))
+			current = np.where(moving, next_node, current)
+			active = moving
+
+		locations = np.array([nodes[i] for i in current], dtype=object)
+		locations[needed[:, 0] != 0] = None
+		if forced_steps:
+			steps = np.stack(forced_steps, axis=1)
+			forced_snps = [[nodes[i] for i in row[row >= 0]] for row in steps]
+		else:
+			forced_snps = [[] for i in range(samples)]
+		return locations, forced_snps
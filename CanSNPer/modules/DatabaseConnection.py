@@ -1,6 +1,28 @@
 import sys
 import os
 import sqlite3
+from urllib.request import pathname2url
+
+def open_database(database, read_only=False, timeout=30, immutable=False):
+	'''Open a sqlite3 connection to a database.
+
+		Read only connections are opened with a mode=ro URI, so they never take write locks.
+		With immutable the database is also opened as immutable=1, sqlite then skips locking
+		and change detection, which is only safe if no process at all writes to the file.
+		Other connections keep the database in the default rollback journal mode. WAL mode is
+		stored in the file and needs write access to its directory even to read it, so a
+		database left in WAL mode is switched back. Connections wait up to timeout seconds
+		for a lock instead of failing.
+	'''
+	if read_only:
+		uri = "file:{path}?mode=ro".format(path=pathname2url(os.path.abspath(database)))
+		if immutable:
+			uri += "&immutable=1"
+		return sqlite3.connect(uri, uri=True, timeout=timeout, cached_statements=256)
+	conn = sqlite3.connect(database, timeout=timeout, cached_statements=256)
+	if conn.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal":
+		conn.execute("PRAGMA journal_mode=DELETE")
+	return conn
 
 class ConnectionError(Exception):
 	def __init__(self, value):
@@ -9,12 +31,18 @@ class ConnectionError(Exception):
 		return repr(self.value)
 
 class DatabaseConnection(object):
-	"""docstring for DatabaseConnection"""
-	def __init__(self, database, verbose=False):
+	"""Connection to a CanSNPer database, connections are shared within a process (see connect)"""
+
+	## Open connections of this process {(database, read_only, pid): connection}
+	pool = {}
+	pool_size = 8
+
+	def __init__(self, database, verbose=False, read_only=False):
 		super().__init__()
 		self.verbose = verbose
 		self.database = database
-		if not os.path.exists(self.database):
+		self.read_only = read_only
+		if not self.read_only and not os.path.exists(self.database):
 			if self.verbose:
 				print("python modules/database/CreateDatabase.py {database}".format(database=self.database))
 			os.system("python modules/database/CreateDatabase.py {database}".format(database=self.database))
@@ -22,12 +50,22 @@ class DatabaseConnection(object):
 		self.cursor = self.create_cursor(self.conn)
 
 	def connect(self,database):
-		'''Create database connection'''
+		'''Return a database connection of the pool, a new connection is opened if there is none.
+
+			Connections are not shared between processes, and sqlite3 keeps the prepared
+			statements of a connection so repeated queries are not compiled again.
+		'''
+		key = (os.path.abspath(database), self.read_only, os.getpid())
+		if key in DatabaseConnection.pool:
+			return DatabaseConnection.pool[key]
 		try:
-			conn = sqlite3.connect(database)
+			conn = open_database(database, read_only=self.read_only)
 			if self.verbose:
 				print("{database} opened successfully.".format(database=database))
-
+			if len(DatabaseConnection.pool) >= DatabaseConnection.pool_size:
+				## Drop the oldest connection, it is closed when no object uses it
+				DatabaseConnection.pool.pop(next(iter(DatabaseConnection.pool)))
+			DatabaseConnection.pool[key] = conn
 			return conn
 		except Exception as e:
 			sys.stderr.write(str(e))
@@ -35,7 +73,8 @@ class DatabaseConnection(object):
 		return None
 
 	def disconnect(self):
-		self.conn.close()
+		'''Release the connection, it stays open in the pool for the next DatabaseConnection'''
+		self.cursor.close()
 
 	def create_cursor(self,conn):
 		'''Create a db cursor'''
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3 -c
+
+'''
+DatabaseSchema creates and migrates the tables of a CanSNPer database.
+	The schema version of a database is stored with PRAGMA user_version,
+	migrations are applied in order and each in its own transaction.
+'''
+
+__version__ = "0.1.0"
+__author__ = "David Sundell"
+__credits__ = ["David Sundell"]
+__license__ = "GPLv3"
+__maintainer__ = "FOI bioinformatics group"
+__email__ = ["bioinformatics@foi.se", "david.sundell@foi.se"]
+__date__ = "2019-05-08"
+__status__ = "Production"
+
+import sqlite3
+from CanSNPer.modules.SequenceStore import SequenceStore
+
+class DuplicateRowsError(Exception):
+	"""Rows that would break a unique key of the new schema, [(table, rowid, key values)]"""
+	def __init__(self, rows):
+		self.rows = rows
+	def __str__(self):
+		lines = ["{table} row {rowid}: {values}".format(table=table, rowid=rowid, values=", ".join(map(str, values))) for table, rowid, values in self.rows[:50]]
+		if len(self.rows) > 50:
+			lines.append("... and {more} more".format(more=len(self.rows) - 50))
+		return "Duplicate rows, remove them or run --migrate_database to keep the first of each:\n" + "\n".join(lines)
+
+class DatabaseSchema(object):
+	"""Versioned schema of the Tree, Sequences and organism SNP tables."""
+
+	## Tables that do not hold the SNPs of an organism
+	system_tables = ["Sequences", "SequenceChunks", "Sketches", "Tree"]
+
+	def __init__(self, c, verbose=False, deduplicate=False):
+		super(DatabaseSchema, self).__init__()
+		self.c = c
+		self.verbose = verbose
+		self.deduplicate = deduplicate  ## Remove rows that break a new unique key, otherwise DuplicateRowsError is raised
+		## Migrations in the order they are applied, a database at version n has the first n applied
+		self.migrations = [self.add_keys, self.add_sequence_chunks, self.add_sketches, self.add_checksums]
+
+	@property
+	def latest(self):
+		'''The schema version of a database with all migrations applied'''
+		return len(self.migrations)
+
+	def version(self):
+		'''Return the schema version of the database, 0 for databases made before versioning'''
+		self.c.execute("PRAGMA user_version")
+		return self.c.fetchone()[0]
+
+	def organisms(self):
+		'''Return the organism SNP tables of the database'''
+		self.c.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name")
+		return [table for table, in self.c.fetchall() if table not in self.system_tables and not table.startswith("sqlite_")]
+
+	def create(self, organism):
+		'''Create the tables of a new organism, the database is migrated to the latest version first'''
+		self.migrate()
+		self.c.execute("CREATE TABLE IF NOT EXISTS %s (SNP VARCHAR(5), Reference VARCHAR(255), Strain VARCHAR(100), Position integer, Derived_base NCHAR(1), Ancestral_base NCHAR(1))" % organism)
+		self.index_organism(organism)
+		self.c.connection.commit()
+
+	def migrate(self):
+		'''Apply the migrations the database is missing, returns the number applied'''
+		self.c.execute("CREATE TABLE IF NOT EXISTS Tree (Name text, Children text, Organism text)")
+		self.c.execute("CREATE TABLE IF NOT EXISTS Sequences (Organism text, Strain text, Sequence text)")
+		version = self.version()
+		applied = 0
+		for number, migration in enumerate(self.migrations, start=1):
+			if version >= number:
+				continue
+			conn = self.c.connection
+			conn.commit()  ## Finish an open transaction so the migration is a transaction of its own
+			try:
+				self.c.execute("BEGIN")
+				migration()
+				self.c.execute("PRAGMA user_version = %d" % number)
+				self.c.execute("COMMIT")
+			except (sqlite3.Error, DuplicateRowsError):
+				self.c.execute("ROLLBACK")
+				raise
+			if self.verbose:
+				print("#Database schema migrated to version {number} ({name})".format(number=number, name=migration.__name__))
+			applied += 1
+		return applied
+
+	def duplicates(self, table, columns):
+		'''Return the rows that share the values of columns with another row [(table, rowid, values)]'''
+		columns = ", ".join(columns)
+		self.c.execute("SELECT rowid, {columns} FROM {table} WHERE ({columns}) IN (SELECT {columns} FROM {table} GROUP BY {columns} HAVING COUNT(*) > 1) ORDER BY {columns}, rowid".format(table=table, columns=columns))
+		return [(table, row[0], row[1:]) for row in self.c.fetchall()]
+
+	def remove_duplicates(self, table, columns):
+		'''Remove rows that repeat the values of columns, the first row inserted is kept.
+
+			Rows are only removed if the schema was made with deduplicate, otherwise DuplicateRowsError lists them.
+		'''
+		if not self.deduplicate:
+			duplicates = self.duplicates(table, columns)
+			if duplicates:
+				raise DuplicateRowsError(duplicates)
+			return
+		self.c.execute("DELETE FROM {table} WHERE rowid NOT IN (SELECT MIN(rowid) FROM {table} GROUP BY {columns})".format(table=table, columns=", ".join(columns)))
+		if self.c.rowcount > 0:
+			print("#Removed {count} duplicate row(s) from {table}".format(count=self.c.rowcount, table=table))
+
+	def index_organism(self, organism):
+		'''Add the keys of an organism SNP table'''
+		self.remove_duplicates(organism, ["SNP"])
+		self.c.execute("CREATE UNIQUE INDEX IF NOT EXISTS {organism}_SNP ON {organism} (SNP)".format(organism=organism))
+		self.c.execute("CREATE INDEX IF NOT EXISTS {organism}_Strain_Position ON {organism} (Strain, Position)".format(organism=organism))
+
+	def add_keys(self):
+		'''Version 1, unique keys on (Organism, Name) in Tree, (Organism, Strain) in Sequences and SNP in organism tables'''
+		self.remove_duplicates("Tree", ["Organism", "Name"])
+		self.c.execute("CREATE UNIQUE INDEX IF NOT EXISTS Tree_Organism_Name ON Tree (Organism, Name)")
+		self.remove_duplicates("Sequences", ["Organism", "Strain"])
+		self.c.execute("CREATE UNIQUE INDEX IF NOT EXISTS Sequences_Organism_Strain ON Sequences (Organism, Strain)")
+		for organism in self.organisms():
+			self.index_organism(organism)
+
+	def add_sequence_chunks(self):
+		'''Version 2, SequenceChunks holds 2-bit packed sequences, their Sequences.Sequence is NULL (see SequenceStore)'''
+		self.c.execute("CREATE TABLE IF NOT EXISTS SequenceChunks (Organism text, Strain text, Chunk integer, Length integer, " +
+					   "Packed blob, Exceptions text, PRIMARY KEY (Organism, Strain, Chunk))")
+
+	def add_sketches(self):
+		'''Version 3, Sketches holds MinHash sketches of the reference sequences (see MinHashSketch)'''
+		self.c.execute("CREATE TABLE IF NOT EXISTS Sketches (Organism text, Strain text, K integer, Size integer, " +
+					   "Checksum text, Hashes blob, PRIMARY KEY (Organism, Strain))")
+
+	def add_checksums(self):
+		'''Version 4, Sequences.Checksum holds the hash of each sequence written with it (see SequenceStore.put)'''
+		self.c.execute("ALTER TABLE Sequences ADD COLUMN Checksum text")
+		store = SequenceStore(self.c)
+		self.c.execute("SELECT Organism, Strain FROM Sequences")
+		for organism, strain in self.c.fetchall():
+			checksum = store.content_hash(store.chunks(organism, strain))
+			self.c.execute("UPDATE Sequences SET Checksum = ? WHERE Organism = ? AND Strain = ?", (checksum, organism, strain))
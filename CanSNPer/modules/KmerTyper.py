@@ -0,0 +1,161 @@
+#!/usr/bin/env python3 -c
+
+'''
+KmerTyper calls canSNPs of a query without aligning it.
+	For every SNP a k-mer centred on the SNP is made for both alleles and both
+	strands from the flanks in the reference sequence, with every combination of
+	alleles of other SNPs in the flanks. The query fasta is scanned
+	once and each SNP is called derived or ancestral if only k-mers of that allele
+	are found. SNPs whose k-mers are not unique in their reference, or that are
+	found with both alleles or not at all, are left unresolved.
+'''
+
+__version__ = "0.1.0"
+__author__ = "David Sundell"
+__credits__ = ["David Sundell"]
+__license__ = "GPLv3"
+__maintainer__ = "FOI bioinformatics group"
+__email__ = ["bioinformatics@foi.se", "david.sundell@foi.se"]
+__date__ = "2019-05-10"
+__status__ = "Production"
+
+import gzip
+import bisect
+import itertools
+import numpy as np
+from CanSNPer.modules.SequenceStore import ENCODE
+
+COMPLEMENT = str.maketrans("ACGTN", "TGCAN")
+
+def reverse_complement(sequence):
+	'''Return the reverse complement of a sequence'''
+	return sequence.translate(COMPLEMENT)[::-1]
+
+def read_fasta(file_name):
+	'''Yield the sequence of every record in a fasta file, the file may be gzipped'''
+	opener = gzip.open if file_name.endswith(".gz") else open
+	with opener(file_name, "rt") as fin:
+		parts = []
+		for line in fin:
+			if line.startswith(">"):
+				if parts:
+					yield "".join(parts).upper()
+				parts = []
+			else:
+				parts.append(line.strip())
+		if parts:
+			yield "".join(parts).upper()
+
+class KmerTyper(object):
+	"""Alignment free SNP caller using k-mers of the SNP flanks."""
+	def __init__(self, k=31, max_neighbours=4, verbose=False):
+		super(KmerTyper, self).__init__()
+		if k % 2 == 0 or not 3 <= k <= 31:
+			raise ValueError("k has to be an odd number from 3 to 31, not {k}".format(k=k))
+		self.k = k
+		self.flank = k // 2
+		self.max_neighbours = max_neighbours  ## SNPs with more SNPs in their flanks are not indexed
+		self.verbose = verbose
+		self.index = {}  ## k-mer -> (SNP, state)
+		self.keys = np.zeros(0, dtype=np.uint64)  ## Sorted k-mers of the index
+		self.snps = set()  ## Every SNP of the catalog
+		self.indexed = set()  ## SNPs with unique k-mers
+
+	def kmers(self, sequence):
+		'''Return the k-mer starting at every position of a sequence as 2-bit integers, and which of them hold only ACGT'''
+		seq = np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)
+		n = len(seq) - self.k + 1
+		if n <= 0:
+			return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+		codes = ENCODE[seq]
+		bad = codes == 255
+		codes = np.where(bad, 0, codes).astype(np.uint64)
+		values = np.zeros(n, dtype=np.uint64)
+		for i in range(self.k):
+			values = (values << np.uint64(2)) | codes[i:i + n]
+		bad_count = np.concatenate(([0], np.cumsum(bad)))
+		valid = bad_count[self.k:] - bad_count[:n] == 0
+		return values, valid
+
+	def kmer(self, sequence):
+		'''Return a single k-mer as an integer, None if it holds other bases than ACGT'''
+		values, valid = self.kmers(sequence)
+		if len(values) != 1 or not valid[0]:
+			return None
+		return int(values[0])
+
+	def build(self, catalog, sequences):
+		'''Index the SNPs of the catalog.
+
+			catalog -- the SNP catalog of the organism {strain: {pos: (pos, ancestral base, derived base, SNP)}}
+			sequences -- function returning the reference sequence of a strain, None if there is none
+		'''
+		conflicts = set()
+		for strain in catalog:
+			self.snps.update([snp[3] for snp in catalog[strain].values()])
+			sequence = sequences(strain)
+			if not sequence:
+				continue
+			candidates = {}
+			positions = sorted(catalog[strain])
+			for pos, (pos, rbase, tbase, name) in catalog[strain].items():
+				if pos - 1 - self.flank < 0 or pos + self.flank > len(sequence) or sequence[pos - 1] not in (rbase, tbase):
+					continue  ## The SNP is too close to the end or does not match the reference
+				## SNPs in the flanks may have either allele in the query
+				neighbours = positions[bisect.bisect_left(positions, pos - self.flank):bisect.bisect_right(positions, pos + self.flank)]
+				neighbours = [catalog[strain][near] for near in neighbours if near != pos]
+				if len(neighbours) > self.max_neighbours:
+					continue
+				derived = set()
+				ancestral = set()
+				for alleles in itertools.product(*[(near[1], near[2]) for near in neighbours]):
+					window = list(sequence[pos - 1 - self.flank:pos + self.flank])
+					for near, base in zip(neighbours, alleles):
+						window[near[0] - pos + self.flank] = base
+					for base, kmers in ((tbase, derived), (rbase, ancestral)):
+						window[self.flank] = base
+						kmer = "".join(window)
+						kmers.update([self.kmer(kmer), self.kmer(reverse_complement(kmer))])
+				if None in derived | ancestral or derived & ancestral:
+					continue  ## Other bases than ACGT in the flanks, or alleles that can not be told apart
+				candidates[name] = dict([(value, 1) for value in derived] + [(value, 2) for value in ancestral])
+			## The k-mers of a SNP must be found exactly once in the reference, at the SNP
+			keys = np.array(sorted(set([value for kmers in candidates.values() for value in kmers])), dtype=np.uint64)
+			values, valid = self.kmers(sequence)
+			hits = values[valid & np.isin(values, keys)]
+			found, counts = np.unique(hits, return_counts=True)
+			occurrences = dict(zip(found.tolist(), counts.tolist()))
+			for name, kmers in candidates.items():
+				if sum([occurrences.get(value, 0) for value in kmers]) != 1:
+					continue
+				for value, state in kmers.items():
+					if value in self.index and self.index[value] != (name, state):
+						conflicts.update([name, self.index[value][0]])
+					self.index[value] = (name, state)
+				self.indexed.add(name)
+		if conflicts:  ## k-mers shared by different SNPs can not tell them apart
+			self.index = dict([(value, call) for value, call in self.index.items() if call[0] not in conflicts])
+			self.indexed -= conflicts
+		self.keys = np.array(sorted(self.index), dtype=np.uint64)
+		if self.verbose:
+			print("#Indexed k-mers of {indexed} of {snps} SNPs".format(indexed=len(self.indexed), snps=len(self.snps)))
+		return self
+
+	def call(self, file_name):
+		'''Return the SNP states of a query fasta {SNP: state} and the set of unresolved SNPs, which have state 0'''
+		observed = {}
+		for sequence in read_fasta(file_name):
+			values, valid = self.kmers(sequence)
+			for value in values[valid & np.isin(values, self.keys)].tolist():
+				name, state = self.index[value]
+				observed.setdefault(name, set()).add(state)
+		calls = {}
+		unresolved = set()
+		for name in self.snps:
+			states = observed.get(name, set())
+			if len(states) == 1:
+				calls[name] = states.pop()
+			else:  ## Not found, or found with both alleles
+				calls[name] = 0
+				unresolved.add(name)
+		return calls, unresolved
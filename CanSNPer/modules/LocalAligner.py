@@ -0,0 +1,173 @@
+#!/usr/bin/env python3 -c
+
+'''
+LocalAligner calls SNPs by aligning only a window of the reference around each SNP.
+	Seeds from the window are looked up in the query to find where the window
+	is, both strands of the query are searched. The window is then aligned to
+	that part of the query with a banded alignment and the query base aligned to
+	the SNP is called with the same states as ParseXMFA, 1 derived, 2 ancestral
+	and 0 missing. It is used for SNPs that KmerTyper can not call, ie with
+	indels or divergent bases near the SNP.
+'''
+
+__version__ = "0.1.0"
+__author__ = "David Sundell"
+__credits__ = ["David Sundell"]
+__license__ = "GPLv3"
+__maintainer__ = "FOI bioinformatics group"
+__email__ = ["bioinformatics@foi.se", "david.sundell@foi.se"]
+__date__ = "2019-05-13"
+__status__ = "Production"
+
+import numpy as np
+from collections import Counter
+from CanSNPer.modules.KmerTyper import KmerTyper, read_fasta, reverse_complement
+
+class LocalAligner(object):
+	"""Banded alignment of SNP flank windows to a query, seeded by k-mers."""
+	def __init__(self, window=200, seed=15, band=32, min_seeds=3, min_score=0.6, verbose=False):
+		super(LocalAligner, self).__init__()
+		self.window = window  ## bases of reference on each side of a SNP
+		self.seeds = KmerTyper(seed)
+		self.band = band  ## largest indel, in bases, the alignment can follow
+		self.min_seeds = min_seeds  ## seeds that have to agree on where the window is in the query
+		self.match = 1
+		self.mismatch = 1
+		self.gap_open = 5
+		self.gap_extend = 1
+		self.flank = 3  ## bases on each side of a SNP that have to be aligned without gaps
+		self.min_score = min_score  ## least alignment score per reference base
+		self.verbose = verbose
+
+	def windows(self, catalog, names, region):
+		'''Return the reference window of each SNP in names {SNP: (window, index of the SNP in window, ancestral base, derived base)}
+
+			catalog -- the SNP catalog of the organism {strain: {pos: (pos, ancestral base, derived base, SNP)}}
+			region -- function returning bases start to end (0-based) of a strain, ie SequenceStore.region
+		'''
+		windows = {}
+		for strain in catalog:
+			for pos, (pos, rbase, tbase, name) in catalog[strain].items():
+				if name not in names:
+					continue
+				start = max(0, pos - 1 - self.window)
+				window = region(strain, start, pos + self.window).upper()
+				if len(window) > pos - 1 - start:
+					windows[name] = (window, pos - 1 - start, rbase, tbase)
+		return windows
+
+	def align(self, ref, query, target):
+		'''Align ref to query, all of ref and any part of query, and return (query index aligned to ref[target], score).
+
+			The query is expected to start band bases before ref. The index is None if ref[target] is aligned to a gap
+			or there is a gap within flank bases of it. Gaps have an opening cost so an indel is kept in one piece
+			rather than split around a mismatch.
+		'''
+		band = 2 * self.band + 1
+		gap_open = self.gap_open + self.gap_extend
+		gap_extend = self.gap_extend
+		r = np.frombuffer(ref.encode("ascii"), dtype=np.uint8)
+		q = np.frombuffer(query.encode("ascii"), dtype=np.uint8)
+		if len(q) < len(r) + band:
+			q = np.concatenate((q, np.full(len(r) + band - len(q), ord("N"), dtype=np.uint8)))
+		steps = np.arange(band) * gap_extend
+		## Cell d of row i is ref[:i] aligned to query[:i + d], H is the best score,
+		## F of alignments ending with a gap in query and E with a gap in ref
+		H = np.zeros(band)
+		F = np.full(band, -np.inf)
+		h_gap = np.zeros((len(r) + 1, band), dtype=bool)  ## H ends with a gap in ref
+		x_gap = np.zeros((len(r) + 1, band), dtype=bool)  ## otherwise H ends with a gap in query
+		f_open = np.zeros((len(r) + 1, band), dtype=bool)
+		e_open = np.zeros((len(r) + 1, band), dtype=bool)
+		for i in range(1, len(r) + 1):
+			bases = q[i - 1:i - 1 + band]
+			diagonal = H + np.where((bases == r[i - 1]) & (bases != ord("N")), self.match, -self.mismatch)
+			opened = np.append(H[1:], -np.inf) - gap_open
+			extended = np.append(F[1:], -np.inf) - gap_extend
+			F = np.maximum(opened, extended)
+			f_open[i] = opened >= extended
+			X = np.maximum(diagonal, F)
+			x_gap[i] = F > diagonal
+			## Gaps in ref follow each other along the row, E[d] = max over k < d of X[k] - gap_open - (d - 1 - k) * gap_extend
+			E = np.full(band, -np.inf)
+			E[1:] = (np.maximum.accumulate(X + steps) - steps)[:-1] - gap_open
+			e_open[i, 1:] = X[:-1] - gap_open >= E[:-1] - gap_extend
+			H = np.maximum(X, E)
+			h_gap[i] = E > X
+		d = int(np.argmax(H))
+		score = H[d]
+		## Trace back the query index aligned to every ref base, -1 for bases aligned to a gap
+		aligned = np.full(len(r), -1)
+		i = len(r)
+		state = "H"
+		while i > 0:
+			if state == "H":
+				state = "E" if h_gap[i, d] else "X"
+			elif state == "X":
+				if x_gap[i, d]:
+					state = "F"
+					continue
+				aligned[i - 1] = i + d - 1
+				i -= 1
+				state = "H"
+			elif state == "F":
+				state = "H" if f_open[i, d] else "F"
+				i -= 1
+				d += 1
+			else:
+				state = "X" if e_open[i, d] else "E"
+				d -= 1
+		## An indel next to the SNP could be placed on either side of it, the call is then left out
+		near = aligned[max(0, target - self.flank):target + self.flank + 1]
+		if near.min() < 0 or (np.diff(near) != 1).any():
+			return None, score
+		return int(aligned[target]), score
+
+	def call(self, file_name, windows):
+		'''Return the SNP states of a query fasta {SNP: state} for the SNPs of windows, and the set of SNPs that were not found'''
+		index = {}  ## seed -> [(SNP, offset in window)]
+		for name, (window, target, rbase, tbase) in windows.items():
+			values, valid = self.seeds.kmers(window)
+			counts = Counter(values[valid].tolist())
+			for offset in np.flatnonzero(valid).tolist():
+				value = int(values[offset])
+				if counts[value] == 1 and not offset <= target < offset + self.seeds.k:  ## Seeds covering the SNP depend on its allele
+					index.setdefault(value, []).append((name, offset))
+		keys = np.array(sorted(index), dtype=np.uint64)
+		votes = dict([(name, Counter()) for name in windows])
+		contigs = []
+		for sequence in read_fasta(file_name):
+			for strand in (sequence, reverse_complement(sequence)):
+				contig = len(contigs)
+				contigs.append(strand)
+				values, valid = self.seeds.kmers(strand)
+				for position in np.flatnonzero(valid & np.isin(values, keys)).tolist():
+					for name, offset in index[int(values[position])]:
+						votes[name][(contig, position - offset)] += 1
+		calls = {}
+		missing = set()
+		for name, (window, target, rbase, tbase) in windows.items():
+			calls[name] = 0
+			if not votes[name]:
+				missing.add(name)
+				continue
+			(contig, start), seeds = votes[name].most_common(1)[0]
+			if seeds < self.min_seeds:
+				missing.add(name)
+				continue
+			pad = "N" * max(0, self.band - start)
+			query = pad + contigs[contig][max(0, start - self.band):start + len(window) + self.band]
+			position, score = self.align(window, query, target)
+			if score < self.min_score * len(window) or position is None:
+				missing.add(name)
+				continue
+			base = query[position]
+			if base == tbase:
+				calls[name] = 1
+			elif base == rbase:
+				calls[name] = 2
+			else:
+				missing.add(name)
+		if self.verbose:
+			print("#Aligned {found} of {snps} SNP windows".format(found=len(windows) - len(missing), snps=len(windows)))
+		return calls, missing
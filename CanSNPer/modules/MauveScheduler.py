@@ -0,0 +1,118 @@
+#!/usr/bin/env python3 -c
+
+'''
+MauveScheduler runs progressiveMauve alignments on a limited number of slots.
+	Jobs are started the moment a slot is freed, each job is waited for in its own
+	thread so no polling is needed. Jobs can be given a timeout and crashed
+	alignments can be retried.
+'''
+
+__version__ = "0.1.0"
+__author__ = "David Sundell"
+__credits__ = ["David Sundell"]
+__license__ = "GPLv3"
+__maintainer__ = "FOI bioinformatics group"
+__email__ = ["bioinformatics@foi.se", "david.sundell@foi.se"]
+__date__ = "2019-05-02"
+__status__ = "Production"
+
+import time
+import threading
+import queue
+from subprocess import Popen, DEVNULL, TimeoutExpired
+
+class MauveJob(object):
+	"""A progressiveMauve command and the outcome of running it."""
+	def __init__(self, key, command, errfile):
+		super(MauveJob, self).__init__()
+		self.key = key  ## Identifier of the job, ie the reference number
+		self.command = command  ## Command as a list of arguments
+		self.errfile = errfile  ## stderr of progressiveMauve is written here
+		self.returncode = None
+		self.timed_out = False
+		self.error = None  ## Exception raised when progressiveMauve could not be run, ie it is not in PATH
+		self.attempts = 0
+		self.runtime = 0
+		self.result = None  ## Result handed over when the slot of the job is released
+
+	@property
+	def failed(self):
+		'''True if the last attempt did not align'''
+		return self.error is not None or self.timed_out or self.returncode != 0
+
+class MauveScheduler(object):
+	"""Event driven scheduler for progressiveMauve jobs."""
+	def __init__(self, slots, timeout=0, retries=0, verbose=False, dev=False):
+		super(MauveScheduler, self).__init__()
+		self.slots = max(1, slots)
+		self.timeout = timeout  ## seconds per attempt, 0 is no limit
+		self.retries = retries  ## number of times a crashed alignment is restarted
+		self.verbose = verbose
+		self.dev = dev
+		self.events = queue.Queue()
+
+	def run_attempt(self, job):
+		'''Run progressiveMauve once, it is killed if it runs longer than the timeout'''
+		with open(job.errfile, "w") as err:
+			p = Popen(job.command, stdout=DEVNULL, stderr=err)
+			try:
+				job.returncode = p.wait(timeout=self.timeout or None)
+			except TimeoutExpired:
+				p.kill()
+				p.wait()
+				job.timed_out = True
+				job.returncode = p.returncode
+				err.write("progressiveMauve timed out after %s seconds\n" % self.timeout)
+
+	def run_job(self, job):
+		'''Run a job in the current thread, retry if progressiveMauve crashed, timed out or could not be started.
+			The scheduler is always told that the job is done, also when it failed.'''
+		start = time.time()
+		try:
+			while job.attempts <= self.retries:
+				job.attempts += 1
+				job.timed_out = False
+				job.returncode = None
+				job.error = None
+				if self.dev:
+					print("#[DEV] progressiveMauve command: %s" % " ".join(job.command))
+				try:
+					self.run_attempt(job)
+				except Exception as e:
+					job.error = e
+				if not job.failed:
+					break
+		finally:
+			job.runtime = time.time() - start
+			self.events.put(("aligned", job, None))
+
+	def release(self, job):
+		'''Return a function that frees the slot of a job, it may be called from any thread'''
+		def done(result=None):
+			self.events.put(("released", job, result))
+		return done
+
+	def run(self, jobs, on_finish=False):
+		'''Run all jobs and return them when finished.
+
+			on_finish(job, release) is called in the calling thread as soon as an alignment is done.
+			The slot of the job is kept until release(result) is called, which allows work on the
+			alignment (ie parsing) to count against the number of slots.
+		'''
+		pending = list(jobs)
+		busy = 0
+		while pending or busy:
+			while pending and busy < self.slots:
+				job = pending.pop(0)
+				busy += 1
+				threading.Thread(target=self.run_job, args=(job,), daemon=True).start()
+			event, job, result = self.events.get()  ## Blocks until any job changes state
+			if event == "aligned":
+				if self.verbose:
+					print("#progressiveMauve job %s finished in %.1f s (%d attempt(s))" % (job.key, job.runtime, job.attempts))
+				if on_finish:
+					on_finish(job, self.release(job))
+					continue
+			job.result = result
+			busy -= 1
+		return jobs
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3 -c
+
+'''
+MinHashSketch finds the organism and closest reference strain of a query.
+	A sketch is the smallest hashes of the canonical k-mers of a sequence
+	(bottom-s MinHash). Sketches of the reference sequences are stored in the
+	Sketches table, keyed by the checksum of the sequence they were made from
+	(see SequenceStore.checksum). The Jaccard index of two sequences is
+	estimated from their sketches and turned into a Mash distance, which is
+	close to 1 - ANI for related genomes.
+'''
+
+__version__ = "0.1.0"
+__author__ = "David Sundell"
+__credits__ = ["David Sundell"]
+__license__ = "GPLv3"
+__maintainer__ = "FOI bioinformatics group"
+__email__ = ["bioinformatics@foi.se", "david.sundell@foi.se"]
+__date__ = "2019-05-14"
+__status__ = "Production"
+
+import math
+import sqlite3
+import numpy as np
+from CanSNPer.modules.KmerTyper import KmerTyper, read_fasta, reverse_complement
+
+def mix(values):
+	'''Return the splitmix64 hash of an array of uint64 values'''
+	with np.errstate(over="ignore"):
+		z = values + np.uint64(0x9E3779B97F4A7C15)
+		z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+		z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+		return z ^ (z >> np.uint64(31))
+
+class MinHashSketch(object):
+	"""Bottom-s MinHash sketches of the reference sequences of a database."""
+	def __init__(self, c, k=21, size=1000, max_distance=0.1, verbose=False):
+		super(MinHashSketch, self).__init__()
+		self.c = c
+		self.kmers = KmerTyper(k).kmers
+		self.k = k
+		self.size = size  ## hashes kept per sketch
+		self.max_distance = max_distance  ## a query further from every reference is not detected, 0.1 is about 90% ANI
+		self.verbose = verbose
+
+	def hashes(self, sequence):
+		'''Return the hashes of the canonical k-mers of a sequence, k-mers with other bases than ACGT are left out'''
+		forward, valid = self.kmers(sequence)
+		reverse = self.kmers(reverse_complement(sequence))[0][::-1]  ## Reverse complement of the k-mer at each position
+		return mix(np.minimum(forward, reverse)[valid])
+
+	def sketch(self, parts, contiguous=False):
+		'''Return the sketch of sequences, a sorted array of at most size hashes.
+
+			parts -- iterable of sequences, ie the records of a fasta file
+			contiguous -- the parts are pieces of one sequence (see SequenceStore.chunks), k-mers across them are included
+		'''
+		sketch = np.zeros(0, dtype=np.uint64)
+		tail = ""
+		for part in parts:
+			if contiguous:
+				part, tail = tail + part, (tail + part)[-(self.k - 1):]
+			## Only the smallest hashes are kept, so memory does not grow with the sequence
+			sketch = np.unique(np.concatenate((sketch, self.hashes(part.upper()))))[:self.size]
+		return sketch
+
+	def jaccard(self, a, b):
+		'''Return the Jaccard index of two sequences estimated from their sketches'''
+		union = np.union1d(a, b)[:self.size]
+		if not len(union):
+			return 0.0
+		shared = np.intersect1d(np.intersect1d(a, b, assume_unique=True), union, assume_unique=True)
+		return len(shared) / len(union)
+
+	def distance(self, a, b):
+		'''Return the Mash distance of two sequences from their sketches, 1 if they share no hashes'''
+		j = self.jaccard(a, b)
+		if j == 0:
+			return 1.0
+		return -math.log(2 * j / (1 + j)) / self.k
+
+	def stored(self):
+		'''Return the stored sketches {(organism, strain): (checksum, sketch)} made with the k and size of this object'''
+		try:
+			self.c.execute("SELECT Organism, Strain, Checksum, Hashes FROM Sketches WHERE K = ? AND Size = ?", (self.k, self.size))
+		except sqlite3.OperationalError:
+			return dict()  ## The database is older than the Sketches table
+		return dict([((organism, strain), (checksum, np.frombuffer(hashes, dtype=np.uint64))) for organism, strain, checksum, hashes in self.c.fetchall()])
+
+	def save(self, organism, strain, checksum, sketch):
+		'''Store the sketch of a reference sequence, replacing the one it had'''
+		self.c.execute("INSERT OR REPLACE INTO Sketches VALUES(?,?,?,?,?,?)",
+					   (organism, strain, self.k, self.size, checksum, sketch.astype(np.uint64).tobytes()))
+
+	def references(self, store, organisms, save=False):
+		'''Return the sketch of every reference sequence of the organisms {(organism, strain): sketch}.
+
+			store -- SequenceStore of the database
+			save -- store sketches that were missing or outdated, otherwise they are only made in memory
+		'''
+		stored = self.stored()
+		sketches = dict()
+		for organism in organisms:
+			for strain, checksum in store.checksums(organism).items():
+				if (organism, strain) in stored and stored[(organism, strain)][0] == checksum:
+					sketches[(organism, strain)] = stored[(organism, strain)][1]
+					continue
+				if self.verbose:
+					print("#Sketching reference sequence of {organism} {strain}".format(organism=organism, strain=strain))
+				sketches[(organism, strain)] = self.sketch(store.chunks(organism, strain), contiguous=True)
+				if save:
+					self.save(organism, strain, checksum, sketches[(organism, strain)])
+		return sketches
+
+	def stored_references(self, store, organisms):
+		'''Return the stored sketches of the reference sequences of the organisms that are up to date with the sequence
+			and the references that have none, ({(organism, strain): sketch}, [(organism, strain)]).
+
+			Nothing is sketched or hashed, sketches are compared with the checksums stored with the sequences
+			and references stored without a checksum have none.
+		'''
+		stored = self.stored()
+		sketches = dict()
+		missing = []
+		for organism in organisms:
+			for strain, checksum in store.stored_checksums(organism).items():
+				if checksum and (organism, strain) in stored and stored[(organism, strain)][0] == checksum:
+					sketches[(organism, strain)] = stored[(organism, strain)][1]
+				else:
+					missing.append((organism, strain))
+		return sketches, missing
+
+	def closest(self, file_name, references):
+		'''Return the references sorted by their distance to a query fasta [(distance, organism, strain)]'''
+		query = self.sketch(read_fasta(file_name))
+		return sorted([(self.distance(query, sketch), organism, strain) for (organism, strain), sketch in references.items()])
+
+	def detect(self, file_name, references):
+		'''Return (organism, strain, distance) of the reference closest to a query fasta, None if none is within max_distance'''
+		ranked = self.closest(file_name, references)
+		if not ranked or ranked[0][0] > self.max_distance:
+			return None
+		distance, organism, strain = ranked[0]
+		return organism, strain, distance
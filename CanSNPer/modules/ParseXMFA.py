@@ -17,13 +17,17 @@ __status__ = "Production"
 
 import argparse
 import os, string
+import gzip
+import bisect
+import mmap
+import numpy as np
 from CanSNPer.modules.DatabaseConnection import DatabaseConnection
 
 class CanSNPerClassification(object):
 	"""docstring for CanSNPerClassification."""
 	def __init__(self, database):
 		super(CanSNPerClassification, self).__init__()
-		self.database = DatabaseConnection(database)
+		self.database = DatabaseConnection(database, read_only=True)
 
 	def snp_lister(self, organism,reference="SCHUS4.2"):
 		'''Returns a list of all SNPs, their positions.
@@ -36,13 +40,75 @@ class CanSNPerClassification(object):
 			"""SELECT Strain, Position, Derived_base, Ancestral_base, SNP
 					FROM {organism}
 					WHERE Strain = ?
-			""".format(organism=organism), reference)
+			""".format(organism=organism), (reference,))
 		results = {}
 		for strain, pos,tbase,rbase, SNP in res.fetchall():
 			results[pos] = tuple([pos,rbase, tbase,SNP])
 		return results
 
+	def snp_catalog(self, organism):
+		'''Returns all SNPs of an organism for every reference strain using a single query.
 
+		Keyword arguments:
+		organism -- the name of the organism
+		return results as a dictionary per strain with the same layout as snp_lister {strain: {pos: (pos, refBase, TargetBase, SNP)}}
+		The catalog only holds builtin types so it can be sent to worker processes as it is.
+		'''
+		res = self.database.query(
+			"""SELECT Strain, Position, Derived_base, Ancestral_base, SNP
+					FROM {organism}
+			""".format(organism=organism))
+		catalog = {}
+		for strain, pos,tbase,rbase, SNP in res.fetchall():
+			catalog.setdefault(strain, {})[pos] = tuple([pos,rbase, tbase,SNP])
+		return catalog
+
+
+class BlockIntervals(object):
+	"""Reference intervals of xmfa blocks sorted by start for O(log n) lookup of positions.
+
+		The blocks of an alignment never share reference bases, so the intervals do not overlap
+		and the interval holding a position is the last one starting at or before it.
+	"""
+	def __init__(self):
+		super(BlockIntervals, self).__init__()
+		self.starts = []
+		self.ends = []
+		self.blocks = []
+		self.is_sorted = True
+
+	def add(self,start,end,block):
+		'''Add the reference interval of a block, blocks may be added in any order and are sorted once before the first lookup'''
+		self.starts.append(start)
+		self.ends.append(end)
+		self.blocks.append(block)
+		self.is_sorted = False
+
+	def sort(self):
+		'''Sort the intervals by start'''
+		order = sorted(range(len(self.starts)), key=self.starts.__getitem__)
+		self.starts = [self.starts[i] for i in order]
+		self.ends = [self.ends[i] for i in order]
+		self.blocks = [self.blocks[i] for i in order]
+		self.is_sorted = True
+
+	def find(self,pos):
+		'''Return the block holding a reference position, False if the position is not aligned'''
+		if not self.is_sorted:
+			self.sort()
+		i = bisect.bisect_right(self.starts, pos) - 1
+		if i >= 0 and pos <= self.ends[i]:
+			return self.blocks[i]
+		return False
+
+	def assign(self,positions):
+		'''Return a dictionary of blocks with the positions each of them holds'''
+		assigned = {}
+		for pos in positions:
+			block = self.find(pos)
+			if block:
+				assigned.setdefault(block, []).append(pos)
+		return assigned
 
 class ParseXMFA(object):
 	"""docstring for ParseXMFA."""
@@ -67,8 +133,7 @@ class ParseXMFA(object):
 			'''Create connection to SNP database and retrieve registered SNPs and save first snp to look for'''
 			self.SNP_DB = CanSNPerClassification(self.database)
 			self.snplist, self.snp_positions = self.get_snps()
-			self.current_snp = self.snp_positions.pop(0)
-		## as the snps are ordered according to the reference mauve positions they can be used sequentialy without search
+		## snp_positions is kept sorted, SNPs within a block are found by binary search so blocks may come in any order
 
 		'''SNPs will be stored as a sorted set containing (position, refBase, targetBase,SNPname)'''
 		self.SNPS = {}
@@ -81,9 +146,11 @@ class ParseXMFA(object):
 	def get_all(self):
 		return self.allSNP
 
-	def get_snps(self):
-		'''Retrieve snps from database object'''
-		self.snplist = self.SNP_DB.snp_lister(self.organism, self.reference)
+	def get_snps(self,snplist=False):
+		'''Retrieve snps from database object, unless a preloaded snplist of the reference is given'''
+		if snplist is False:
+			snplist = self.SNP_DB.snp_lister(self.organism, self.reference)
+		self.snplist = snplist
 		self.snp_positions = list(self.snplist.keys())
 		self.snp_positions.sort()
 		return self.snplist,self.snp_positions
@@ -93,35 +160,35 @@ class ParseXMFA(object):
 		dna_rev = [ self.rcDict[x] for x in dna[::-1] ]
 		return "".join(dna_rev)
 
-	def get_SNPs(self,ref,target,snp=0,head=0):
-		'''Walk through the paired sequences and save SNPs'''
-		snppos,rbase,tbase,snpName = snp    ## Retrieve all information known about the next upcoming SNP
-		ts1 = snppos
-		snppos -= int(head["start"])-1  ## python counts from 0 not 1
-		_rbase = False                    ## create place holder for reference base
-		_snp = False                    ## create place holder for target base
-		'''i will count the relative position in the reference (without -)'''
-		i = 0
-		''' ii is the actual position in the file '''
-		base_positions = range(len(ref))
-		'''If sign is "-" it means the reference sequence is the reverce complement, hence positions need to be inverse'''
-		if head["sign"] == "-":
-			base_positions = reversed(base_positions)
-		for ii in base_positions:
-			if ref[ii] != "-":          ## if the reference contains a - do not count as base, else follow reference position
-				i+=1
-			if i == snppos:                ## check the snp position
-				_snp = target[ii]        ## get base in target sequence
+	def block_index(self,ref):
+		'''Return the alignment column of each reference base in a block.
+			Element k is the column holding the k:th base (counted from 0) of the reference,
+			columns where the reference contains a - are not counted.
+		'''
+		return np.flatnonzero(np.frombuffer(ref.encode(), dtype=np.uint8) != ord("-"))
+
+	def get_SNPs(self,ref,target,snps=[],head=0):
+		'''Resolve all SNPs within a block of paired sequences using a reference coordinate index'''
+		SNP = {}
+		columns = self.block_index(ref)   ## Built once per block, shared by all SNPs in the block
+		for snp in snps:
+			snppos,rbase,tbase,snpName = snp    ## Retrieve all information known about the SNP
+			snppos -= int(head["start"])-1  ## relative position in the reference, counting from 1
+			_rbase = False                    ## create place holder for reference base
+			_snp = False                    ## create place holder for target base
+			if 0 < snppos <= len(columns):
+				'''If sign is "-" it means the reference sequence is the reverce complement, hence positions are counted from the end'''
 				if head["sign"] == "-":
-					'''Again if sign is "-" the complement base needs to be retrieved'''
-					_snp = self.reverse_complement(_snp)
-		self.allSNP.append([snpName,list(self.reference)[0],str(snppos),rbase,tbase,_snp])
-		SNP = {snp[3]:0} ## SNP not found
-		if tbase == _snp:                ## If Derived (target) base is in target sequence then call SNP
-			if self.verbose: print((_rbase), (tbase), snp, head["sign"], "Called")
-			SNP[snp[3]] = 1 		## Derived SNP
-		elif rbase == _snp:  		## SNP is found but confirmed to be ancestral
-			SNP[snp[3]] = 2			## Ancestral SNP
+					_snp = self.reverse_complement(target[columns[len(columns)-snppos]])
+				else:
+					_snp = target[columns[snppos-1]]
+			self.allSNP.append([snpName,self.reference,str(snppos),rbase,tbase,_snp])
+			SNP[snpName] = 0 ## SNP not found
+			if tbase == _snp:                ## If Derived (target) base is in target sequence then call SNP
+				if self.verbose: print((_rbase), (tbase), snp, head["sign"], "Called")
+				SNP[snpName] = 1 		## Derived SNP
+			elif rbase == _snp:  		## SNP is found but confirmed to be ancestral
+				SNP[snpName] = 2			## Ancestral SNP
 		return SNP
 
 	def parse_head(self,head):
@@ -139,8 +206,9 @@ class ParseXMFA(object):
 			ref = True
 		return {"ref":ref,"sign":sign, "start":start,"end":end,"relend":relend}
 
-	def read_sequence(self,seqP,res={}):
+	def read_sequence(self,seqP):
 		'''read information in sequence pair'''
+		res = {}
 		seqLines = seqP.strip().split("> ")
 		headinfo = seqLines[0]
 		if len(seqLines) > 2:  ## Both target and reference have sequence, parse and find ----- in data
@@ -148,54 +216,164 @@ class ParseXMFA(object):
 			refHead = self.parse_head(refSeq.pop(0))
 			targetSeq = seqLines[2].split("\n")
 			targetHead = self.parse_head(targetSeq.pop(0))
-			#if refHead["start"] < self.current_snp and refHead["end"] > self.current_snp:
-			while self.current_snp < refHead["end"]:
-				ref = "".join(refSeq)
-				target = "".join(targetSeq)
-				offset = 1
-				res = dict(**res, **self.get_SNPs(ref,target,snp=self.snplist[self.current_snp],head=refHead))
-				if len(self.snp_positions) == 0:  ## last position not found in this block continue, do not update SNP
-					return res
-				self.current_snp = self.snp_positions.pop(0)
-			return res
-
-	def read_xmfa(self,f=False):
-		'''read xmfa file'''
+			ref = "".join(refSeq)
+			target = "".join(targetSeq)
+			snps = [self.snplist[pos] for pos in self.block_snps(refHead)]
+			res = self.get_SNPs(ref,target,snps=snps,head=refHead)
+		return res
+
+	def block_snps(self,head):
+		'''Return the sorted SNP positions within the reference interval of a block'''
+		first = bisect.bisect_left(self.snp_positions, head["start"])
+		last = bisect.bisect_right(self.snp_positions, head["end"])
+		return self.snp_positions[first:last]
+
+	def missing_snps(self):
+		'''SNPs not covered by any block of the alignment are not found'''
+		for pos in self.snp_positions:
+			snppos,rbase,tbase,snpName = self.snplist[pos]
+			if snpName not in self.SNPS:
+				self.allSNP.append([snpName,self.reference,str(snppos),rbase,tbase,False])
+				self.SNPS[snpName] = 0
+		return self.SNPS
+
+	def open_xmfa(self,f):
+		'''Open xmfa file for binary reading, gzip compressed files are decompressed on the fly'''
+		if f.endswith(".gz"):
+			return gzip.open(f, "rb")
+		return open(f, "rb")
+
+	def xmfa_blocks(self,fin):
+		'''Generator that yields one alignment block at a time from an open xmfa file.
+			Only the lines of the current block are kept in memory.
+			Each block is returned as (byte offset, byte length, block text)
+		'''
+		block = []
+		offset = 0
+		position = 0
+		for line in fin:
+			#### Each aligned sequence part is separated by = sign
+			if line.startswith(b"="):
+				data = b"".join(block)
+				yield offset, len(data), data.decode()
+				block = []
+				offset = position + len(line)
+			else:
+				block.append(line)
+			position += len(line)
+		if block:  ## A file not terminated by = may still hold a last block
+			data = b"".join(block)
+			yield offset, len(data), data.decode()
+
+	def block_reference(self,seqP):
+		'''Return the parsed head of the reference (sequence 1) in a block, False if the reference is not aligned'''
+		for line in seqP.split("\n"):
+			if line.startswith("> 1:"):
+				return self.parse_head(line[2:])
+		return False
+
+	def index_file(self,f):
+		'''Return the name of the sidecar index of an xmfa file'''
+		return "{xmfa}.idx".format(xmfa=f)
+
+	def write_index(self,f,index):
+		'''Write the sidecar index of an xmfa file.
+			The first line stores the size of the indexed xmfa, each following line describes one block
+			offset, length, start, end and sign of the reference
+		'''
+		tmp = "{index}.{pid}.tmp".format(index=self.index_file(f), pid=os.getpid())
+		with open(tmp, "w") as fout:
+			fout.write("#xmfa_size\t{size}\n".format(size=os.path.getsize(f)))
+			for block in index:
+				fout.write("\t".join(map(str,block))+"\n")
+		os.replace(tmp, self.index_file(f))  ## Concurrent readers never see a partially written index
+
+	def read_index(self,f):
+		'''Read the sidecar index of an xmfa file, returns False if there is no index or it is outdated'''
+		idx = self.index_file(f)
+		if not os.path.exists(idx) or os.path.getmtime(idx) < os.path.getmtime(f):
+			return False
+		index = []
+		with open(idx) as fin:
+			size = fin.readline().strip().split("\t")
+			if len(size) != 2 or int(size[1]) != os.path.getsize(f):
+				return False
+			for line in fin:
+				offset,length,start,end,sign = line.strip().split("\t")
+				index.append((int(offset),int(length),int(start),int(end),sign))
+		return index
+
+	def read_indexed_xmfa(self,f,index):
+		'''Read only the blocks holding SNP positions, seeking to them in a memory mapped xmfa file'''
+		intervals = BlockIntervals()
+		for offset,length,start,end,sign in index:
+			intervals.add(start,end,(offset,length))
+		blocks = intervals.assign(self.snp_positions)
+		with open(f, "rb") as fin:
+			with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as xmfa:
+				for offset,length in blocks:
+					self.SNPS.update(self.read_sequence(xmfa[offset:offset+length].decode()))
+		return self.missing_snps()
+
+	def read_xmfa(self,f=False,index=False):
+		'''read xmfa file block by block.
+			If index is set, a sidecar index of the file is used when available and created when missing,
+			compressed files can not be indexed.
+		'''
 		if not f:
 			f = self.xmfa
-		with open(f) as fin:
-			fcontent = fin.read()
-			#### Each aligned sequence part is separated by = sign, so start with splitting the sequences into pairs of sequence
-			seqPairs = fcontent.strip().split("=")
-			for seqP in seqPairs:
+		index = index and not f.endswith(".gz") and os.path.getsize(f) > 0
+		if index:
+			blocks = self.read_index(f)
+			if blocks:
+				return self.read_indexed_xmfa(f, blocks)
+		blocks = []
+		with self.open_xmfa(f) as fin:
+			for offset,length,seqP in self.xmfa_blocks(fin):
+				if index:
+					head = self.block_reference(seqP)
+					if head:
+						blocks.append((offset,length,head["start"],head["end"],head["sign"]))
+				elif len(self.SNPS) == len(self.snp_positions):  ## All SNPs found, no need to read further
+					break
 				### Join together all SNPs found in data
-				if len(self.snp_positions) > 0:
-					self.SNPS = dict(**self.SNPS, **self.read_sequence(seqP))
-		return self.SNPS
+				if len(self.SNPS) < len(self.snp_positions):
+					self.SNPS.update(self.read_sequence(seqP))
+		if index:
+			self.write_index(f, blocks)
+		return self.missing_snps()
 
 	def get_references(self,database):
 		'''Get query'''
-		db = DatabaseConnection(database)
+		db = DatabaseConnection(database, read_only=True)
 		query = """SELECT DISTINCT(Strain) FROM Sequences"""
 		res = db.query(query).fetchall()
 		db.disconnect()
 		return res
 
-	def run(self, database, xmfa, organism,reference):
-		'''Run script function if class is called from other script'''
+	def run(self, database, xmfa, organism,reference,index=False,snplist=False):
+		'''Run script function if class is called from other script.
+			snplist is the preloaded SNPs of the reference (see CanSNPerClassification.snp_catalog),
+			the database is only opened if it is not given.
+		'''
 		self.database = database
 		self.organism = organism
+		if isinstance(reference, (tuple,list)):  ## references may be given as database rows
+			reference = reference[0]
 		self.reference = reference
 		self.xmfa = xmfa
+		self.SNPS = {}
+		self.allSNP = []
 		#print(self.database,self.organism, self.reference,self.xmfa)
-		'''Create connection to SNP database and retrieve registered SNPs and save first snp to look for'''
-		self.SNP_DB = CanSNPerClassification(self.database)
-		self.snplist, self.snp_positions = self.get_snps()
+		if snplist is False:
+			'''Create connection to SNP database and retrieve registered SNPs'''
+			self.SNP_DB = CanSNPerClassification(self.database)
+		self.snplist, self.snp_positions = self.get_snps(snplist)
 		if len(self.snp_positions) == 0:
-			print("Error no SNPs found in the database!")
-			exit()
-		self.current_snp = self.snp_positions.pop(0)
-		return self.read_xmfa()
+			## Do not exit, run is executed in worker processes that must return a result
+			print("Error no SNPs found in the database for {reference}!".format(reference=self.reference))
+			return {}
+		return self.read_xmfa(index=index)
 
 if __name__=="__main__":
 	parser = argparse.ArgumentParser(description='Parse xmfa files and extract non overlapping sequences')
@@ -204,9 +382,10 @@ if __name__=="__main__":
 	parser.add_argument('--organism', metavar='', default="Francisella", help="Specify organism")
 	parser.add_argument('--reference', metavar='', default="FSC200", help="Specify organism")
 	parser.add_argument('--flank', metavar='',default=200, type=int, help="Min length of gap to be saved to output")
+	parser.add_argument('--index',action='store_true',help="use (and create if missing) a .idx sidecar index of the xmfa file")
 	parser.add_argument('--verbose',action='store_true',help="print process info, default no output")
 	args = parser.parse_args()
 	if args.verbose:
 		print(args)
 	xmfa = ParseXMFA(database=args.database, xmfa=args.xmfa, organism=args.organism,reference=args.reference, main=True)
-	xmfa.read_xmfa()
+	xmfa.read_xmfa(index=args.index)
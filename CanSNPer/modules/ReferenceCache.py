@@ -0,0 +1,82 @@
+#!/usr/bin/env python3 -c
+
+'''
+ReferenceCache keeps the reference sequences of the database as fasta files
+	that progressiveMauve can read, so they are not rewritten on every run.
+	Files are named by a hash of their content, a changed sequence is written
+	to a new file and files are written atomically so concurrent runs can share
+	one cache folder.
+'''
+
+__version__ = "0.1.0"
+__author__ = "David Sundell"
+__credits__ = ["David Sundell"]
+__license__ = "GPLv3"
+__maintainer__ = "FOI bioinformatics group"
+__email__ = ["bioinformatics@foi.se", "david.sundell@foi.se"]
+__date__ = "2019-05-02"
+__status__ = "Production"
+
+import os
+import glob
+import hashlib
+from uuid import uuid4
+
+class ReferenceCache(object):
+	"""Content addressed cache of reference fasta files."""
+	def __init__(self, cache_path, verbose=False):
+		super(ReferenceCache, self).__init__()
+		self.cache_path = cache_path
+		self.verbose = verbose
+
+	def safe_name(self, name):
+		'''Organism and strain names are used in file names'''
+		return name.replace(os.sep, "_")
+
+	def key(self, organism, strain, sequence):
+		'''Return the content hash of a reference sequence'''
+		sha = hashlib.sha1()
+		sha.update("{organism}\t{strain}\t".format(organism=organism, strain=strain).encode())
+		sha.update(sequence.encode())
+		return sha.hexdigest()[:16]
+
+	def file_name(self, organism, strain, key):
+		'''Return the path of a cached reference'''
+		return os.path.join(self.cache_path, self.safe_name(organism),
+					"{strain}.{key}.fa".format(strain=self.safe_name(strain), key=key))
+
+	def get(self, organism, strain, sequence, key=False):
+		'''Return the fasta file of a reference sequence, the file is written if it is not in the cache
+
+			sequence -- the sequence, or a function returning it in parts which is only called if the file is written
+			key -- hash of the stored sequence (ie SequenceStore.checksum) used instead of hashing sequence
+		'''
+		if key:
+			key = self.key(organism, strain, key)
+		else:
+			key = self.key(organism, strain, sequence)
+		fasta = self.file_name(organism, strain, key)
+		if os.path.exists(fasta):
+			if self.verbose: print("#Using cached reference {fasta}".format(fasta=fasta))
+			return fasta
+		os.makedirs(os.path.dirname(fasta), exist_ok=True)
+		## Write to a unique name and move in place, other runs never see a partially written file
+		tmp = "{fasta}.{uid}.tmp".format(fasta=fasta, uid=uuid4().hex)
+		with open(tmp, "w") as fout:
+			fout.write(">%s.%s\n" % (organism, strain))
+			for part in ([sequence] if isinstance(sequence, str) else sequence()):
+				fout.write(part)
+			fout.write("\n")
+		os.replace(tmp, fasta)
+		if self.verbose: print("#Cached reference {fasta}".format(fasta=fasta))
+		return fasta
+
+	def clear(self, organism, strain):
+		'''Remove all cached versions of a reference, used when its sequence is changed in the database'''
+		pattern = os.path.join(glob.escape(os.path.join(self.cache_path, self.safe_name(organism))),
+					"{strain}.{key}.fa".format(strain=glob.escape(self.safe_name(strain)), key="[0-9a-f]"*16))
+		for fasta in glob.glob(pattern):
+			try:
+				os.remove(fasta)
+			except FileNotFoundError:
+				pass  ## Removed by a concurrent run
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3 -c
+
+'''
+ResultCache stores typing results on disk keyed by the content of the query,
+	the database and the settings used, so a resubmitted query does not need
+	to be aligned again. The cache is limited in size and the least recently
+	used results are removed first.
+'''
+
+__version__ = "0.1.0"
+__author__ = "David Sundell"
+__credits__ = ["David Sundell"]
+__license__ = "GPLv3"
+__maintainer__ = "FOI bioinformatics group"
+__email__ = ["bioinformatics@foi.se", "david.sundell@foi.se"]
+__date__ = "2019-05-03"
+__status__ = "Production"
+
+import os
+import json
+import hashlib
+from uuid import uuid4
+
+class ResultCache(object):
+	"""Size bounded least recently used cache of typing results."""
+	def __init__(self, cache_path, max_size=100, verbose=False):
+		super(ResultCache, self).__init__()
+		self.cache_path = cache_path
+		self.max_size = max_size * 1024 * 1024  ## max_size is given in megabytes
+		self.verbose = verbose
+		os.makedirs(self.cache_path, exist_ok=True)
+
+	def file_hash(self, file_name):
+		'''Return the hash of the content of a file, read in chunks'''
+		sha = hashlib.sha1()
+		with open(file_name, "rb") as fin:
+			for chunk in iter(lambda: fin.read(1 << 20), b""):
+				sha.update(chunk)
+		return sha.hexdigest()
+
+	def key(self, query, *args):
+		'''Return the cache key of a query file typed with the given database fingerprint and settings'''
+		sha = hashlib.sha1(self.file_hash(query).encode())
+		for arg in args:
+			sha.update("\t{arg}".format(arg=arg).encode())
+		return sha.hexdigest()
+
+	def file_name(self, key):
+		'''Return the path of a cached result'''
+		return os.path.join(self.cache_path, "{key}.json".format(key=key))
+
+	def get(self, key):
+		'''Return a cached result, False if there is none'''
+		result_file = self.file_name(key)
+		try:
+			with open(result_file) as fin:
+				result = json.load(fin)
+			os.utime(result_file)  ## Mark the result as recently used
+		except (OSError, ValueError):
+			return False
+		if self.verbose: print("#Using cached result {result}".format(result=result_file))
+		return result
+
+	def put(self, key, result):
+		'''Store a result and remove the least recently used results if the cache is full'''
+		result_file = self.file_name(key)
+		tmp = "{result}.{uid}.tmp".format(result=result_file, uid=uuid4().hex)
+		with open(tmp, "w") as fout:
+			json.dump(result, fout)
+		os.replace(tmp, result_file)  ## Concurrent runs never read a partially written result
+		self.evict()
+
+	def evict(self):
+		'''Remove least recently used results until the cache is within its size limit'''
+		entries = []
+		for f in os.listdir(self.cache_path):
+			if not f.endswith(".json"):
+				continue
+			try:
+				stat = os.stat(os.path.join(self.cache_path, f))
+			except FileNotFoundError:
+				continue  ## Evicted by a concurrent run
+			entries.append((stat.st_mtime, stat.st_size, f))
+		size = sum([entry[1] for entry in entries])
+		for mtime, fsize, f in sorted(entries):
+			if size <= self.max_size:
+				break
+			try:
+				os.remove(os.path.join(self.cache_path, f))
+			except FileNotFoundError:
+				pass
+			size -= fsize
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3 -c
+
+'''
+SequenceStore reads and writes the reference sequences of the database.
+	Sequences are either stored as text in Sequences.Sequence or 2-bit packed
+	in chunks in SequenceChunks, where every base other than A, C, G and T is
+	kept in a list of exceptions. A region of a packed sequence is read by
+	decoding only the chunks it overlaps. The checksum of every sequence is
+	stored with it when it is written, it does not change when it is packed.
+'''
+
+__version__ = "0.1.0"
+__author__ = "David Sundell"
+__credits__ = ["David Sundell"]
+__license__ = "GPLv3"
+__maintainer__ = "FOI bioinformatics group"
+__email__ = ["bioinformatics@foi.se", "david.sundell@foi.se"]
+__date__ = "2019-05-09"
+__status__ = "Production"
+
+import json
+import hashlib
+import numpy as np
+
+## 2-bit code of each base, 255 for bases that are kept as exceptions
+ENCODE = np.full(256, 255, dtype=np.uint8)
+for code, base in enumerate(b"ACGT"):
+	ENCODE[base] = code
+DECODE = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+class SequenceStore(object):
+	"""Text and 2-bit packed reference sequences of the Sequences and SequenceChunks tables."""
+	def __init__(self, c, chunk_size=65536, verbose=False):
+		super(SequenceStore, self).__init__()
+		self.c = c
+		self.chunk_size = chunk_size  ## bases per chunk, a multiple of 4
+		self.verbose = verbose
+		self._stored_checksums = None  ## True if Sequences has the Checksum column (schema version 4)
+
+	def pack(self, sequence):
+		'''Return a sequence 2-bit packed and its exceptions as [[start, length, base], ...]'''
+		seq = np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)
+		codes = ENCODE[seq]
+		other = np.flatnonzero(codes == 255)
+		exceptions = []
+		if len(other):
+			## Runs of the same base at consecutive positions are stored once
+			breaks = np.flatnonzero((np.diff(other) != 1) | (seq[other[1:]] != seq[other[:-1]])) + 1
+			starts = np.concatenate(([0], breaks))
+			ends = np.concatenate((breaks, [len(other)]))
+			exceptions = [[int(other[s]), int(e - s), chr(seq[other[s]])] for s, e in zip(starts, ends)]
+			codes[other] = 0
+		codes = np.concatenate((codes, np.zeros(-len(codes) % 4, dtype=np.uint8))).reshape(-1, 4)
+		packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+		return packed.astype(np.uint8).tobytes(), exceptions
+
+	def unpack(self, packed, length, exceptions):
+		'''Return the sequence of packed bases'''
+		packed = np.frombuffer(packed, dtype=np.uint8)
+		codes = np.empty((len(packed), 4), dtype=np.uint8)
+		for i, shift in enumerate((6, 4, 2, 0)):
+			codes[:, i] = (packed >> shift) & 3
+		seq = DECODE[codes.reshape(-1)[:length]]
+		for start, run, base in exceptions:
+			seq[start:start + run] = ord(base)
+		return seq.tobytes().decode("ascii")
+
+	def strains(self, organism):
+		'''Return the strains with a sequence of an organism'''
+		self.c.execute("SELECT Strain FROM Sequences WHERE Organism = ? ORDER BY Strain", (organism,))
+		return [strain for strain, in self.c.fetchall()]
+
+	def is_packed(self, organism, strain):
+		'''Return True if the sequence of a strain is stored packed'''
+		self.c.execute("SELECT Sequence IS NULL FROM Sequences WHERE Organism = ? AND Strain = ?", (organism, strain))
+		row = self.c.fetchone()
+		return bool(row and row[0])
+
+	def put(self, organism, strain, sequence, packed=True):
+		'''Store the sequence of a strain, replacing the sequence it had'''
+		checksum = self.content_hash([sequence])
+		self.c.execute("DELETE FROM SequenceChunks WHERE Organism = ? AND Strain = ?", (organism, strain))
+		self.c.execute("SELECT COUNT(*) FROM Sequences WHERE Organism = ? AND Strain = ?", (organism, strain))
+		if self.c.fetchone()[0]:
+			self.c.execute("UPDATE Sequences SET Sequence = ?, Checksum = ? WHERE Organism = ? AND Strain = ?",
+						   (None if packed else sequence, checksum, organism, strain))
+		else:
+			self.c.execute("INSERT INTO Sequences (Organism, Strain, Sequence, Checksum) VALUES(?,?,?,?)",
+						   (organism, strain, None if packed else sequence, checksum))
+		if not packed:
+			return
+		rows = []
+		for chunk, start in enumerate(range(0, len(sequence), self.chunk_size)):
+			part = sequence[start:start + self.chunk_size]
+			bases, exceptions = self.pack(part)
+			rows.append((organism, strain, chunk, len(part), bases, json.dumps(exceptions) if exceptions else None))
+		self.c.executemany("INSERT INTO SequenceChunks VALUES(?,?,?,?,?,?)", rows)
+
+	def pack_all(self, organism=None):
+		'''Pack every sequence stored as text, of one organism or of all of them. Returns the number packed'''
+		if organism:
+			self.c.execute("SELECT Organism, Strain FROM Sequences WHERE Organism = ? AND Sequence IS NOT NULL", (organism,))
+		else:
+			self.c.execute("SELECT Organism, Strain FROM Sequences WHERE Sequence IS NOT NULL")
+		strains = self.c.fetchall()
+		for organism, strain in strains:
+			if self.verbose: print("#Packing sequence of {organism} {strain}".format(organism=organism, strain=strain))
+			self.put(organism, strain, self.get(organism, strain), packed=True)
+		return len(strains)
+
+	def chunk_rows(self, organism, strain, first=0, last=-1):
+		'''Return (Chunk, Length, Packed, Exceptions) of the chunks first to last of a packed sequence, last -1 is to the end'''
+		self.c.execute("SELECT Chunk, Length, Packed, Exceptions FROM SequenceChunks WHERE Organism = ? AND Strain = ? " +
+					   "AND Chunk >= ? AND (Chunk <= ? OR ? < 0) ORDER BY Chunk", (organism, strain, first, last, last))
+		return self.c.fetchall()
+
+	def chunks(self, organism, strain):
+		'''Yield the sequence of a strain in parts, a packed sequence is decoded one chunk at a time'''
+		if not self.is_packed(organism, strain):
+			self.c.execute("SELECT Sequence FROM Sequences WHERE Organism = ? AND Strain = ?", (organism, strain))
+			row = self.c.fetchone()
+			if row:
+				yield row[0]
+			return
+		chunk = 0
+		while True:
+			rows = self.chunk_rows(organism, strain, chunk, chunk + 15)  ## Sixteen chunks per query
+			for number, length, packed, exceptions in rows:
+				yield self.unpack(packed, length, json.loads(exceptions) if exceptions else [])
+			if len(rows) < 16:
+				return
+			chunk += 16
+
+	def get(self, organism, strain):
+		'''Return the sequence of a strain'''
+		return "".join(self.chunks(organism, strain))
+
+	def region(self, organism, strain, start, end):
+		'''Return the bases start to end (0-based, end excluded) of the sequence of a strain'''
+		start = max(0, start)
+		if end <= start:
+			return ""
+		if not self.is_packed(organism, strain):
+			self.c.execute("SELECT substr(Sequence, ?, ?) FROM Sequences WHERE Organism = ? AND Strain = ?",
+						   (start + 1, end - start, organism, strain))
+			row = self.c.fetchone()
+			return row[0] if row else ""
+		## Chunks are read by the chunk size the sequence was stored with, all but the last chunk are full
+		self.c.execute("SELECT Length FROM SequenceChunks WHERE Organism = ? AND Strain = ? AND Chunk = 0", (organism, strain))
+		row = self.c.fetchone()
+		if not row:
+			return ""
+		chunk_size = row[0]
+		first = start // chunk_size
+		rows = self.chunk_rows(organism, strain, first, (end - 1) // chunk_size)
+		parts = [self.unpack(packed, length, json.loads(exceptions) if exceptions else []) for number, length, packed, exceptions in rows]
+		offset = start - first * chunk_size
+		return "".join(parts)[offset:offset + end - start]
+
+	def content_hash(self, parts):
+		'''Return the hash of a sequence given in parts'''
+		sha = hashlib.sha1()
+		for part in parts:
+			sha.update(part.encode())
+		return sha.hexdigest()
+
+	def has_checksums(self):
+		'''Return True if checksums are stored with the sequences, databases before schema version 4 have none'''
+		if self._stored_checksums is None:
+			self.c.execute("PRAGMA table_info(Sequences)")
+			self._stored_checksums = "Checksum" in [row[1] for row in self.c.fetchall()]
+		return self._stored_checksums
+
+	def stored_checksums(self, organism):
+		'''Return {strain: checksum} of the sequences of an organism as stored, None for sequences stored without one'''
+		if not self.has_checksums():
+			return dict([(strain, None) for strain in self.strains(organism)])
+		self.c.execute("SELECT Strain, Checksum FROM Sequences WHERE Organism = ? ORDER BY Strain", (organism,))
+		return dict(self.c.fetchall())
+
+	def checksums(self, organism):
+		'''Return {strain: checksum} of the sequences of an organism, read from the database.
+
+			Sequences without a stored checksum (databases not migrated to version 4) are hashed.
+		'''
+		checksums = self.stored_checksums(organism)
+		for strain in checksums:
+			if checksums[strain] is None:
+				if self.verbose: print("#No stored checksum of {organism} {strain}, the sequence is hashed (run --migrate_database to store it)".format(organism=organism, strain=strain))
+				checksums[strain] = self.content_hash(self.chunks(organism, strain))
+		return checksums
+
+	def checksum(self, organism, strain):
+		'''Return the checksum of the sequence of a strain, the hash of its text stored when it was written'''
+		if self.has_checksums():
+			self.c.execute("SELECT Checksum FROM Sequences WHERE Organism = ? AND Strain = ?", (organism, strain))
+			row = self.c.fetchone()
+			if row and row[0]:
+				return row[0]
+		return self.content_hash(self.chunks(organism, strain))
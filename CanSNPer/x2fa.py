@@ -17,9 +17,16 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
-# Apologies for the perl-esque way of coding.
-# I updated a perl script and tried to copy it line for line.
-# VERSION 9
+# VERSION 10
+# Updates for v10:
+# The conversion is the function x2fa, which can be imported and called without
+# starting a new process. Alignment blocks are numpy arrays, gap columns of the
+# reference are removed with a boolean mask and the flanks of all deletions in a
+# block are merged into one mask. The output is written through a buffered writer,
+# or with --stream (stream=True) straight into a memory mapped output file one block
+# at a time, so memory use does not grow with the number of genomes.
+# Fixed writing the repr of bytearrays instead of the bases, and screening of
+# deletion flanks only looking at the first sequence.
 # Updates for v9:
 # Changed the way screening of flanks is done. Fixed a bug where it sometimes messed
 # the length of the alignment up.
@@ -29,204 +36,228 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # Using the bytearrays, the program runs a lot faster, especially when screening deletion flanks.
 import re
 import sys
-#from string import maketrans
+import numpy as np
 
-def reverse_complement(dna):
-    '''Complement and reverse DNA string'''
-    complements = str.maketrans('acgtrymkbdhvACGTRYMKBDHV', 'tgcayrkmvhdbTGCAYRKMVHDB')
-    return dna.translate(complements)[::-1]
+GAP = ord("-")
+COMPLEMENT = bytes.maketrans(b'acgtrymkbdhvACGTRYMKBDHV', b'tgcayrkmvhdbTGCAYRKMVHDB')
+
+def read_blocks(xmfa_file, names):
+    '''Yield the alignment blocks of an XMFA file as {sequence number: (start, end, strand, aligned bytes)}.
+
+    Start and end are 1-based and inclusive. The names of the sequences, read from
+    the #SequenceNFile comments, are added to the dictionary names {number: name}.
+    '''
+    pattern_start_of_seq = re.compile(rb"^>\s*(\d+):(\d+)-(\d+) ([+-])")  # Finds the start of sequence in xmfa
+    pattern_seq_name = re.compile(rb"^#Sequence(\d+)File\t(.*)$")  # Finds comment line that contains sequence name in xmfa
+    block = dict()
+    header = None
+    parts = list()
+    with open(xmfa_file, "rb") as xmfa:
+        for line in xmfa:
+            line = line.rstrip(b"\r\n")
+            if line.startswith(b">"):
+                if header:
+                    block[header[0]] = header[1:] + (b"".join(parts),)
+                hit = pattern_start_of_seq.search(line)
+                num, start, end = int(hit.group(1)), int(hit.group(2)), int(hit.group(3))
+                header = (num, min(start, end), max(start, end), hit.group(4).decode())
+                parts = list()
+            elif line.strip() == b"=":
+                # = marks the end of an alignment block
+                if header:
+                    block[header[0]] = header[1:] + (b"".join(parts),)
+                if block:
+                    yield block
+                block = dict()
+                header = None
+            elif line.startswith(b"#"):
+                hit = pattern_seq_name.search(line)
+                if hit:
+                    names[int(hit.group(1))] = hit.group(2).strip().decode()
+            elif header:
+                parts.append(line.strip())
+    if header:
+        block[header[0]] = header[1:] + (b"".join(parts),)
+    if block:
+        yield block
+
+def runs(gaps):
+    '''Return the start and end columns of the runs of True in each row of a boolean matrix, as (rows, starts, ends)'''
+    padded = np.zeros((gaps.shape[0], gaps.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = gaps
+    change = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(change == 1)
+    ends = np.nonzero(change == -1)[1]
+    return rows, starts, ends
+
+def screen_block(block, reference_num, flank=0):
+    '''Return the rows of an alignment block with the gap columns of the reference removed {sequence number: bytes}.
+
+    With flank > 0 every base within flank bases of an insertion or deletion
+    against the reference is replaced by a gap, in all sequences of the block.
+    '''
+    numbers = list(block)
+    matrix = np.array([np.frombuffer(block[num][3], dtype=np.uint8) for num in numbers])
+    reference = matrix[numbers.index(reference_num)]
+    keep = reference != GAP
+    matrix = matrix[:, keep]
+    if flank > 0 and matrix.shape[1]:
+        length = matrix.shape[1]
+        # Insertions in the queries are where the removed reference gaps were
+        gap_starts = runs((~keep)[np.newaxis, :])[1]
+        inserted = np.concatenate(([0], np.cumsum(keep)))[gap_starts]
+        # Deletions are gaps of the other sequences
+        others = [row for row, num in enumerate(numbers) if num != reference_num]
+        rows, starts, ends = runs(matrix[others] == GAP)
+        starts = np.concatenate((inserted, starts))
+        ends = np.concatenate((inserted, ends))
+        # Merge all flank intervals into one mask with a running count of open intervals
+        edges = np.zeros(length + 1, dtype=np.int64)
+        np.add.at(edges, np.clip(starts - flank, 0, length), 1)
+        np.add.at(edges, np.clip(ends + flank, 0, length), -1)
+        masked = np.cumsum(edges[:-1]) > 0
+        matrix[:, masked] = GAP
+    return dict([(num, matrix[row].tobytes()) for row, num in enumerate(numbers)])
+
+def read_headers(xmfa_file, names):
+    '''Yield (sequence number, start, end) of every aligned sequence of an XMFA file without reading the bases.
+
+    The names of the sequences are added to the dictionary names {number: name}.
+    '''
+    pattern_start_of_seq = re.compile(rb"^>\s*(\d+):(\d+)-(\d+) ([+-])")
+    pattern_seq_name = re.compile(rb"^#Sequence(\d+)File\t(.*)$")
+    with open(xmfa_file, "rb") as xmfa:
+        for line in xmfa:
+            if line.startswith(b">"):
+                hit = pattern_start_of_seq.search(line)
+                start, end = int(hit.group(2)), int(hit.group(3))
+                yield int(hit.group(1)), min(start, end), max(start, end)
+            elif line.startswith(b"#"):
+                hit = pattern_seq_name.search(line.rstrip(b"\r\n"))
+                if hit:
+                    names[int(hit.group(1))] = hit.group(2).strip().decode()
+
+def reference_number(reference, num2name, xmfa_file):
+    '''Return the sequence number of the reference, given by name or number'''
+    name2num = dict([(name, num) for num, name in num2name.items()])
+    if reference in name2num:
+        return name2num[reference]
+    if str(reference).isdigit() and int(reference) in num2name:
+        return int(reference)
+    raise ValueError("{reference} is not a sequence of {xmfa}".format(reference=reference, xmfa=xmfa_file))
+
+def place_blocks(blocks, reference_num, flank, xmfa_file):
+    '''Yield (sequence number, 0-based position in the reference, bases) of the screened rows of alignment blocks'''
+    for block in blocks:
+        if reference_num not in block:  # Blocks without the reference are not in its coordinates
+            continue
+        start, end, sign = block[reference_num][:3]
+        start -= 1
+        if start < 0 or end <= 0:
+            continue
+        sequences = screen_block(block, reference_num, flank)
+        if len(sequences[reference_num]) != end - start:
+            raise ValueError("The block at {start}-{end} of {xmfa} does not match its length".format(start=start + 1, end=end, xmfa=xmfa_file))
+        for num, sequence in sequences.items():
+            if sign == "-":
+                sequence = sequence.translate(COMPLEMENT)[::-1]
+            if flank > 0:  # The ends of a block are screened like the flanks of a deletion
+                sequence = sequence[flank:-flank]
+            yield num, start + flank, sequence
+
+def write_fasta(outfile, name, sequence, width=80):
+    '''Write a sequence in fasta format, width bases per line'''
+    outfile.write(b">" + name.encode() + b"\n")
+    outfile.write(b"\n".join([sequence[pos:pos + width] for pos in range(0, len(sequence), width)]))
+    outfile.write(b"\n")
+
+def x2fa(xmfa_file, reference, flank=0, out_file=None, buffer_size=1 << 20, stream=False):
+    '''Convert an XMFA alignment to one fasta sequence per aligned genome, in the coordinates of the reference.
+
+    Keyword arguments:
+    xmfa_file -- the XMFA file, ie from progressiveMauve
+    reference -- the name of the reference as given in the XMFA file (#SequenceNFile), or its number
+    flank -- replace bases within flank bases of insertions and deletions with gaps
+    out_file -- write the sequences here, the reference first
+    stream -- write to out_file one block at a time (see x2fa_stream), nothing is returned
+
+    Positions of the reference that are not aligned are gaps. Returns the sequences
+    {name: bytes}.
+    '''
+    if stream:
+        return x2fa_stream(xmfa_file, reference, flank, out_file)
+    num2name = dict()
+    aligned = list(read_blocks(xmfa_file, num2name))
+    for block in aligned:
+        for num in block:
+            num2name.setdefault(num, str(num))
+    reference_num = reference_number(reference, num2name, xmfa_file)
+
+    # The length of the reference is the position of the "last" bit that is aligned
+    length_of_reference = max([block[reference_num][1] for block in aligned if reference_num in block] + [0])
+    outseqs = dict([(num, bytearray(b"-" * length_of_reference)) for num in sorted(num2name)])
+    for num, position, sequence in place_blocks(aligned, reference_num, flank, xmfa_file):
+        outseqs[num][position:position + len(sequence)] = sequence
+    if out_file:
+        with open(out_file, "wb", buffering=buffer_size) as outfile:
+            # First, write the reference sequence, then the rest
+            for num in [reference_num] + [num for num in outseqs if num != reference_num]:
+                write_fasta(outfile, num2name[num], outseqs[num])
+    return dict([(num2name[num], bytes(sequence)) for num, sequence in outseqs.items()])
+
+def x2fa_stream(xmfa_file, reference, flank, out_file, width=80):
+    '''Convert an XMFA alignment to fasta like x2fa, holding only one alignment block in memory.
+
+    The XMFA file is read twice. The headers give the names and the length of the
+    reference, from which the layout of out_file is known. It is created at its
+    full size, filled with gaps and memory mapped, and the rows of each block are
+    then written straight to their place in it. Memory use does not depend on the
+    number or length of the genomes, only on the largest block.
+    '''
+    num2name = dict()
+    length_of_reference = dict()
+    for num, start, end in read_headers(xmfa_file, num2name):
+        num2name.setdefault(num, str(num))
+        length_of_reference[num] = max(end, length_of_reference.get(num, 0))
+    reference_num = reference_number(reference, num2name, xmfa_file)
+    length = length_of_reference.get(reference_num, 0)
+
+    # Every record is a header and length bases in lines of width, the reference first
+    order = [reference_num] + [num for num in sorted(num2name) if num != reference_num]
+    headers = dict([(num, b">" + num2name[num].encode() + b"\n") for num in order])
+    body = length + max(1, -(-length // width))  # Bases and newlines
+    offsets = dict()
+    size = 0
+    for num in order:
+        offsets[num] = size + len(headers[num])
+        size = offsets[num] + body
+    with open(out_file, "wb") as outfile:
+        outfile.truncate(size)
+    if not size:
+        return None
+    out = np.memmap(out_file, dtype=np.uint8, mode="r+", shape=(size,))
+    newline = ord("\n")
+    for num in order:
+        offset = offsets[num]
+        out[offset - len(headers[num]):offset] = np.frombuffer(headers[num], dtype=np.uint8)
+        out[offset:offset + body] = GAP
+        out[offset + width:offset + body:width + 1] = newline
+        out[offset + body - 1] = newline
+    for num, position, sequence in place_blocks(read_blocks(xmfa_file, dict()), reference_num, flank, xmfa_file):
+        positions = np.arange(position, position + len(sequence))
+        out[offsets[num] + positions + positions // width] = np.frombuffer(sequence, dtype=np.uint8)
+    out.flush()
+    del out
+    return None
 
 if __name__ == "__main__":
     '''Run the program'''
-    if len(sys.argv) != 5:
+    stream = "--stream" in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != "--stream"]
+    if len(args) != 4:
         # Usage information
-        exit("usage: x2fa.py <.xmfa> <reference> <screen deletions by X bases> <outfile>")
-
-    # Self-explanatory grabbing of command-line arguments
-    xmfa = open(sys.argv[1], "r")
-    outfile = open(sys.argv[4], "w")
-    reference_name = sys.argv[2]
-    flank = int(sys.argv[3])
-
-    # Counters and other single variable initiations
-    alignment_number = 0  # Keeps track of the alignment
-    curr_seq = None  # Keeps track of which sequence is active when reading xmfa
-    curr_pos = None  # Keeps track of which position in the sequence we are at when reading xmfa
-
-    # Regex patterns
-    pattern_start_of_seq = re.compile("^>\s*(\d+):(\d+)-(\d+) ([+-])")  # Finds the start of sequence in xmfa
-    pattern_seq_name = re.compile("#Sequence(\d+)File")  # Finds comment line that contains sequence name in xmfa
-    pattern_comment = re.compile("#")  # Finds comment in xmfa
-    pattern_gap = re.compile("-+")  # Finds a gap of any size!
-
-    # Dictionaries
-    aGen = dict()  # This is the dictionary that will contain all alignment fragments
-    outseqs = dict()  # Will eventually be filled with finalised sequences
-    rmH = dict()  # Will contain information on things that are going to be removed
-    name2num = dict()  # Conversion dictionaries
-    num2name = dict()  # Conversion dictionaries
-    aGen[alignment_number] = dict()
-    rmH[alignment_number] = dict()
-    for line in xmfa:
-        if pattern_start_of_seq.search(line):
-            # This line contains information on the aligned sequence, add it to aGen
-            curr_seq = int(line.split(":")[0].split(" ")[1])
-            curr_pos = 0
-            aGen[alignment_number][curr_seq] = dict()
-
-            # Get the start and end position of the alignment
-            startend = line.split(" ")[1].split(":")[1].split("-")
-            startend[0] = int(startend[0])
-            startend[1] = int(startend[1])
-            if startend[0] < startend[1]:
-                aGen[alignment_number][curr_seq]["p1"] = startend[0]
-                aGen[alignment_number][curr_seq]["p2"] = startend[1]
-            else:
-                aGen[alignment_number][curr_seq]["p1"] = startend[1]
-                aGen[alignment_number][curr_seq]["p2"] = startend[0]
-            aGen[alignment_number][curr_seq]["sign"] = line.split(" ")[2]
-
-            # Save the alignment as a bytearray.
-            aGen[alignment_number][curr_seq]["seq"] = bytearray(" " * (aGen[alignment_number][curr_seq]["p2"] - aGen[alignment_number][curr_seq]["p1"]), encoding="utf8")
-        elif line.strip() == "=":
-            # = marks the start of a new alignment block
-            alignment_number += 1
-            aGen[alignment_number] = dict()
-            rmH[alignment_number] = dict()
-        elif pattern_seq_name.search(line):
-            # If its a sequence name comment line, add information to name2num/num2name
-            num = int(line.split("Sequence")[1].split("File")[0])
-            name = line.split("\t")[1].strip()
-            name2num[name] = num
-            num2name[num] = name
-        elif pattern_comment.search(line):
-            # If its another type of comment line, dont do anything
-            pass
-        else:
-            # The rest is only sequence, add it to the current seq at the current position
-            length_of_line = len(line) - 1
-            aGen[alignment_number][curr_seq]["seq"][curr_pos:curr_pos + length_of_line] = line.strip().encode(encoding="utf8")
-            curr_pos += length_of_line
-
-    # Dont need this file open anymore
-    xmfa.close()
-
-    # Find out which of the sequences is the reference
-    reference_num = name2num[reference_name]
-    # Get the length of the reference sequence, the position of the "last" bit that is aligned
-    length_of_reference = 0
-    for alignment in aGen.keys():
-        try:  # Try to test this, but skip any errors, the reference is not in all alignments
-            if aGen[alignment][reference_num]["p2"] > length_of_reference:
-                length_of_reference = aGen[alignment][reference_num]["p2"]
-        except KeyError as e:
-            pass
-
-    # Mock up the output sequences, fill them with only gaps
-    for num in num2name.keys():
-        # Handle the output sequences as bytearrays too!
-        outseqs[num] = bytearray("-" * length_of_reference, 'utf-8')
-
-    for alignment in list(aGen.keys()):
-        keep_going_flag = False
-        try:  # Test if the reference is in the alignment
-            tmp = aGen[alignment][reference_num]["seq"]
-            keep_going_flag = True
-        except KeyError as e:  # Delete the alignment if it doesnt have the reference
-            del aGen[alignment]
-
-        if keep_going_flag:  # If we have the reference
-            search_pos = 0
-            list_of_gaps = list()
-            sequence_search_string = str(aGen[alignment][reference_num]["seq"])
-            while search_pos < len(aGen[alignment][reference_num]["seq"]):
-                gap_hit = pattern_gap.search(sequence_search_string, search_pos)
-                if gap_hit:  # Looking for gaps in the reference
-                    rmH[alignment][gap_hit.start()] = gap_hit.end() - gap_hit.start()  # Save information
-                    search_pos = gap_hit.end()
-                else:
-                    break
-            #print(rmH)
-            for pos in reversed(sorted(rmH[alignment].keys())):  # Go through those gaps and remove them
-                if rmH[alignment][pos]:
-                    # print(rmH[alignment][pos])
-                    # print("True")
-
-                    start = pos
-                    end = pos + rmH[alignment][pos]
-                    #print(start,end)
-                    for sequence in aGen[alignment].keys():
-                        # print("Length before: ", len(aGen[alignment][sequence]["seq"]))
-                        # print(str(aGen[alignment][sequence]["seq"])[start:end])
-                        # print(aGen[alignment][sequence]["seq"][start:end])
-                        # #print(aGen[alignment][sequence]["seq"])
-                        # print(len(aGen[alignment][sequence]["seq"][start:end]), len(str(aGen[alignment][sequence]["seq"])[start:end]))
-                        aGen[alignment][sequence]["seq"][start:end] = bytearray('','utf8')#bytearray(str(aGen[alignment][sequence]["seq"])[start:end]="" ,'utf8')
-                        #print("Length after: ", len(aGen[alignment][sequence]["seq"]))
-                    if flank > 0:  # If we are going to extend deletions, store the information for these
-                        #print(list_of_gaps)
-                        for i in range(0, len(list_of_gaps)):
-                            # Reduce the position values as we remove pieces of the genome
-                            list_of_gaps[i] = [list_of_gaps[i][0] - end + start, list_of_gaps[i][1] - end + start]
-                        list_of_gaps.append([start, start])
-                    #exit()
-            if flank > 0:  # Extend the deletions by the number of bases given as flank
-                search_pos = 0
-                for sequence in aGen[alignment].keys():
-                    if sequence == reference_num:
-                        continue
-                    sequence_search_string = str(aGen[alignment][sequence]["seq"])
-                    while search_pos < length_of_reference:
-                        gap_hit = pattern_gap.search(sequence_search_string, search_pos)
-                        if gap_hit:  # Looking for gaps in the non-references
-                            list_of_gaps.append([gap_hit.start(), gap_hit.end()])
-                            search_pos = gap_hit.end()
-                        else:
-                            break
-                for non_ref_gap in list_of_gaps:
-                    for sequence in aGen[alignment].keys():
-                        new_start = max(0, non_ref_gap[0] - flank)
-                        new_end = min(non_ref_gap[1] + flank, len(aGen[alignment][sequence]["seq"]))
-                        aGen[alignment][sequence]["seq"][new_start:new_end] = bytearray("-" * (new_end - new_start))
-
-    # Go through all the alignment blocks and add the sequence to the output bytearrays
-    for alignment in aGen.keys():
-        start = int(aGen[alignment][reference_num]["p1"]) - 1
-        end = int(aGen[alignment][reference_num]["p2"])
-        if flank > 0:
-            start += flank
-            end -= flank
-        if aGen[alignment][reference_num]["sign"] == "+":
-            # Add sequence to outseqs
-            for sequence in aGen[alignment].keys():
-                if start >= 0 and end > 0 and aGen[alignment][sequence]["seq"]:
-                    if flank > 0:
-                        outseqs[sequence][start:end] = bytearray(str(aGen[alignment][sequence]["seq"][flank:-flank]), encoding="utf8")
-                    else:
-                        outseqs[sequence][start:end] = bytearray(str(aGen[alignment][sequence]["seq"]), encoding="utf8")
-        else:
-            # Add reverse complement to outseqs
-            for sequence in aGen[alignment].keys():
-                if start >= 0 and end > 0 and aGen[alignment][sequence]["seq"]:
-                    if flank > 0:
-                        outseqs[sequence][start:end] = bytearray(reverse_complement(str(aGen[alignment][sequence]["seq"][flank:-flank])), encoding="utf8")
-                    else:
-                        outseqs[sequence][start:end] = bytearray(reverse_complement(str(aGen[alignment][sequence]["seq"])), encoding="utf8")
-
-    # First, write the reference sequence
-    outfile.write(">" + num2name[reference_num] + "\n")
-    seqpos = 0
-    # 80 characters at a time
-    while seqpos < len(outseqs[reference_num]):
-        outfile.write(str(outseqs[reference_num][seqpos:seqpos + 80]) + "\n")
-        seqpos += 80
-
-    # Then, write the rest
-    for sequence in outseqs.keys():
-        if sequence != reference_num:
-            outfile.write(">" + num2name[sequence] + "\n")
-            seqpos = 0
-            while seqpos < len(outseqs[sequence]):
-                outfile.write(str(outseqs[sequence][seqpos:seqpos + 80]) + "\n")
-                seqpos += 80
-    outfile.close()
+        exit("usage: x2fa.py [--stream] <.xmfa> <reference> <screen deletions by X bases> <outfile>")
+    try:
+        x2fa(args[0], args[1], int(args[2]), args[3], stream=stream)
+    except ValueError as e:
+        exit(str(e))
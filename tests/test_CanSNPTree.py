@@ -0,0 +1,71 @@
+'''Tests of the vectorised classification in CanSNPTree'''
+
+import sqlite3
+import numpy as np
+from CanSNPer.modules.CanSNPTree import CanSNPTree
+
+def make_tree(newick, snps):
+	tree = CanSNPTree("Test").load_newick(newick)
+	tree.snps = dict([(snp, ("REF", i + 1, "A")) for i, snp in enumerate(snps)])
+	return tree
+
+def test_classify_matrix_without_snps():
+	'''A tree without SNPs classifies every sample as None instead of failing'''
+	tree = make_tree("((C)B)A;", [])
+	states, snp_names = tree.state_matrix([{}, {"B": 1}])
+	assert states.shape == (2, 0)
+	locations, forced = tree.classify_matrix(states, snp_names, threshold=1)
+	assert list(locations) == [tree.classify({}, 1)[0], tree.classify({"B": 1}, 1)[0]]
+	assert list(locations) == [None, None]
+	assert forced == [[], []]
+
+def test_classify_matrix_matches_classify():
+	'''Every sample is classified as by classify'''
+	tree = make_tree("((D,E)B,(F)C)A;", ["A", "B", "C", "D", "E", "F"])
+	rng = np.random.RandomState(1)
+	snplists = [dict(zip(tree.snps, rng.randint(0, 3, len(tree.snps)).tolist())) for i in range(50)]
+	for threshold in (0, 1, 2):
+		states, snp_names = tree.state_matrix(snplists)
+		locations, forced = tree.classify_matrix(states, snp_names, threshold)
+		for i, snplist in enumerate(snplists):
+			location, not_derived = tree.classify(snplist, threshold)
+			assert locations[i] == location
+			assert forced[i] == not_derived
+
+def test_load_and_allow_differences():
+	'''The snapshot is read from the database once, allowed differences pass ancestral SNPs on the way to a derived one'''
+	c = sqlite3.connect(":memory:").cursor()
+	c.execute("CREATE TABLE Tree (Name text, Children text, Organism text)")
+	c.executemany("INSERT INTO Tree VALUES(?,?,?)", [("A", "B;C", "Test"), ("B", "D", "Test"), ("C", "", "Test"), ("D", "", "Test")])
+	c.execute("CREATE TABLE Test (SNP VARCHAR(5), Reference VARCHAR(255), Strain VARCHAR(100), Position integer, Derived_base NCHAR(1), Ancestral_base NCHAR(1))")
+	c.executemany("INSERT INTO Test VALUES(?,?,?,?,?,?)", [(snp, "ref", "REF", i + 1, "A", "G") for i, snp in enumerate("ABCD")])
+	tree = CanSNPTree("Test").load(c)
+	assert tree.find_root() == "A"
+	assert tree.get_snp("D") == ("REF", 4, "A")
+	snplist = {"A": 1, "B": 2, "C": 2, "D": 1}
+	assert tree.classify(snplist, 0, "A") == ("A", [])
+	assert tree.classify(snplist, 1, "A") == ("D", ["B"])
+
+def test_classify_in_one_pass():
+	'''The deepest derived SNP is found, forcing only moves towards a derived SNP and deep trees need no recursion'''
+	tree = make_tree("((((E)D)C,F)B)A;", ["A", "B", "C", "D", "E", "F"])
+	counts, needed = tree.node_support({"A": 1, "B": 1, "C": 2, "D": 0, "E": 1}, "A")
+	assert counts["A"] == [3, 1, 2]
+	assert needed == {"A": 0, "B": 0, "C": 2, "D": 1, "E": 0, "F": None}
+	assert tree.classify({"A": 1, "B": 1, "C": 2, "D": 0, "E": 1}, 1, "A") == ("B", [])
+	assert tree.classify({"A": 1, "B": 1, "C": 2, "D": 0, "E": 1}, 2, "A") == ("E", ["C", "D"])
+	assert tree.classify({"A": 2, "B": 1}, 5, "A") == (None, [])
+	chain = make_tree("(" * 5000 + "N5000" + "".join([")N%d" % i for i in range(4999, -1, -1)]) + ";", ["N%d" % i for i in range(5001)])
+	assert chain.classify(dict([("N%d" % i, 1) for i in range(5001)]), 0, "N0") == ("N5000", [])
+
+def test_newick_and_root():
+	'''The root is the node listed as nobody's child, the newick of the tree reads back as the same tree'''
+	tree = CanSNPTree("Test")
+	tree.load_lines(["A;B", "A;B;D", "A;B;E", "A;C"])
+	tree.nodes.reverse()  ## The root is not the first row
+	assert tree.find_root() == "A"
+	newick = tree.to_newick()
+	assert newick == "((D,E)B,C)A;"
+	assert CanSNPTree("Test").load_newick(newick).to_newick() == newick
+	chain = make_tree("(" * 5000 + "N5000" + "".join([")N%d" % i for i in range(4999, -1, -1)]) + ";", [])
+	assert chain.to_newick("N0").count("(") == 5000
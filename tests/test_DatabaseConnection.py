@@ -0,0 +1,25 @@
+'''Tests of opening databases'''
+
+import sqlite3
+from CanSNPer.modules.DatabaseConnection import open_database
+
+def test_writers_leave_the_rollback_journal(tmp_path):
+	'''A database left in WAL mode is switched back, read only connections then need no -wal or -shm files'''
+	database = str(tmp_path / "test.db")
+	conn = sqlite3.connect(database)
+	conn.execute("PRAGMA journal_mode=WAL")
+	conn.execute("CREATE TABLE Tree (Name text, Children text, Organism text)")
+	conn.commit()
+	conn.close()
+	conn = open_database(database)
+	conn.execute("INSERT INTO Tree VALUES('A', 'B', 'Test')")
+	conn.commit()
+	conn.close()
+	assert sqlite3.connect(database).execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+	tmp_path.chmod(0o555)  ## Nothing can be created next to the database
+	try:
+		conn = open_database(database, read_only=True)
+		assert conn.execute("SELECT Name FROM Tree").fetchall() == [("A",)]
+		conn.close()
+	finally:
+		tmp_path.chmod(0o755)
@@ -0,0 +1,40 @@
+'''Tests of creating and migrating databases'''
+
+import sqlite3
+import pytest
+from CanSNPer.modules.DatabaseSchema import DatabaseSchema, DuplicateRowsError
+from CanSNPer.modules.SequenceStore import SequenceStore
+
+def old_database():
+	'''A database made before schema versions, with a duplicated SNP'''
+	c = sqlite3.connect(":memory:").cursor()
+	c.execute("CREATE TABLE Tree (Name text, Children text, Organism text)")
+	c.execute("CREATE TABLE Sequences (Organism text, Strain text, Sequence text)")
+	c.execute("CREATE TABLE Francisella (SNP VARCHAR(5), Reference VARCHAR(255), Strain VARCHAR(100), Position integer, Derived_base NCHAR(1), Ancestral_base NCHAR(1))")
+	c.executemany("INSERT INTO Tree VALUES(?,?,?)", [("B.1", "B.2", "Francisella"), ("B.2", "", "Francisella")])
+	c.execute("INSERT INTO Sequences VALUES('Francisella', 'REF', 'ACGTNNACGT')")
+	c.executemany("INSERT INTO Francisella VALUES(?,?,?,?,?,?)", [("B.1", "ref", "REF", 2, "T", "C"), ("B.2", "ref", "REF", 5, "A", "G"),
+																 ("B.1", "ref", "REF", 3, "A", "G")])
+	c.connection.commit()
+	return c
+
+def test_migrate_version_0_database():
+	'''Duplicates stop the migration unless they are removed on purpose, then every version is applied'''
+	c = old_database()
+	schema = DatabaseSchema(c)
+	assert schema.version() == 0
+	with pytest.raises(DuplicateRowsError) as error:
+		schema.migrate()
+	assert [(table, values) for table, rowid, values in error.value.rows] == [("Francisella", ("B.1",)), ("Francisella", ("B.1",))]
+	assert "--migrate_database" in str(error.value)
+	assert schema.version() == 0
+	assert DatabaseSchema(c, deduplicate=True).migrate() == schema.latest
+	assert schema.version() == schema.latest
+	assert schema.organisms() == ["Francisella"]
+	c.execute("SELECT Position FROM Francisella WHERE SNP = 'B.1'")
+	assert c.fetchall() == [(2,)]  ## The first row is kept
+	with pytest.raises(sqlite3.IntegrityError):
+		c.execute("INSERT INTO Francisella VALUES('B.2', 'ref', 'REF', 7, 'A', 'G')")
+	store = SequenceStore(c)
+	assert store.checksums("Francisella") == {"REF": store.content_hash(["ACGTNNACGT"])}
+	assert DatabaseSchema(c).migrate() == 0
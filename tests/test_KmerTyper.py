@@ -0,0 +1,37 @@
+'''Tests of calling SNPs from k-mers'''
+
+import numpy as np
+from CanSNPer.modules.KmerTyper import KmerTyper, reverse_complement
+
+OTHER = {"A": "G", "C": "T", "G": "A", "T": "C"}
+
+def make_reference(seed=5, length=3000):
+	rng = np.random.RandomState(seed)
+	reference = "".join(rng.choice(list("ACGT"), length))
+	## {position: (position, ancestral base, derived base, SNP)}, 1-based like the database
+	snps = dict([(pos, (pos, reference[pos - 1], OTHER[reference[pos - 1]], "S%d" % pos)) for pos in (500, 1000, 1500, 2000)])
+	return reference, {"REF": snps}
+
+def mutate(sequence, pos, base):
+	return sequence[:pos - 1] + base + sequence[pos:]
+
+def test_call_snps_from_kmers(tmp_path):
+	'''SNPs are called on both strands, SNPs next to an indel of the query are left unresolved'''
+	reference, catalog = make_reference()
+	typer = KmerTyper(31).build(catalog, lambda strain: reference if strain == "REF" else None)
+	assert typer.indexed == set(["S500", "S1000", "S1500", "S2000"])
+	query = mutate(reference, 500, catalog["REF"][500][2])  ## Derived
+	query = query[:1994] + query[1997:]  ## A deletion 5 bases from S2000
+	fasta = tmp_path / "query.fa"
+	fasta.write_text(">contig1\n%s\n>contig2\n%s\n" % (query[:1200], reverse_complement(query[1200:])))
+	calls, unresolved = typer.call(str(fasta))
+	assert calls == {"S500": 1, "S1000": 2, "S1500": 2, "S2000": 0}
+	assert unresolved == set(["S2000"])
+
+def test_repeated_flanks_are_not_indexed():
+	'''A SNP whose k-mers are found elsewhere in the reference can not be called from k-mers'''
+	reference, catalog = make_reference()
+	reference = reference[:2500] + reference[1485:1516] + reference[2531:]  ## The flanks of S1500 are repeated
+	typer = KmerTyper(31).build(catalog, lambda strain: reference)
+	assert "S1500" not in typer.indexed
+	assert typer.indexed == set(["S500", "S1000", "S2000"])
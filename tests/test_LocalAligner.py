@@ -0,0 +1,22 @@
+'''Tests of calling SNPs by aligning their flanks'''
+
+from CanSNPer.modules.LocalAligner import LocalAligner
+from CanSNPer.modules.KmerTyper import reverse_complement
+from test_KmerTyper import make_reference, mutate
+
+def test_call_snps_next_to_indels(tmp_path):
+	'''SNPs with indels near them in the query are called on either strand, unless the indel is next to the SNP'''
+	reference, catalog = make_reference()
+	aligner = LocalAligner(window=100)
+	windows = aligner.windows(catalog, set(["S500", "S1000", "S1500", "S2000"]), lambda strain, start, end: reference[start:end])
+	window, target, rbase, tbase = windows["S1000"]
+	assert len(window) == 201 and window[target] == reference[999] == rbase
+	query = mutate(reference, 1000, tbase)  ## Derived
+	query = query[:1500] + query[1502:]  ## A deletion right after S1500, it could be placed on either side
+	query = query[:1009] + "ACGTAC" + query[1009:]  ## An insertion 10 bases after S1000
+	query = query[:480] + query[488:]  ## A deletion 12 bases before S500
+	fasta = tmp_path / "query.fa"
+	fasta.write_text(">contig1\n%s\n>contig2\n%s\n" % (reverse_complement(query[:1800]), query[1800:1900]))
+	calls, missing = aligner.call(str(fasta), windows)
+	assert calls == {"S500": 2, "S1000": 1, "S1500": 0, "S2000": 0}
+	assert missing == set(["S1500", "S2000"])  ## S2000 is not in the query
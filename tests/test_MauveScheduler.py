@@ -0,0 +1,37 @@
+'''Tests of the progressiveMauve scheduler'''
+
+import sys
+import threading
+from CanSNPer.modules.MauveScheduler import MauveScheduler, MauveJob
+
+def test_missing_command_fails_instead_of_hanging(tmp_path):
+	'''A command that can not be started ends as a failed job and run returns'''
+	job = MauveJob(1, ["/nonexistent/progressiveMauve"], str(tmp_path / "err.txt"))
+	finished = []
+	jobs = MauveScheduler(2, retries=1).run([job], lambda job, release: (finished.append(job.key), release()))
+	assert jobs == [job]
+	assert finished == [1]
+	assert job.failed
+	assert isinstance(job.error, FileNotFoundError)
+	assert job.attempts == 2
+
+def test_jobs_run_on_limited_slots(tmp_path):
+	'''Every job is run, crashed jobs are retried and the result given to release is kept'''
+	jobs = [MauveJob(i, [sys.executable, "-c", "import sys; sys.exit(%d)" % (i % 2)], str(tmp_path / ("err%d.txt" % i))) for i in range(5)]
+	MauveScheduler(2, retries=1).run(jobs, lambda job, release: release(job.returncode))
+	assert [job.result for job in jobs] == [0, 1, 0, 1, 0]
+	assert [job.attempts for job in jobs] == [1, 2, 1, 2, 1]
+	assert [job.failed for job in jobs] == [False, True, False, True, False]
+
+def test_finished_jobs_are_handed_over_while_others_run(tmp_path):
+	'''on_finish gets a job as soon as it is done, its slot is only freed by release'''
+	slow = MauveJob("slow", [sys.executable, "-c", "import time; time.sleep(2)"], str(tmp_path / "slow.txt"))
+	fast = MauveJob("fast", [sys.executable, "-c", "pass"], str(tmp_path / "fast.txt"))
+	last = MauveJob("last", [sys.executable, "-c", "pass"], str(tmp_path / "last.txt"))
+	order = []
+	def on_finish(job, release):
+		order.append(job.key)
+		threading.Timer(0.2 if job.key == "fast" else 0, release, ("parsed %s" % job.key,)).start()
+	MauveScheduler(2).run([slow, fast, last], on_finish)
+	assert order == ["fast", "last", "slow"]  ## last waits for the slot of fast to be released, not for slow
+	assert [job.result for job in (slow, fast, last)] == ["parsed slow", "parsed fast", "parsed last"]
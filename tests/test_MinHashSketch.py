@@ -0,0 +1,46 @@
+'''Tests of finding the organism of a query from MinHash sketches'''
+
+import sqlite3
+import numpy as np
+from CanSNPer.modules.DatabaseSchema import DatabaseSchema
+from CanSNPer.modules.SequenceStore import SequenceStore
+from CanSNPer.modules.MinHashSketch import MinHashSketch
+from CanSNPer.__main__ import detect_organisms
+
+def random_sequence(rng, length):
+	return "".join(rng.choice(list("ACGT"), length))
+
+def make_database(rng):
+	c = sqlite3.connect(":memory:").cursor()
+	schema = DatabaseSchema(c)
+	store = SequenceStore(c)
+	sequences = dict()
+	for organism in ("Francisella", "Yersinia"):
+		schema.create(organism)
+		sequences[organism] = random_sequence(rng, 20000)
+		store.put(organism, "REF", sequences[organism], packed=organism == "Yersinia")
+	return c, store, sequences
+
+def test_detect_from_stored_sketches(tmp_path):
+	'''A query is matched to the organism of the closest reference, only up to date sketches are used'''
+	rng = np.random.RandomState(2)
+	c, store, sequences = make_database(rng)
+	sketcher = MinHashSketch(c, size=200)
+	assert sketcher.stored_references(store, ["Francisella", "Yersinia"]) == ({}, [("Francisella", "REF"), ("Yersinia", "REF")])
+	sketcher.references(store, ["Francisella", "Yersinia"], save=True)
+	c.execute("UPDATE Sequences SET Checksum = NULL WHERE Organism = 'Francisella'")  ## Not hashed again, left out
+	references, missing = sketcher.stored_references(store, ["Francisella", "Yersinia"])
+	assert list(references) == [("Yersinia", "REF")]
+	assert missing == [("Francisella", "REF")]
+	query = tmp_path / "query.fa"
+	query.write_text(">query\n%s\n" % sequences["Yersinia"][1000:15000])
+	assert sketcher.detect(str(query), references)[:2] == ("Yersinia", "REF")
+	query.write_text(">query\n%s\n" % random_sequence(rng, 10000))
+	assert sketcher.detect(str(query), references) is None
+
+def test_without_sketches_the_organism_is_asked_for(tmp_path, monkeypatch):
+	'''detect_organisms falls back to select_table if no sketch is stored'''
+	c, store, sequences = make_database(np.random.RandomState(3))
+	monkeypatch.setattr("builtins.input", lambda prompt: "Yersinia")
+	config = {"reference": None, "verbose": False, "query": None}
+	assert detect_organisms(["a.fa", "b.fa"], config, c) == {"a.fa": "Yersinia", "b.fa": "Yersinia"}
@@ -0,0 +1,100 @@
+'''Tests of reading SNPs from progressiveMauve alignments'''
+
+import os
+import gzip
+import pickle
+import sqlite3
+from CanSNPer.modules.ParseXMFA import ParseXMFA, BlockIntervals, CanSNPerClassification
+
+## Block 1 has gaps in the reference, block 2 is aligned to the minus strand of the reference
+BLOCKS = ["""> 1:1-10 + ref.fa
+ACG--TACGTAC
+> 2:1-12 + query.fa
+ATGCCTACGAAC
+""", """> 1:11-20 - ref.fa
+CCGGGGTTTT
+> 2:13-22 + query.fa
+CCGGGGTATT
+"""]
+HEADER = "#FormatVersion Mauve1\n#Sequence1File\tref.fa\n#Sequence2File\tquery.fa\n"
+
+## {position: (position, reference base, derived base, SNP)}
+SNPS = dict([(snp[0], snp) for snp in [(2, "C", "T", "S1"), (4, "T", "G", "S2"), (8, "T", "A", "S3"),
+									  (13, "A", "T", "S4"), (19, "G", "A", "S5"), (25, "C", "T", "S6")]])
+EXPECTED = {"S1": 1, "S2": 2, "S3": 1, "S4": 1, "S5": 2, "S6": 0}
+
+def write_xmfa(path, blocks, end="="):
+	text = HEADER + "=\n".join(blocks) + end + "\n"
+	if str(path).endswith(".gz"):
+		with gzip.open(str(path), "wt") as fout:
+			fout.write(text)
+	else:
+		path.write_text(text)
+	return str(path)
+
+def parse(xmfa, index=False):
+	return ParseXMFA().run("unused.db", xmfa, "Test", "REF", index=index, snplist=SNPS)
+
+def test_blocks_are_read_one_at_a_time(tmp_path):
+	'''Plain and gzipped alignments give the same SNPs, also when the last block is not ended by ='''
+	blocks = list(ParseXMFA().xmfa_blocks(open(write_xmfa(tmp_path / "test.xmfa", BLOCKS), "rb")))
+	assert len(blocks) == 2
+	assert blocks[1][2] == BLOCKS[1]
+	assert parse(write_xmfa(tmp_path / "test.xmfa", BLOCKS)) == EXPECTED
+	assert parse(write_xmfa(tmp_path / "test.xmfa.gz", BLOCKS)) == EXPECTED
+	assert parse(write_xmfa(tmp_path / "open.xmfa", BLOCKS, end="")) == EXPECTED
+
+def test_minus_strand_and_reference_gaps(tmp_path):
+	'''SNP positions skip the gap columns of the reference and count from the end of blocks on the minus strand'''
+	parser = ParseXMFA()
+	parser.reference = "REF"
+	assert list(parser.block_index("AC--G-T")) == [0, 1, 4, 6]
+	head = parser.parse_head("1:11-20 - ref.fa")
+	assert parser.get_SNPs("CCGGGGTTTT", "CCGGGGTATT", [SNPS[13], SNPS[19]], head) == {"S4": 1, "S5": 2}
+	head = parser.parse_head("1:1-10 + ref.fa")
+	assert parser.get_SNPs("ACG--TACGTAC", "ATGCCTACGAAC", [SNPS[2], SNPS[4], SNPS[8]], head) == {"S1": 1, "S2": 2, "S3": 1}
+	assert parse(write_xmfa(tmp_path / "test.xmfa", BLOCKS)) == EXPECTED
+
+def test_sidecar_index(tmp_path):
+	'''The index is written on the first read, used on the next and ignored once the alignment changes'''
+	xmfa = write_xmfa(tmp_path / "test.xmfa", BLOCKS)
+	assert parse(xmfa, index=True) == EXPECTED
+	index = ParseXMFA().read_index(xmfa)
+	assert [block[2:] for block in index] == [(1, 10, "+"), (11, 20, "-")]
+	parser = ParseXMFA()
+	calls = []
+	read = parser.read_indexed_xmfa
+	parser.read_indexed_xmfa = lambda f, index: calls.append(f) or read(f, index)
+	assert parser.run("unused.db", xmfa, "Test", "REF", index=True, snplist=SNPS) == EXPECTED
+	assert calls == [xmfa]
+	write_xmfa(tmp_path / "test.xmfa", BLOCKS[:1])
+	os.utime(xmfa, (os.path.getmtime(xmfa) + 10,) * 2)
+	assert ParseXMFA().read_index(xmfa) is False
+	assert parse(xmfa, index=True) == dict(EXPECTED, S4=0, S5=0)
+
+def test_blocks_in_any_order(tmp_path):
+	'''Positions are assigned to the block holding them whatever the order the blocks were added in'''
+	intervals = BlockIntervals()
+	for start, end in [(30, 39), (1, 10), (20, 25), (11, 19)]:
+		intervals.add(start, end, "%d-%d" % (start, end))
+	assert intervals.assign([1, 10, 11, 26, 39, 40]) == {"1-10": [1, 10], "11-19": [11], "30-39": [39]}
+	assert intervals.find(26) is False
+	intervals.add(26, 29, "26-29")  ## Sorted again before the next lookup
+	assert intervals.find(26) == "26-29"
+	assert parse(write_xmfa(tmp_path / "reversed.xmfa", BLOCKS[::-1]), index=True) == EXPECTED
+
+def test_snp_catalog(tmp_path):
+	'''The SNPs of all references are loaded in one query, as snp_lister gives them for each reference'''
+	database = str(tmp_path / "test.db")
+	conn = sqlite3.connect(database)
+	conn.execute("CREATE TABLE Test (SNP VARCHAR(5), Reference VARCHAR(255), Strain VARCHAR(100), Position integer, Derived_base NCHAR(1), Ancestral_base NCHAR(1))")
+	conn.executemany("INSERT INTO Test VALUES(?,?,?,?,?,?)", [(name, "ref", "REF", pos, tbase, rbase) for pos, rbase, tbase, name in SNPS.values()] +
+					 [("O1", "ref", "OTHER", 5, "A", "C")])
+	conn.commit()
+	conn.close()
+	classification = CanSNPerClassification(database)
+	catalog = classification.snp_catalog("Test")
+	assert catalog == {"REF": SNPS, "OTHER": {5: (5, "C", "A", "O1")}}
+	assert catalog["OTHER"] == classification.snp_lister("Test", "OTHER")
+	assert pickle.loads(pickle.dumps(catalog)) == catalog  ## Sent to worker processes as it is
+	assert ParseXMFA().run(database, write_xmfa(tmp_path / "test.xmfa", BLOCKS), "Test", "REF") == EXPECTED
@@ -0,0 +1,23 @@
+'''Tests of the reference fasta cache'''
+
+import os
+from CanSNPer.modules.ReferenceCache import ReferenceCache
+
+def test_files_are_written_once_per_sequence(tmp_path):
+	'''A reference is only written when its key is new, clear removes all its versions'''
+	cache = ReferenceCache(str(tmp_path))
+	reads = []
+	def parts():
+		reads.append(1)
+		return ["ACGT", "TTGA"]
+	fasta = cache.get("Francisella", "REF", parts, key="checksum1")
+	assert open(fasta).read() == ">Francisella.REF\nACGTTTGA\n"
+	assert cache.get("Francisella", "REF", parts, key="checksum1") == fasta
+	assert len(reads) == 1  ## The sequence is not read for a cached reference
+	changed = cache.get("Francisella", "REF", parts, key="checksum2")
+	assert changed != fasta and len(reads) == 2
+	assert cache.get("Francisella", "REF", "ACGTTTGA") not in (fasta, changed)  ## Keyed on the sequence itself
+	other = cache.get("Francisella", "REF2", parts, key="checksum1")
+	cache.clear("Francisella", "REF")
+	assert not os.path.exists(fasta) and not os.path.exists(changed)
+	assert os.path.exists(other)
@@ -0,0 +1,28 @@
+'''Tests of the typing result cache'''
+
+import os
+from CanSNPer.modules.ResultCache import ResultCache
+
+def test_results_are_keyed_by_query_and_settings(tmp_path):
+	'''A result is found again for the same query content and settings only'''
+	cache = ResultCache(str(tmp_path / "cache"))
+	query = tmp_path / "query.fa"
+	query.write_text(">q\nACGT\n")
+	key = cache.key(str(query), "Francisella", "fingerprint", 0)
+	assert cache.get(key) is False
+	cache.put(key, {"query": str(query), "snps": {"B.1": 1}, "classification": "B.1", "not_derived": []})
+	assert cache.get(cache.key(str(query), "Francisella", "fingerprint", 0))["classification"] == "B.1"
+	assert cache.key(str(query), "Francisella", "fingerprint", 1) != key
+	query.write_text(">q\nACGA\n")
+	assert cache.key(str(query), "Francisella", "fingerprint", 0) != key
+
+def test_least_recently_used_results_are_evicted(tmp_path):
+	'''The cache is kept within its size, the results used last are kept'''
+	cache = ResultCache(str(tmp_path / "cache"))
+	for i in range(3):
+		cache.put("key%d" % i, {"snps": {"SNP%d" % i: "x" * 100}})
+		os.utime(cache.file_name("key%d" % i), (i, i))
+	cache.max_size = 250  ## bytes, room for two results
+	cache.get("key0")  ## key0 is now the most recently used
+	cache.put("key3", {"snps": {"SNP3": "x" * 100}})
+	assert sorted(os.listdir(str(tmp_path / "cache"))) == ["key0.json", "key3.json"]
@@ -0,0 +1,32 @@
+'''Tests of storing reference sequences'''
+
+import sqlite3
+import numpy as np
+from CanSNPer.modules.DatabaseSchema import DatabaseSchema
+from CanSNPer.modules.SequenceStore import SequenceStore
+
+def test_packed_round_trip():
+	'''Packed sequences, other bases included, read back as stored, whole or by region, with the checksum of the text'''
+	c = sqlite3.connect(":memory:").cursor()
+	DatabaseSchema(c).migrate()
+	store = SequenceStore(c, chunk_size=64)
+	rng = np.random.RandomState(4)
+	sequence = list("".join(rng.choice(list("ACGT"), 1003)))
+	sequence[100:140] = "N" * 40  ## A run crossing a chunk boundary
+	sequence[500] = "R"
+	sequence[501] = "N"
+	sequence[-1] = "N"
+	sequence = "".join(sequence)
+	store.put("Francisella", "TEXT", sequence, packed=False)
+	store.put("Francisella", "PACKED", sequence)
+	assert not store.is_packed("Francisella", "TEXT") and store.is_packed("Francisella", "PACKED")
+	assert store.get("Francisella", "PACKED") == sequence
+	c.execute("SELECT COUNT(*), SUM(Length) FROM SequenceChunks WHERE Strain = 'PACKED'")
+	assert c.fetchone() == (16, 1003)
+	for start, end in [(0, 1), (60, 70), (63, 64), (64, 128), (90, 150), (499, 503), (990, 1003), (1000, 2000), (5, 5)]:
+		assert store.region("Francisella", "PACKED", start, end) == sequence[start:end]
+		assert store.region("Francisella", "TEXT", start, end) == sequence[start:end]
+	assert store.checksum("Francisella", "PACKED") == store.checksum("Francisella", "TEXT") == store.content_hash([sequence])
+	assert store.pack_all() == 1
+	assert store.get("Francisella", "TEXT") == sequence
+	assert store.checksum("Francisella", "TEXT") == store.content_hash([sequence])
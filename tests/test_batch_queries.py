@@ -0,0 +1,16 @@
+'''Tests of finding the queries of a batch'''
+
+import gzip
+from CanSNPer.__main__ import get_batch_queries
+
+def test_fasta_directory_and_manifest(tmp_path):
+	'''Fasta files, gzipped or not, are typed as they are, manifests list fasta files relative to themselves'''
+	with gzip.open(str(tmp_path / "a.fa.gz"), "wt") as fasta:
+		fasta.write(">a\nACGT\n")
+	(tmp_path / "b.fa").write_text(">b\nACGT\n")
+	(tmp_path / "manifest.txt").write_text("# queries\nb.fa\n\na.fa.gz\n")
+	(tmp_path / "dir").mkdir()
+	(tmp_path / "dir" / "c.fasta").write_text(">c\nACGT\n")
+	(tmp_path / "dir" / "notes.txt").write_text("c.fasta\n")
+	queries = get_batch_queries([str(tmp_path / "a.fa.gz"), str(tmp_path / "manifest.txt"), str(tmp_path / "dir")])
+	assert queries == [str(tmp_path / name) for name in ("a.fa.gz", "b.fa", "a.fa.gz", "dir/c.fasta")]
@@ -0,0 +1,41 @@
+'''Tests of importing SNPs and trees'''
+
+import sqlite3
+from CanSNPer.modules.DatabaseSchema import DatabaseSchema
+from CanSNPer.modules.CanSNPTree import CanSNPTree
+from CanSNPer.__main__ import import_to_db, import_tree
+
+def make_database():
+	c = sqlite3.connect(":memory:").cursor()
+	DatabaseSchema(c).create("Francisella")
+	return c
+
+def config():
+	return {"reference": "Francisella", "query": None, "verbose": False, "dev": False}
+
+def test_import_snps(tmp_path):
+	'''SNPs are inserted or updated in chunks, broken lines are skipped'''
+	c = make_database()
+	snp_file = tmp_path / "snps.txt"
+	snp_file.write_text("#SNP-name\tOrganism-name\tReference\tStrain\tPosition\tDerived-base\tAncestral-base\n" +
+						"".join(["B.%d\tFrancisella\tref\tREF\t%d\tA\tG\n" % (i, i * 10) for i in range(5)]) +
+						"B.9\tFrancisella\tref\tREF\tnot a position\tA\tG\nB.10\tFrancisella\n")
+	assert import_to_db(str(snp_file), config(), c, chunk_size=2) == (5, 0, 2)
+	snp_file.write_text("B.1\tFrancisella\tref\tREF\t11\tT\tC\nB.5\tFrancisella\tref\tREF\t50\tA\tG\n")
+	assert import_to_db(str(snp_file), config(), c, chunk_size=2) == (1, 1, 0)
+	c.execute("SELECT SNP, Position, Derived_base, Ancestral_base FROM Francisella WHERE SNP IN ('B.1', 'B.5') ORDER BY SNP")
+	assert c.fetchall() == [("B.1", 11, "T", "C"), ("B.5", 50, "A", "G")]
+
+def test_import_tree(tmp_path):
+	'''Trees are read from node lines or newick and replace the tree of the organism'''
+	c = make_database()
+	lines = tmp_path / "tree.txt"
+	lines.write_text("ROOT\nROOT;N1\nROOT;N2\nROOT;N2;N3\nROOT;N2;N4\n")
+	import_tree(str(lines), config(), c)
+	assert CanSNPTree("Francisella").load_tree(c).to_newick() == "(N1,(N3,N4)N2)ROOT;"
+	newick = tmp_path / "tree.nwk"
+	newick.write_text("(N1,(N3,N4,(N6)N5)N2)ROOT;\n")
+	import_tree(str(newick), config(), c)
+	c.execute("SELECT COUNT(*) FROM Tree WHERE Organism = 'Francisella'")
+	assert c.fetchone()[0] == 7
+	assert CanSNPTree("Francisella").load_tree(c).to_newick() == "(N1,(N3,N4,(N6)N5)N2)ROOT;"
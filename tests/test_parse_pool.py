@@ -0,0 +1,16 @@
+'''Tests of parsing alignments in worker processes'''
+
+from multiprocessing import Pool, cpu_count
+from CanSNPer.modules.ParseXMFA import ParseXMFA
+from CanSNPer.__main__ import get_pool_size, xmfa_parse_job, parse_xmfa
+from test_ParseXMFA import BLOCKS, SNPS, EXPECTED, write_xmfa
+
+def test_alignments_are_parsed_on_a_bounded_pool(tmp_path):
+	'''The pool has --num_threads workers, one per core by default, and the jobs carry the SNPs of their reference'''
+	assert get_pool_size(3) == 3
+	assert get_pool_size(0) == cpu_count()
+	write_xmfa(tmp_path / "q.fa.CanSNPer.1.xmfa", BLOCKS)
+	job = xmfa_parse_job(ParseXMFA(), "1", str(tmp_path), "q.fa", "unused.db", "Test", "REF", False, {"REF": SNPS, "OTHER": {}})
+	assert job[-1] == SNPS
+	with Pool(get_pool_size(2)) as pool:
+		assert pool.apply_async(parse_xmfa, job).get() == EXPECTED
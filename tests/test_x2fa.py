@@ -0,0 +1,43 @@
+'''Tests of the XMFA to fasta conversion'''
+
+from CanSNPer.x2fa import x2fa
+
+XMFA = """#FormatVersion Mauve1
+#Sequence1File\tref.fa
+#Sequence2File\tquery.fa
+> 1:1-8 + ref.fa
+ACGT--ACGT
+> 2:11-20 - query.fa
+ACGTTTACGA
+=
+> 1:9-12 - ref.fa
+AACC
+> 2:1-4 + query.fa
+AACG
+=
+> 2:30-33 + query.fa
+TTTT
+=
+"""
+
+def test_sequences_in_reference_coordinates(tmp_path):
+	'''Insertions in the query are removed and blocks on the minus strand of the reference are reverse complemented'''
+	xmfa = tmp_path / "test.xmfa"
+	xmfa.write_text(XMFA)
+	out_file = tmp_path / "test.fa"
+	sequences = x2fa(str(xmfa), "ref.fa", out_file=str(out_file))
+	assert sequences == {"ref.fa": b"ACGTACGTGGTT", "query.fa": b"ACGTACGACGTT"}
+	assert out_file.read_text() == ">ref.fa\nACGTACGTGGTT\n>query.fa\nACGTACGACGTT\n"
+	assert x2fa(str(xmfa), 1) == sequences
+
+def test_stream_writes_the_same_file(tmp_path):
+	'''Streaming into a memory mapped file gives the file of the buffered conversion, also for flanks and wrapped lines'''
+	long_block = "> 1:13-212 + ref.fa\n" + "ACGT" * 50 + "\n> 2:40-239 + query.fa\n" + "ACGA" * 20 + "-" * 3 + "ACGT" * 29 + "A\n=\n"
+	xmfa = tmp_path / "test.xmfa"
+	xmfa.write_text(XMFA + long_block)
+	for flank in (0, 1):
+		out_file, stream_file = tmp_path / "test.fa", tmp_path / "stream.fa"
+		x2fa(str(xmfa), "ref.fa", flank=flank, out_file=str(out_file))
+		assert x2fa(str(xmfa), "ref.fa", flank=flank, out_file=str(stream_file), stream=True) is None
+		assert stream_file.read_bytes() == out_file.read_bytes()
+		assert len(out_file.read_text().splitlines()[1]) == 80